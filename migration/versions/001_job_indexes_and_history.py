@@ -0,0 +1,43 @@
+"""Add indexes for the hot job queries, and the job history table for Job.archive()."""
+
+from sqlalchemy import *
+from migrate import *
+
+
+def indexes(job):
+    return [
+            Index('job_status_task_container', job.c.status, job.c.task, job.c.data_container_id),
+            Index('job_new', job.c.id, postgresql_where=(job.c.status == u'new')),
+            Index('job_unfinished', job.c.data_container_id, job.c.id, postgresql_where=(job.c.status != u'done')),
+            ]
+
+
+def job_history(meta):
+    return Table('jobhistory', meta,
+            Column('id', Integer, primary_key=True, autoincrement=False),
+            Column('timestamp', DateTime),
+            Column('task', Unicode(31)),
+            Column('redo_all', Boolean),
+            Column('progress', Integer),
+            Column('activity', Unicode(255)),
+            Column('archivetime', DateTime),
+            Column('data_container_id', Integer, ForeignKey('datacontainer.id')),
+            )
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    Table('datacontainer', meta, autoload=True)
+    job = Table('job', meta, autoload=True)
+    for index in indexes(job):
+        index.create()
+    job_history(meta).create()
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    Table('datacontainer', meta, autoload=True)
+    job = Table('job', meta, autoload=True)
+    for index in indexes(job):
+        index.drop()
+    job_history(meta).drop()
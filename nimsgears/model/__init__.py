@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """The application's model objects"""
 
+import sqlalchemy
 from zope.sqlalchemy import ZopeTransactionExtension
 from sqlalchemy.orm import scoped_session, sessionmaker
 #from sqlalchemy import MetaData
@@ -56,3 +57,9 @@ elixir.options_defaults['shortnames'] = True
 from nims import *
 
 elixir.setup_all()
+
+# job indexes, also created for existing databases by migration 001
+sqlalchemy.Index('job_status_task_container', Job.table.c.status, Job.table.c.task, Job.table.c.data_container_id)
+# partial indexes for Job.claim(), covering only new or unfinished jobs, which are few compared to done jobs
+sqlalchemy.Index('job_new', Job.table.c.id, postgresql_where=(Job.table.c.status == u'new'))
+sqlalchemy.Index('job_unfinished', Job.table.c.data_container_id, Job.table.c.id, postgresql_where=(Job.table.c.status != u'done'))
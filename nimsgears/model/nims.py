@@ -1,15 +1,18 @@
 import os
 import re
-import shutil
+import time
+import select
 import hashlib
 import datetime
 
 import dicom
+import sqlalchemy
 import transaction
 from elixir import *
 
 import nimsutil
 from nimsgears.model import metadata, DBSession
+from zope.sqlalchemy import mark_changed
 from repoze.what import predicates
 
 from tg import session
@@ -18,9 +21,27 @@ from sqlalchemy.util._collections import NamedTuple
 __session__ = DBSession
 __metadata__ = metadata
 
-__all__  = ['Group', 'User', 'Permission', 'Message', 'Job', 'Access', 'AccessPrivilege']
+__all__  = ['Group', 'User', 'Permission', 'Message', 'Job', 'JobHistory', 'Access', 'AccessPrivilege']
 __all__ += ['ResearchGroup', 'Person', 'Subject', 'DataContainer', 'Experiment', 'Session', 'Epoch']
 __all__ += ['Dataset', 'PrimaryMRData', 'DicomData' , 'GEPFile', 'NiftiData']
+__all__ += ['JOB_CHANNEL', 'UPDATE_CHANNEL', 'NotificationListener']
+
+# new jobs and earlier unfinished jobs are found through the job_new and job_unfinished partial indexes
+JOB_CLAIM_SQL = """
+    UPDATE %(job)s SET status = 'active' WHERE id IN (
+        SELECT job.id FROM %(job)s AS job
+        WHERE job.status = 'new' AND job.data_container_id IS NOT NULL %(task_clause)s AND NOT EXISTS (
+            SELECT 1 FROM %(job)s AS earlier
+            WHERE earlier.data_container_id = job.data_container_id AND earlier.id < job.id
+            AND earlier.status != 'done')
+        ORDER BY job.id LIMIT :limit
+        FOR UPDATE SKIP LOCKED)
+    RETURNING id"""
+
+JOB_CHANNEL = 'nims_job'            # new jobs and job status changes
+UPDATE_CHANNEL = 'nims_update'      # data containers that were updated or flagged for finding/processing
+
+JOB_OUTPUT_KINDS = {u'find': u'secondary', u'proc': u'derived'}    # datasets a job replaces when (re)started
 
 
 class Group(Entity):
@@ -467,18 +488,99 @@ class Job(Entity):
     def __unicode__(self):
         return u'%s#%s' % (self.data_container, self.task)
 
+    @classmethod
+    def claim(cls, limit=1, task=None):
+        """
+        Mark up to limit eligible new jobs as active, and return them in order; the caller must commit.
+
+        A new job is eligible once all earlier jobs for its data container are done. On PostgreSQL, jobs are
+        selected and marked in one statement, and jobs locked by a concurrent claim are skipped, not waited for.
+        """
+        if limit < 1:
+            return []
+        if DBSession.bind.dialect.name == 'postgresql':
+            sql = JOB_CLAIM_SQL % {'job': cls.table.name, 'task_clause': 'AND job.task = :task' if task else ''}
+            job_ids = [row[0] for row in DBSession.execute(sqlalchemy.text(sql), dict(limit=limit, task=task))]
+            mark_changed(DBSession())
+        else:
+            earlier = sqlalchemy.orm.aliased(cls)
+            unfinished = sqlalchemy.exists().where(earlier.data_container_id == cls.data_container_id)
+            unfinished = unfinished.where((earlier.id < cls.id) & (earlier.status != u'done'))
+            query = cls.query.filter(cls.status == u'new').filter(cls.data_container_id != None).filter(~unfinished)
+            if task:
+                query = query.filter(cls.task == task)
+            job_ids = []
+            for job in query.order_by(cls.id).limit(limit).with_lockmode('update').all():
+                job.status = u'active'
+                job_ids.append(job.id)
+        return cls.query.filter(cls.id.in_(job_ids)).order_by(cls.id).populate_existing().all() if job_ids else []
+
+    @classmethod
+    def archive(cls, before, batch_size=10000):
+        """Move done jobs created before the given time into the job history, committing per batch; return the count."""
+        columns = ['id', 'timestamp', 'task', 'redo_all', 'progress', 'activity', 'data_container_id']
+        job = cls.table
+        query = sqlalchemy.select([job.c[col] for col in columns]).where((job.c.status == u'done') & (job.c.timestamp < before))
+        archived_cnt = 0
+        while True:
+            rows = DBSession.execute(query.order_by(job.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                break
+            archivetime = datetime.datetime.now()
+            DBSession.execute(JobHistory.table.insert(), [dict(zip(columns, row), archivetime=archivetime) for row in rows])
+            DBSession.execute(job.delete().where(job.c.id.in_([row[0] for row in rows])))
+            mark_changed(DBSession())
+            transaction.commit()
+            archived_cnt += len(rows)
+        return archived_cnt
+
+    @classmethod
+    def create_many(cls, containers_and_tasks, nims_path):
+        """
+        Create new jobs for (data container, task) pairs in one insert, removing the datasets they will replace.
+
+        Equivalent to creating each job with Job(data_container=..., task=..., nims_path=...), but with one query
+        per task for the outdated datasets, and without loading the new jobs into the session.
+        """
+        for task, kind in JOB_OUTPUT_KINDS.iteritems():
+            container_ids = [dc.id for dc, t in containers_and_tasks if t == task]
+            if container_ids:
+                for ds in Dataset.query.filter(Dataset.container_id.in_(container_ids)).filter_by(kind=kind).all():
+                    nimsutil.digestutil.remove_dataset(os.path.join(nims_path, ds.relpath))
+                    ds.delete()
+        if containers_and_tasks:
+            DBSession.execute(cls.table.insert(), [dict(data_container_id=dc.id, task=task) for dc, task in containers_and_tasks])
+            notify(DBSession.connection(), JOB_CHANNEL)
+            mark_changed(DBSession())
+
     def restart(self, nims_path):
         self.status = u'new'
         query = Dataset.query.filter(Dataset.container == self.data_container)
-        if self.task == u'find':
-            query = query.filter_by(kind=u'secondary')
-        elif self.task == u'proc':
-            query = query.filter_by(kind=u'derived')
+        if self.task in JOB_OUTPUT_KINDS:
+            query = query.filter_by(kind=JOB_OUTPUT_KINDS[self.task])
         for ds in query.all():
-            shutil.rmtree(os.path.join(nims_path, ds.relpath))
+            nimsutil.digestutil.remove_dataset(os.path.join(nims_path, ds.relpath))
             ds.delete()
 
 
+class JobHistory(Entity):
+
+    """Done job, moved out of the job table by Job.archive(); keeps its original id."""
+
+    id = Field(Integer, primary_key=True, autoincrement=False)
+    timestamp = Field(DateTime)
+    task = Field(Unicode(31))
+    redo_all = Field(Boolean)
+    progress = Field(Integer)
+    activity = Field(Unicode(255))
+    archivetime = Field(DateTime, default=datetime.datetime.now)
+
+    data_container = ManyToOne('DataContainer')
+
+    def __unicode__(self):
+        return u'%s#%s' % (self.data_container, self.task)
+
+
 class AccessPrivilege(object):
 
     privilege_names = {
@@ -883,16 +985,20 @@ class Dataset(Entity):
             self.trashtime = None
             self.container.untrash()
 
-    def update_file_cnt_and_digest(self, nims_path):
+    @staticmethod
+    def file_cnt_and_digest(path, hash_name=None, pool=None):
+        """
+        Return the number of files in a dataset directory and the digest of their contents; touches no db state.
+
+        Only files that are new or changed since the last call are hashed, on the given thread pool, if any. Without
+        a hash_name, the hash of the last call is used; see nimsutil.digestutil.
+        """
+        return nimsutil.digestutil.file_cnt_and_digest(path, hash_name, pool)
+
+    def update_file_cnt_and_digest(self, nims_path, file_cnt_and_digest=None, hash_name=None):
+        """Set file count and digest, computed here unless given; return True if the digest changed."""
         old_digest = self.digest
-        new_hash = hashlib.sha1()
-        filelist = os.listdir(os.path.join(nims_path, self.relpath))
-        for filename in sorted(filelist):
-            with open(os.path.join(nims_path, self.relpath, filename), 'rb') as fd:
-                for chunk in iter(lambda: fd.read(1048576 * new_hash.block_size), ''):
-                    new_hash.update(chunk)
-        self.digest = new_hash.digest()
-        self.file_cnt_act = len(filelist)
+        self.file_cnt_act, self.digest = file_cnt_and_digest or self.file_cnt_and_digest(os.path.join(nims_path, self.relpath), hash_name)
         return self.digest != old_digest
 
 
@@ -917,12 +1023,15 @@ class PrimaryMRData(Dataset):
     def from_metadata(cls, md):
         dataset = cls.query.join(Epoch).filter(Epoch.uid == md.series_uid).filter(Epoch.acq == md.acq_no).with_lockmode('update').first()
         if not dataset:
+            md.group_name, md.exp_name = nimsutil.parse_patient_id(md.patient_id, ResearchGroup.get_all_ids())
             epoch = Epoch.from_metadata(md)
             dataset = cls(
                     container=epoch,
                     datatype=md.datatype,
                     kind=u'primary',
                     archived=True,
+                    file_cnt_act=0,
+                    file_cnt_tgt=md.image_cnt,
                     )
             transaction.commit()
             DBSession.add(dataset)
@@ -953,8 +1062,9 @@ class DicomData(PrimaryMRData):
             md.series_desc = nimsutil.clean_string(dcm.series_desc)
             md.timestamp = dcm.timestamp
             md.duration = dcm.duration
+            md.image_cnt = dcm.image_cnt
             md.subj_code, md.subj_fn, md.subj_ln, md.subj_dob = nimsutil.parse_subject(dcm.patient_name, dcm.patient_dob)
-            md.group_name, md.exp_name = nimsutil.parse_patient_id(dcm.patient_id, ResearchGroup.get_all_ids())
+            md.patient_id = dcm.patient_id
         return md
 
 
@@ -965,7 +1075,7 @@ class GEPFile(PrimaryMRData):
     @staticmethod
     def get_metadata(filename):
         try:
-            pf = nimsutil.pfile.PFile(filename)
+            pf = nimsutil.pfile.PFile(filename, probe=True)
         except nimsutil.pfile.PFileError:
             md = None
         else:
@@ -981,9 +1091,9 @@ class GEPFile(PrimaryMRData):
             md.series_desc = nimsutil.clean_string(pf.series_desc)
             md.timestamp = pf.timestamp
             md.duration = pf.duration
-            all_groups = [rg.id for rg in ResearchGroup.query.all()]
+            md.image_cnt = 1
             md.subj_code, md.subj_fn, md.subj_ln, md.subj_dob = nimsutil.parse_subject(pf.patient_name, pf.patient_dob)
-            md.group_name, md.exp_name = nimsutil.parse_patient_id(pf.patient_id, ResearchGroup.get_all_ids())
+            md.patient_id = pf.patient_id
         return md
 
 
@@ -995,3 +1105,68 @@ class NiftiData(Dataset):
 class Metadata(object):
 
         pass
+
+
+def notify(connection, channel):
+    """Send a notification, which PostgreSQL delivers when the current transaction commits."""
+    if connection.dialect.name == 'postgresql':
+        connection.execute('NOTIFY %s' % channel)
+
+def notify_on_insert(mapper, connection, target):
+    if isinstance(target, Job):
+        notify(connection, JOB_CHANNEL)
+    elif isinstance(target, DataContainer) and (target.updated or target.needs_finding or target.needs_processing):
+        notify(connection, UPDATE_CHANNEL)
+
+def notify_on_update(mapper, connection, target):
+    """Notify of job status changes, and of container flags being raised (not of their being set again)."""
+    if isinstance(target, Job) and sqlalchemy.orm.attributes.get_history(target, 'status')[0]:
+        notify(connection, JOB_CHANNEL)
+    elif isinstance(target, DataContainer):
+        if any(True in sqlalchemy.orm.attributes.get_history(target, flag)[0] for flag in ('updated', 'needs_finding', 'needs_processing')):
+            notify(connection, UPDATE_CHANNEL)
+
+sqlalchemy.event.listen(sqlalchemy.orm.mapper, 'after_insert', notify_on_insert)
+sqlalchemy.event.listen(sqlalchemy.orm.mapper, 'after_update', notify_on_update)
+
+
+class NotificationListener(object):
+
+    """
+    Wait for notifications on the given channels, using PostgreSQL's LISTEN.
+
+    On other databases, or while the listening connection is down, waiting falls back to sleeping.
+    """
+
+    def __init__(self, engine, *channels):
+        self.engine = engine
+        self.channels = channels
+        self.connection = None
+
+    def listen(self):
+        """Return the listening DBAPI connection, (re)connecting as needed; None if LISTEN is not supported."""
+        if self.engine.dialect.name == 'postgresql' and not self.connection:
+            self.connection = self.engine.raw_connection()  # held, i.e., never returned to the pool
+            self.connection.connection.set_isolation_level(0)   # autocommit
+            cursor = self.connection.cursor()
+            for channel in self.channels:
+                cursor.execute('LISTEN %s' % channel)
+        return self.connection and self.connection.connection
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for a notification; return True if there was one."""
+        try:
+            connection = self.listen()
+            if connection:
+                if select.select([connection], [], [], timeout) == ([], [], []):
+                    return False
+                connection.poll()
+                notified = bool(connection.notifies)
+                del connection.notifies[:]
+                return notified
+        except (select.error, self.engine.dialect.dbapi.Error):
+            if self.connection:
+                self.connection.invalidate()
+            self.connection = None
+        time.sleep(timeout)
+        return False
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# @author:  Gunnar Schaefer
+
+"""
+Benchmark Job.claim() against the single-job claim query the processor used to run, as the job history grows.
+
+Creates the model's tables in the given database and fills them with synthetic jobs; use a scratch database:
+    python -m nimsgears.tests.models.bench_job_claim postgresql://localhost/nims_bench --history 100000
+"""
+
+from __future__ import print_function
+
+import time
+import random
+import argparse
+import datetime
+
+import numpy as np
+import sqlalchemy
+import transaction
+
+from nimsgears import model
+from nimsgears.model import DBSession, DataContainer, Job
+
+
+def legacy_claim(task=None):
+    """The claim query of Processor.run before Job.claim(); returns at most one job."""
+    Job_A = sqlalchemy.orm.aliased(Job)
+    subquery = sqlalchemy.exists().where(Job_A.data_container_id == DataContainer.id)
+    subquery = subquery.where((Job_A.id < Job.id) & (Job_A.status != u'done'))
+    query = Job.query.join(DataContainer).filter(Job.status==u'new')
+    if task:
+        query = query.filter(Job.task==task)
+    return query.filter(~subquery).order_by(Job.id).with_lockmode('update').first()
+
+
+def insert_jobs(engine, container_ids, cnt, status):
+    now = datetime.datetime.now()
+    rows = [dict(timestamp=now, status=status, task=u'proc', data_container_id=random.choice(container_ids)) for i in range(cnt)]
+    for start in range(0, len(rows), 10000):
+        engine.execute(Job.table.insert(), rows[start:start+10000])
+
+
+def time_claims(claim, repeat):
+    """Return the median time of a claim, which is rolled back each time."""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        claim()
+        times.append(time.time() - start)
+        transaction.abort()
+    return np.median(times)
+
+
+class ArgumentParser(argparse.ArgumentParser):
+
+    def __init__(self):
+        super(ArgumentParser, self).__init__()
+        self.description = """Benchmark job claiming with a growing job history."""
+        self.add_argument('db_uri', help='URI of a scratch database')
+        self.add_argument('--history', type=int, default=100000, help='number of done jobs to end up with')
+        self.add_argument('--steps', type=int, default=4, help='number of history sizes to measure at')
+        self.add_argument('--containers', type=int, default=10000, help='number of data containers')
+        self.add_argument('--live', type=int, default=200, help='number of new and active jobs')
+        self.add_argument('--batch', type=int, default=8, help='number of jobs per claim')
+        self.add_argument('--repeat', type=int, default=20, help='number of claims to time at each history size')
+
+
+if __name__ == '__main__':
+    args = ArgumentParser().parse_args()
+    engine = sqlalchemy.create_engine(args.db_uri)
+    model.init_model(engine)
+    model.metadata.create_all(engine)
+    engine.execute(DataContainer.table.insert(), [dict(timestamp=datetime.datetime.now()) for i in range(args.containers)])
+    container_ids = [row[0] for row in engine.execute(sqlalchemy.select([DataContainer.table.c.id]))]
+    live_containers = random.sample(container_ids, args.live / 2)
+    insert_jobs(engine, live_containers, args.live / 4, u'active')
+    insert_jobs(engine, live_containers, args.live - args.live / 4, u'new')
+
+    print('%10s  %16s  %20s' % ('done jobs', 'legacy (1 job)', 'claim (%d jobs)' % args.batch))
+    done_cnt = 0
+    for step in range(args.steps + 1):
+        if step:
+            insert_jobs(engine, container_ids, args.history / args.steps, u'done')
+            done_cnt += args.history / args.steps
+            engine.execute('ANALYZE' if engine.dialect.name == 'postgresql' else 'SELECT 1')
+        legacy_time = time_claims(legacy_claim, args.repeat)
+        claim_time = time_claims(lambda: Job.claim(args.batch), args.repeat)
+        print('%10d  %14.2fms  %18.2fms' % (done_cnt, legacy_time * 1000, claim_time * 1000))
+    DBSession.remove()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Test suite for claiming, creating and archiving jobs"""
+import datetime
+
+import transaction
+from nose.tools import eq_
+
+from nimsgears import model
+from nimsgears.model import DBSession
+
+
+class TestJobClaim(object):
+    """Unit test case for ``Job.claim``."""
+
+    def setUp(self):
+        self.containers = [model.DataContainer() for i in range(3)]
+        jobs = [
+                (0, u'proc', u'done'),
+                (0, u'proc', u'new'),       # eligible
+                (0, u'find', u'new'),       # behind the previous job
+                (1, u'proc', u'failed'),
+                (1, u'proc', u'new'),       # behind a failed job
+                (2, u'find', u'new'),       # eligible
+                ]
+        self.jobs = [model.Job(data_container=self.containers[dc], task=task, status=status) for dc, task, status in jobs]
+        DBSession.flush()
+
+    def tearDown(self):
+        DBSession.rollback()
+
+    def test_claim_eligible_jobs(self):
+        claimed = model.Job.claim(10)
+        eq_(claimed, [self.jobs[1], self.jobs[5]])
+        eq_([job.status for job in claimed], [u'active', u'active'])
+        eq_(model.Job.claim(10), [])
+
+    def test_claim_limit_and_task(self):
+        eq_(model.Job.claim(1), [self.jobs[1]])
+        eq_(model.Job.claim(10, task=u'proc'), [])
+        eq_(model.Job.claim(10, task=u'find'), [self.jobs[5]])
+
+
+class TestJobCreateMany(object):
+    """Unit test case for ``Job.create_many``."""
+
+    def setUp(self):
+        self.containers = [model.DataContainer() for i in range(2)]
+        DBSession.flush()
+
+    def tearDown(self):
+        DBSession.rollback()
+
+    def test_create_many(self):
+        model.Job.create_many([(self.containers[0], u'find'), (self.containers[0], u'proc'), (self.containers[1], u'proc')], '/nonexistent')
+        jobs = model.Job.query.order_by(model.Job.id).all()
+        eq_([(job.data_container, job.task, job.status) for job in jobs],
+                [(self.containers[0], u'find', u'new'), (self.containers[0], u'proc', u'new'), (self.containers[1], u'proc', u'new')])
+
+
+class TestJobArchive(object):
+    """Unit test case for ``Job.archive``."""
+
+    def setUp(self):
+        container = model.DataContainer()
+        now = datetime.datetime.now()
+        jobs = [
+                (u'done', now - datetime.timedelta(days=10)),   # archived
+                (u'done', now - datetime.timedelta(days=9)),    # archived
+                (u'failed', now - datetime.timedelta(days=10)),
+                (u'new', now - datetime.timedelta(days=10)),
+                (u'done', now),
+                ]
+        jobs = [model.Job(data_container=container, task=u'proc', status=status, timestamp=timestamp, activity=u'job %d' % i)
+                for i, (status, timestamp) in enumerate(jobs)]
+        DBSession.flush()
+        self.job_ids = [job.id for job in jobs]
+        self.cutoff = now - datetime.timedelta(days=1)
+
+    def tearDown(self):
+        for obj in model.JobHistory.query.all() + model.Job.query.all() + model.DataContainer.query.all():
+            obj.delete()
+        transaction.commit()    # Job.archive() commits, so the fixture cannot simply be rolled back
+
+    def test_archive(self):
+        eq_(model.Job.archive(self.cutoff, batch_size=1), 2)
+        history = model.JobHistory.query.order_by(model.JobHistory.id).all()
+        eq_([(job.id, job.task, job.activity) for job in history], [(self.job_ids[0], u'proc', u'job 0'), (self.job_ids[1], u'proc', u'job 1')])
+        eq_([job.data_container for job in history], [model.Job.get(self.job_ids[2]).data_container] * 2)
+        assert all(job.archivetime for job in history)
+        eq_([job.id for job in model.Job.query.order_by(model.Job.id)], self.job_ids[2:])
+        eq_(model.Job.archive(self.cutoff), 0)
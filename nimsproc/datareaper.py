@@ -19,10 +19,10 @@ QUANTIZATION_CORRECTION = datetime.timedelta(seconds=1)
 
 class DataReaper(object):
 
-    def __init__(self, datetime_file):
+    def __init__(self, state):
         super(DataReaper, self).__init__()
-        self.datetime_file = datetime_file
-        self.last_update = nimsutil.get_reference_datetime(self.datetime_file)
+        self.state = state
+        self.last_update = self.state.get_reference_datetime(datetime.datetime.now())
         self.monitored_files = {}
         self.alive = True
 
@@ -43,13 +43,16 @@ class DataReaper(object):
             else:
                 this_check = datetime.datetime.fromtimestamp(int(out[0]))
                 remote_files = sorted([DataFile(*f.split(';')) for f in out[1:]], key=lambda rf: rf.mod_time)
+                for rf in remote_files:
+                    rf.needs_reaping = not self.state.is_reaped('file', rf.name, rf.size, rf.mtime)
                 for rf in remote_files:
                     if rf.name in self.monitored_files:
                         mf = self.monitored_files[rf.name]
                         if rf.size == mf.size and mf.needs_reaping:
                             success = rf.reap(this_check)
                             if success:
-                                nimsutil.update_reference_datetime(self.datetime_file, rf.mod_time)
+                                self.state.mark('file', rf.name, nimsutil.reapstate.REAPED, size=rf.size, mtime=rf.mtime)
+                                self.state.set_reference_datetime(rf.mod_time)
                                 self.last_update = rf.mod_time
                         elif mf.needs_reaping:
                             LOG.info('Monitoring %s' % rf)
@@ -58,6 +61,7 @@ class DataReaper(object):
                     else:
                         LOG.info('Discovered %s' % rf)
                 self.monitored_files = dict(zip([rf.name for rf in remote_files], remote_files))
+                self.state.forget_expired('file', self.last_update)
             finally:
                 time.sleep(SLEEP_TIME)
 
@@ -67,7 +71,8 @@ class DataFile(object):
     def __init__(self, name, size, mod_time, needs_reaping=True):
         self.name = name
         self.size = int(size)
-        self.mod_time = datetime.datetime.fromtimestamp(int(mod_time))
+        self.mtime = int(mod_time)
+        self.mod_time = datetime.datetime.fromtimestamp(self.mtime)
         self.needs_reaping = needs_reaping
 
     def __repr__(self):
@@ -124,7 +129,8 @@ if __name__ == '__main__':
     REAP_CMD = 'rsync -a %s:%%s %%s' % args.data_host
 
     datetime_file = os.path.join(os.path.dirname(__file__), '.%s.datetime' % REAPER_ID)
-    reaper = DataReaper(datetime_file)
+    state = nimsutil.reapstate.ReapState(os.path.join(os.path.dirname(__file__), '.%s.state' % REAPER_ID), datetime_file)
+    reaper = DataReaper(state)
 
     def term_handler(signum, stack):
         reaper.halt()
@@ -132,4 +138,5 @@ if __name__ == '__main__':
     signal.signal(signal.SIGTERM, term_handler)
 
     reaper.run()
+    state.close()
     LOG.warning('Process halted')
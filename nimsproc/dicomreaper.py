@@ -5,32 +5,63 @@
 
 import os
 import sys
+import json
 import time
 import shutil
+import Queue
 import signal
 import argparse
 import datetime
 import collections
+import multiprocessing.pool
+
+import dicom
 
 import scu
 import nimsutil
 
+MOVE_BATCH_SIZE = 100   # images per move
+FULL_QUERY_INTERVAL = 600   # seconds between full study queries, which also notice deleted studies
+
 
 class DicomReaper(object):
 
-    def __init__(self, id_, scu, reap_stage, sort_stage, datetime_file, sleep_time, log):
+    """
+    Reap completed series from a dicom server.
+
+    Series are moved concurrently, one per mover, i.e., per (caller AE title, incoming port) pair; each mover needs an
+    AE title of its own, because the server sends the images to the port it associates with the AE title. Reaped
+    series are staged for sorting in the order in which their moves were started.
+
+    Up to window exams are monitored at a time. The reap state records every reaped exam, series and image, so that a
+    restarted reaper neither moves images again nor re-queries reaped series.
+    """
+
+    def __init__(self, id_, scu, reap_stage, sort_stage, state, sleep_time, log, movers=None, index_file=None, max_sleep_time=None, window=2):
         self.id_ = id_
         self.scu = scu
         self.reap_stage = reap_stage
         self.sort_stage = sort_stage
-        self.datetime_file = datetime_file
+        self.state = state
+        self.window = window
         self.sleep_time = sleep_time
+        self.max_sleep_time = max(max_sleep_time, sleep_time)
+        self.idle_time = sleep_time
         self.log = log
+        self.index = StudyIndex(index_file)
+        self.last_full_query = 0
 
-        self.current_exam_datetime = nimsutil.get_reference_datetime(self.datetime_file)
-        self.monitored_exams = collections.deque()
+        self.current_exam_datetime = self.state.get_reference_datetime(datetime.datetime.now())
+        self.monitored_exams = []       # oldest first
         self.alive = True
 
+        movers = movers or [(scu.aet, scu.incoming_port)]
+        self.idle_movers = Queue.Queue()
+        for mover in movers:
+            self.idle_movers.put(mover)
+        self.pool = multiprocessing.pool.ThreadPool(len(movers))
+        self.moves = collections.deque()    # (series, reap_path, AsyncResult), in the order the moves were started
+
         # stage any files left behind from a previous run
         for item in os.listdir(self.reap_stage):
             if item.startswith(self.id_):
@@ -41,114 +72,307 @@ class DicomReaper(object):
 
     def run(self):
         while self.alive:
-            outstanding_exams = self.get_outstanding_exams()
-            n_monitored_exams = len(self.monitored_exams)
-            n_outstanding_exams = len(outstanding_exams)
-
-            if n_monitored_exams > 0 and n_outstanding_exams > 0 and self.monitored_exams[0].id_ != outstanding_exams[0].id_:
-                vanished_exam = self.monitored_exams.popleft()
-                self.log.warning('Dropping   %s (assumed deleted from scanner)' % vanished_exam)
-                continue
-
-            if n_monitored_exams > 1 and n_outstanding_exams > 1 and self.monitored_exams[1].id_ != outstanding_exams[1].id_:
-                vanished_exam = self.monitored_exams.pop()
-                self.log.warning('Dropping   %s (assumed deleted from scanner)' % vanished_exam)
-                continue
-
-            next_exam = None
-            if n_monitored_exams < 2 and n_monitored_exams < n_outstanding_exams:
-                next_exam = outstanding_exams[n_monitored_exams]
-                self.monitored_exams.append(next_exam)
-            elif n_monitored_exams == 2 and n_monitored_exams < n_outstanding_exams:
-                if not any([series.needs_reaping for series in self.monitored_exams[0].series_dict.itervalues()]):
-                    self.monitored_exams.popleft()
-                    next_exam = outstanding_exams[n_monitored_exams]
-                    self.monitored_exams.append(next_exam)
-                    self.current_exam_datetime = self.monitored_exams[0].datetime
-                    nimsutil.update_reference_datetime(self.datetime_file, self.current_exam_datetime)
-
-            if next_exam:
-                self.log.info('New        %s' % self.monitored_exams[-1])
-
+            self.update_monitored_exams(self.get_outstanding_exams())
             for exam in self.monitored_exams:
-                if not self.alive: return
+                if not self.alive: break
                 exam.reap()
-
-            time.sleep(self.sleep_time)
+            if not self.alive: break
+
+            self.index.prune(self.current_exam_datetime)
+            self.index.save()
+            self.stage_reaped(self.next_sleep_time())
+
+        self.pool.close()
+        self.pool.join()
+        self.stage_reaped()
+
+    def update_monitored_exams(self, outstanding_exams):
+        """
+        Drop vanished exams, retire reaped ones, and fill the window with the oldest outstanding exams.
+
+        An exam is reaped once it has been monitored, none of its series needs reaping, and a newer exam shows that the
+        scanner has moved on.
+        """
+        outstanding_uids = [exam.uid for exam in outstanding_exams]
+        skipped_uids = [exam.uid for exam in self.monitored_exams]
+        for exam in self.monitored_exams[:]:
+            if exam.uid not in outstanding_uids:
+                self.monitored_exams.remove(exam)
+                self.log.warning('Dropping   %s (assumed deleted from scanner)' % exam)
+            elif exam.reap_cnt and exam.uid != outstanding_uids[-1] and not any(series.needs_reaping for series in exam.series_dict.itervalues()):
+                self.monitored_exams.remove(exam)
+                self.state.mark('exam', exam.uid, nimsutil.reapstate.REAPED, size=self.index.studies[exam.uid]['instances'])
+                self.log.info('Reaped     %s' % exam)
+        for exam in outstanding_exams:
+            if len(self.monitored_exams) >= self.window:
+                break
+            if exam.uid not in skipped_uids:
+                self.monitored_exams.append(exam)
+                self.log.info('New        %s' % exam)
+        self.monitored_exams.sort(key=lambda exam: exam.datetime)
+        if self.monitored_exams and self.monitored_exams[0].datetime != self.current_exam_datetime:
+            self.current_exam_datetime = self.monitored_exams[0].datetime
+            self.state.set_reference_datetime(self.current_exam_datetime)
+
+    def next_sleep_time(self):
+        """Return the time to sleep until the next cycle, doubling it, up to max_sleep_time, while nothing changes."""
+        if self.index.changed or self.moves:
+            self.idle_time = self.sleep_time
+        else:
+            self.idle_time = min(self.idle_time * 2, self.max_sleep_time)
+        self.index.changed = False
+        return self.idle_time
+
+    def start_move(self, series, instance_uids):
+        now = datetime.datetime.now().strftime('%s')
+        stage_dir = '%s_%s-%d-%d_%s' % (self.id_, series.exam.id_, series.id_, series.move_cnt, now)
+        reap_path = nimsutil.make_joined_path(self.reap_stage, stage_dir)
+        self.moves.append((series, instance_uids, reap_path, self.pool.apply_async(self.move, (series, instance_uids, reap_path))))
+
+    def move(self, series, instance_uids, reap_path):
+        """Move images of a series with the next idle mover; runs on the pool."""
+        aet, incoming_port = self.idle_movers.get()
+        try:
+            query = scu.ImageQuery(StudyInstanceUID=series.exam.uid, SeriesInstanceUID=series.uid, SOPInstanceUID='\\'.join(instance_uids))
+            return self.scu.move(query, reap_path, aet, incoming_port)
+        finally:
+            self.idle_movers.put((aet, incoming_port))
+
+    def stage_reaped(self, timeout=0):
+        """Stage the finished moves that all earlier moves have finished before, waiting up to timeout seconds."""
+        deadline = time.time() + timeout
+        while self.moves:
+            series, instance_uids, reap_path, result = self.moves[0]
+            result.wait(max(deadline - time.time(), 0))
+            if not result.ready():
+                break
+            self.moves.popleft()
+            try:
+                reap_count = result.get()
+            except Exception as ex:
+                self.log.warning('Failed     %s: %s' % (series, ex))
+                reap_count = 0
+            series.reaped(instance_uids, reap_path, reap_count)
+        if not self.moves:
+            time.sleep(max(deadline - time.time(), 0))
 
     def get_outstanding_exams(self):
-        date = self.current_exam_datetime.strftime('%Y%m%d-')
-        response_list = self.scu.find(scu.StudyQuery(StudyDate=date))
-        exam_list = []
-        for resp in response_list:
-            exam_id = resp.StudyID
-            datetime_str = resp.StudyDate + resp.StudyTime
-            datetime_obj = datetime.datetime.strptime(datetime_str, '%Y%m%d%H%M%S')
-            exam_list.append(Exam(exam_id, datetime_obj, self))
-        exam_list = [exam for exam in exam_list if exam.datetime >= self.current_exam_datetime]
+        """
+        Update the study index, and return the exams since the current one that have not been reaped.
+
+        Every FULL_QUERY_INTERVAL, all studies since the date of the current exam are queried, and studies that are no
+        longer found are dropped. In between, only studies since the newest known one, and the monitored ones, are.
+        """
+        if time.time() - self.last_full_query >= FULL_QUERY_INTERVAL or not self.index.studies:
+            responses = self.find_studies(StudyDate=self.current_exam_datetime.strftime('%Y%m%d-'))
+            if responses:   # an empty response may just as well be a failed query
+                self.index.retain(resp.StudyInstanceUID for resp in responses)
+                self.last_full_query = time.time()
+                for kind in ('exam', 'series', 'image'):
+                    self.state.forget_before(kind, self.last_full_query - nimsutil.reapstate.RETENTION)
+        else:
+            newest = self.index.newest()
+            if newest[:8] == datetime.date.today().strftime('%Y%m%d'):
+                responses = self.find_studies(StudyDate=newest[:8], StudyTime=newest[8:] + '-')
+            else:
+                responses = self.find_studies(StudyDate=newest[:8] + '-')
+            if self.monitored_exams:
+                responses += self.find_studies(StudyInstanceUID='\\'.join(exam.uid for exam in self.monitored_exams))
+        for resp in responses:
+            self.index.update_study(resp.StudyInstanceUID, resp.StudyID, resp.StudyDate + resp.StudyTime[:6], resp.get('NumberOfStudyRelatedInstances', ''))
+        exam_list = [Exam(study['id'], uid, datetime.datetime.strptime(study['datetime'], '%Y%m%d%H%M%S'), self) for uid, study in self.index.studies.iteritems()]
+        exam_list = [exam for exam in exam_list if exam.datetime >= self.current_exam_datetime
+                and not self.state.is_reaped('exam', exam.uid, self.index.studies[exam.uid]['instances'])]
         return sorted(exam_list, key=lambda exam: exam.datetime)
 
+    def find_studies(self, **kwargs):
+        query = dict(StudyDate='', StudyTime='', StudyID='', StudyInstanceUID='', NumberOfStudyRelatedInstances='')
+        query.update(kwargs)
+        return self.scu.find(scu.StudyQuery(**query))
+
+
+class StudyIndex(object):
+
+    """
+    The studies known to be on the scanner, and their series, persisted as JSON unless filename is None.
+
+    Series are re-queried only when the instance count of their study has changed, or is not reported by the scanner.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.studies = {}       # study uid -> {'id', 'datetime', 'instances', 'series_instances', 'series': {series uid: [number, image count]}}
+        self.changed = False
+        self.dirty = False
+        try:
+            with open(filename) as fd:
+                self.studies = json.load(fd)
+        except (TypeError, IOError, ValueError):    # no, missing or unreadable index
+            pass
+
+    def newest(self):
+        return max(study['datetime'] for study in self.studies.itervalues())
+
+    def update_study(self, uid, id_, datetime_str, instances):
+        study = self.studies.setdefault(uid, {'series': {}, 'series_instances': None, 'instances': None})
+        instances = int(instances) if instances.isdigit() else None
+        if study.get('id') != id_ or study.get('datetime') != datetime_str or study['instances'] != instances:
+            study.update(id=id_, datetime=datetime_str, instances=instances)
+            self.changed = self.dirty = True
+
+    def get_series(self, uid):
+        """Return the series of a study, as (uid, number, image count), or None if they need to be queried."""
+        study = self.studies[uid]
+        if study['instances'] is None or study['instances'] != study['series_instances']:
+            return None
+        return [(series_uid, number, image_cnt) for series_uid, (number, image_cnt) in study['series'].iteritems()]
+
+    def update_series(self, uid, series_list):
+        study = self.studies[uid]
+        series = dict((series_uid, [number, image_cnt]) for series_uid, number, image_cnt in series_list)
+        if series != study['series']:
+            study['series'] = series
+            self.changed = True
+        study['series_instances'] = study['instances']
+        self.dirty = True
+
+    def retain(self, uids):
+        uids = set(uids)
+        for uid in set(self.studies) - uids:
+            del self.studies[uid]
+            self.changed = self.dirty = True
+
+    def prune(self, oldest):
+        oldest = oldest.strftime('%Y%m%d%H%M%S')
+        for uid, study in self.studies.items():
+            if study['datetime'] < oldest:
+                del self.studies[uid]
+                self.dirty = True
+
+    def save(self):
+        """Write the index atomically, if it has changed."""
+        if self.filename and self.dirty:
+            with open(self.filename + '.tmp', 'w') as fd:
+                json.dump(self.studies, fd)
+            os.rename(self.filename + '.tmp', self.filename)
+        self.dirty = False
+
 
 class Exam(object):
 
-    def __init__(self, id_, datetime_, reaper):
+    def __init__(self, id_, uid, datetime_, reaper):
         self.id_ = id_
+        self.uid = uid
         self.datetime = datetime_
         self.reaper = reaper
         self.series_dict = {}
+        self.reap_cnt = 0
 
     def __str__(self):
         return 'Exam %s %s' % (self.id_, self.datetime)
 
     def reap(self):
         """An exam must be reaped at least twice, since newly encountered series are not immediately reaped."""
-        reaper.log.debug('Monitoring %s' % self)
+        self.reaper.log.debug('Monitoring %s' % self)
+        self.reap_cnt += 1
         updated_series_list = self.get_series_list()
-        for updated_series in updated_series_list:
+        for updated_series in sorted(updated_series_list, key=lambda series: series.id_):
             if not self.reaper.alive: break
             if updated_series.id_ in self.series_dict:
                 self.series_dict[updated_series.id_].reap(updated_series.image_count)
             else:
-                reaper.log.info('New        %s' % updated_series)
+                if updated_series.needs_reaping:
+                    self.reaper.log.info('New        %s' % updated_series)
                 self.series_dict[updated_series.id_] = updated_series
 
     def get_series_list(self):
-        responses = reaper.scu.find(scu.SeriesQuery(StudyID=self.id_))
-        series_numbers = [int(resp.SeriesNumber) for resp in responses]
-        image_counts = [int(resp.ImagesInAcquisition) for resp in responses]
-        return [Series(self, self.reaper, id_, image_cnt) for (id_, image_cnt) in zip(series_numbers, image_counts)]
+        """Return the series of this exam, from the study index unless the exam has changed since they were queried."""
+        series_list = self.reaper.index.get_series(self.uid)
+        if series_list is None:
+            responses = self.reaper.scu.find(scu.SeriesQuery(StudyInstanceUID=self.uid, SeriesNumber='', SeriesInstanceUID='', ImagesInAcquisition=''))
+            series_list = [(resp.SeriesInstanceUID, int(resp.SeriesNumber), int(resp.ImagesInAcquisition)) for resp in responses]
+            self.reaper.index.update_series(self.uid, series_list)
+        return [Series(self, self.reaper, number, uid, image_cnt) for uid, number, image_cnt in series_list]
 
 
 class Series(object):
 
-    def __init__(self, exam, reaper, id_, image_count):
+    """
+    A series, reaped image by image.
+
+    Images are moved as soon as they appear, in batches of at most MOVE_BATCH_SIZE, and each batch is staged for
+    sorting as soon as it, and all batches before it, have arrived. Images that fail to arrive are moved again in the
+    next cycle. The series is reaped once its image count has stopped increasing and all of its images have arrived.
+    Reaped images, and reaped series with their image count, are recorded in the reap state as they are staged.
+    """
+
+    def __init__(self, exam, reaper, id_, uid, image_count):
         self.exam = exam
         self.reaper = reaper
         self.id_ = id_
+        self.uid = uid
         self.image_count = image_count
-        self.needs_reaping = True
+        self.needs_reaping = not reaper.state.is_reaped('series', uid, image_count)
+        self.instance_uids = []         # as of the last image query, in instance number order
+        self.reaped_uids = reaper.state.keys('image', uid)
+        self.moving_uids = set()
+        self.move_cnt = 0
 
     def __str__(self):
         return '%s, Series %d, %d images' % (self.exam, self.id_, self.image_count)
 
     def reap(self, new_image_count):
-        if new_image_count > self.image_count:
+        stable = new_image_count <= self.image_count
+        if not stable:
             self.image_count = new_image_count
             self.needs_reaping = True
             self.reaper.log.info('Monitoring %s' % self)
-        elif self.needs_reaping: # image count has stopped increasing
-            self.reaper.log.info('Reaping    %s' % self)
-            now = datetime.datetime.now().strftime('%s')
-            stage_dir = '%s_%s-%d_%s' % (self.reaper.id_, self.exam.id_, self.id_, now)
-            reap_path = nimsutil.make_joined_path(self.reaper.reap_stage, stage_dir)
-            reap_count = self.reaper.scu.move(scu.SeriesQuery(StudyID=self.exam.id_, SeriesNumber=self.id_), reap_path)
-            if reap_count >= self.image_count:
-                self.needs_reaping = False
-                shutil.move(reap_path, reaper.sort_stage)
-                self.reaper.log.info('Reaped     %s' % self)
-            else:
-                shutil.rmtree(reap_path)
-                self.reaper.log.warning('Incomplete %s, %d reaped' % (self, reap_count))
+        if not self.needs_reaping:
+            return
+        if len(self.instance_uids) < self.image_count:
+            self.instance_uids = self.get_instance_uids()
+        new_uids = [uid for uid in self.instance_uids if uid not in self.reaped_uids and uid not in self.moving_uids]
+        if new_uids:
+            self.reaper.log.info('Reaping    %s, %d new' % (self, len(new_uids)))
+            for i in range(0, len(new_uids), MOVE_BATCH_SIZE):
+                self.move_cnt += 1
+                self.reaper.start_move(self, new_uids[i:i+MOVE_BATCH_SIZE])
+            self.moving_uids.update(new_uids)
+        elif stable and not self.moving_uids and len(self.reaped_uids) >= self.image_count:
+            self.needs_reaping = False
+            self.reaper.state.mark('series', self.uid, nimsutil.reapstate.REAPED, self.exam.uid, self.image_count)
+            self.reaper.log.info('Reaped     %s' % self)
+
+    def get_instance_uids(self):
+        responses = self.reaper.scu.find(scu.ImageQuery(StudyInstanceUID=self.exam.uid, SeriesInstanceUID=self.uid, SOPInstanceUID='', InstanceNumber=''))
+        return [resp.SOPInstanceUID for resp in sorted(responses, key=lambda resp: int(resp.InstanceNumber or 0))]
+
+    def reaped(self, instance_uids, reap_path, reap_count):
+        """Stage the images of a finished move; images that did not arrive are left to the next cycle."""
+        self.moving_uids.difference_update(instance_uids)
+        if reap_count >= len(instance_uids):
+            arrived_uids = instance_uids
+        else:
+            arrived_uids = received_instance_uids(reap_path)
+            self.reaper.log.warning('Incomplete %s, %d of %d reaped' % (self, len(arrived_uids), len(instance_uids)))
+        self.reaped_uids.update(arrived_uids)
+        if os.listdir(reap_path):
+            shutil.move(reap_path, self.reaper.sort_stage)
+        else:
+            os.rmdir(reap_path)
+        self.reaper.state.mark_many('image', arrived_uids, nimsutil.reapstate.REAPED, self.uid)
+
+
+def received_instance_uids(path):
+    """Return the SOP instance UIDs of the readable dicom files in path; remove any other files."""
+    instance_uids = []
+    for filename in os.listdir(path):
+        filepath = os.path.join(path, filename)
+        try:
+            instance_uids.append(dicom.read_file(filepath, stop_before_pixels=True).SOPInstanceUID)
+        except Exception:
+            os.remove(filepath)
+    return instance_uids
 
 
 class ArgumentParser(argparse.ArgumentParser):
@@ -160,6 +384,10 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('aet', help='caller AE title')
         self.add_argument('aec', help='callee AE title')
         self.add_argument('-s', '--sleeptime', type=int, default=30, help='time to sleep before checking for new data')
+        self.add_argument('-S', '--maxsleeptime', type=int, default=240, help='longest time to sleep while the scanner is idle')
+        self.add_argument('-b', '--backend', choices=['dcmtk', 'native'], default='dcmtk', help='query/retrieve with DCMTK processes or in-process DIMSE')
+        self.add_argument('-w', '--window', type=int, default=2, help='number of exams to monitor at a time')
+        self.add_argument('-m', '--movers', nargs='+', metavar='AET:PORT', help='caller AE titles and incoming ports for concurrent moves (default: aet:port)')
         self.add_argument('-n', '--logname', default=os.path.splitext(os.path.basename(__file__))[0], help='process name for log')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='path to log file')
@@ -170,12 +398,16 @@ if __name__ == '__main__':
     host, port = args.dicomserver.split(':')
 
     log = nimsutil.get_logger(args.logname, args.logfile, args.loglevel)
-    scu_ = scu.SCU(host, port, args.aet, args.aec, log=log)
+    scu_ = (scu.NativeSCU if args.backend == 'native' else scu.SCU)(host, port, args.aet, args.aec, log=log)
     reap_stage = nimsutil.make_joined_path(args.stage_path, 'reap')
     sort_stage = nimsutil.make_joined_path(args.stage_path, 'sort')
     datetime_file = os.path.join(os.path.dirname(__file__), '.%s.datetime' % host)
+    state = nimsutil.reapstate.ReapState(os.path.join(os.path.dirname(__file__), '.%s.state' % host), datetime_file)
+    index_file = os.path.join(os.path.dirname(__file__), '.%s.index' % host)
+
+    movers = [(aet, int(port)) for aet, port in (mover.split(':') for mover in args.movers)] if args.movers else None
 
-    reaper = DicomReaper(host, scu_, reap_stage, sort_stage, datetime_file, args.sleeptime, log)
+    reaper = DicomReaper(host, scu_, reap_stage, sort_stage, state, args.sleeptime, log, movers, index_file, args.maxsleeptime, args.window)
 
     def term_handler(signum, stack):
         reaper.halt()
@@ -183,4 +415,6 @@ if __name__ == '__main__':
     signal.signal(signal.SIGTERM, term_handler)
 
     reaper.run()
+    scu_.close()
+    state.close()
     log.warning('Process halted')
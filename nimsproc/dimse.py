@@ -0,0 +1,436 @@
+# @author:  Gunnar Schaefer
+
+"""
+A minimal, in-process DICOM upper layer and DIMSE implementation: C-FIND and C-MOVE as SCU, C-STORE and C-ECHO as SCP.
+
+Only what the reaper needs is implemented: there is no asynchronous operations window, no role selection, and no
+extended negotiation. Identifiers are exchanged in implicit VR little endian. Received instances are written as
+received, in whatever transfer syntax was negotiated, behind a file meta header; they are never decoded.
+
+Example:
+    assoc = Association.request('scanner', 4006, 'NIMS', 'SCANNER', [STUDY_ROOT_FIND, STUDY_ROOT_MOVE])
+    studies = assoc.find(identifier)
+    with StorageSCP(4006, 'NIMS') as scp:
+        scp.begin('/scratch/reap/series')
+        response = assoc.move(identifier, 'NIMS')
+        stored_cnt = scp.end()
+    assoc.release()
+"""
+
+import os
+import re
+import socket
+import select
+import struct
+import logging
+import threading
+import SocketServer
+
+import dicom.datadict
+import dicom.filebase
+import dicom.filereader
+import dicom.filewriter
+
+APPLICATION_CONTEXT = '1.2.840.10008.3.1.1.1'
+IMPLEMENTATION_UID = '2.25.207441394372418218396466296573104127521'
+IMPLEMENTATION_VERSION = 'NIMS_DIMSE'
+IMPLICIT_VR_LE = '1.2.840.10008.1.2'
+EXPLICIT_VR_LE = '1.2.840.10008.1.2.1'
+VERIFICATION = '1.2.840.10008.1.1'
+STUDY_ROOT_FIND = '1.2.840.10008.5.1.4.1.2.2.1'
+STUDY_ROOT_MOVE = '1.2.840.10008.5.1.4.1.2.2.2'
+MAX_PDU_LENGTH = 1 << 16
+
+A_ASSOCIATE_RQ, A_ASSOCIATE_AC, A_ASSOCIATE_RJ, P_DATA_TF, A_RELEASE_RQ, A_RELEASE_RP, A_ABORT = range(1, 8)
+APPLICATION_CONTEXT_ITEM, PRESENTATION_CONTEXT_RQ_ITEM, PRESENTATION_CONTEXT_AC_ITEM = 0x10, 0x20, 0x21
+ABSTRACT_SYNTAX_ITEM, TRANSFER_SYNTAX_ITEM, USER_INFO_ITEM = 0x30, 0x40, 0x50
+MAX_LENGTH_ITEM, IMPLEMENTATION_UID_ITEM, IMPLEMENTATION_VERSION_ITEM = 0x51, 0x52, 0x55
+
+C_STORE_RQ, C_FIND_RQ, C_MOVE_RQ, C_ECHO_RQ = 0x0001, 0x0020, 0x0021, 0x0030
+RESPONSE = 0x8000
+NO_DATASET = 0x0101
+SUCCESS, WARNING, PENDING, PENDING_WARNING, OUT_OF_RESOURCES, CANNOT_UNDERSTAND = 0x0000, 0xb000, 0xff00, 0xff01, 0xa700, 0xc000
+CALLING_AET_NOT_RECOGNIZED = 3      # A-ASSOCIATE-RJ reason, from the service user
+UID_PATTERN = re.compile(r'[0-9.]{1,64}\Z')
+
+COMMAND_ELEMENTS = {    # command set element -> (keyword, VR)
+        0x0002: ('AffectedSOPClassUID', 'UI'),
+        0x0100: ('CommandField', 'US'),
+        0x0110: ('MessageID', 'US'),
+        0x0120: ('MessageIDBeingRespondedTo', 'US'),
+        0x0600: ('MoveDestination', 'AE'),
+        0x0700: ('Priority', 'US'),
+        0x0800: ('CommandDataSetType', 'US'),
+        0x0900: ('Status', 'US'),
+        0x0902: ('ErrorComment', 'LO'),
+        0x1000: ('AffectedSOPInstanceUID', 'UI'),
+        0x1020: ('NumberOfRemainingSuboperations', 'US'),
+        0x1021: ('NumberOfCompletedSuboperations', 'US'),
+        0x1022: ('NumberOfFailedSuboperations', 'US'),
+        0x1023: ('NumberOfWarningSuboperations', 'US'),
+        0x1030: ('MoveOriginatorApplicationEntityTitle', 'AE'),
+        0x1031: ('MoveOriginatorMessageID', 'US'),
+        }
+
+log = logging.getLogger('dimse')
+
+
+class DimseError(Exception):
+    pass
+
+
+def item(type_, value):
+    return struct.pack('>BBH', type_, 0, len(value)) + value
+
+
+def iter_items(data):
+    """Yield the (type, value) of the items in data."""
+    offset = 0
+    while offset + 4 <= len(data):
+        type_, length = struct.unpack_from('>BxH', data, offset)
+        yield type_, data[offset+4:offset+4+length]
+        offset += 4 + length
+
+
+def user_info_item():
+    return item(USER_INFO_ITEM, item(MAX_LENGTH_ITEM, struct.pack('>I', MAX_PDU_LENGTH))
+            + item(IMPLEMENTATION_UID_ITEM, IMPLEMENTATION_UID) + item(IMPLEMENTATION_VERSION_ITEM, IMPLEMENTATION_VERSION))
+
+
+def encode_command(command):
+    """Encode a command set, given as a dict of keywords and values, in implicit VR little endian."""
+    elements = ''
+    for element, (keyword, vr) in sorted(COMMAND_ELEMENTS.iteritems()):
+        if keyword not in command:
+            continue
+        if vr == 'US':
+            value = struct.pack('<H', command[keyword])
+        else:
+            value = str(command[keyword])
+            value += ('\0' if vr == 'UI' else ' ') * (len(value) % 2)
+        elements += struct.pack('<HHI', 0, element, len(value)) + value
+    return struct.pack('<HHII', 0, 0, 4, len(elements)) + elements
+
+
+def decode_command(data):
+    command = {}
+    offset = 0
+    while offset + 8 <= len(data):
+        element, length = struct.unpack_from('<2xHI', data, offset)
+        value = data[offset+8:offset+8+length]
+        offset += 8 + length
+        if element in COMMAND_ELEMENTS:
+            keyword, vr = COMMAND_ELEMENTS[element]
+            command[keyword] = struct.unpack('<H', value)[0] if vr == 'US' else value.rstrip('\0 ')
+    return command
+
+
+def encode_dataset(dataset):
+    fp = dicom.filebase.DicomBytesIO()
+    fp.is_little_endian = True
+    fp.is_implicit_VR = True
+    dicom.filewriter.write_dataset(fp, dataset)
+    return fp.parent.getvalue()
+
+
+def decode_dataset(data):
+    return dicom.filereader.read_dataset(dicom.filebase.DicomBytesIO(data), True, True, len(data))
+
+
+def file_meta(sop_class_uid, sop_instance_uid, transfer_syntax, source_aet):
+    """Return the preamble and the file meta information of a dicom file, in explicit VR little endian."""
+    elements = struct.pack('<HH2sxxI', 2, 1, 'OB', 2) + '\0\1'
+    for element, vr, value in (
+            (0x0002, 'UI', sop_class_uid), (0x0003, 'UI', sop_instance_uid), (0x0010, 'UI', transfer_syntax),
+            (0x0012, 'UI', IMPLEMENTATION_UID), (0x0013, 'SH', IMPLEMENTATION_VERSION), (0x0016, 'AE', source_aet)):
+        value += ('\0' if vr == 'UI' else ' ') * (len(value) % 2)
+        elements += struct.pack('<HH2sH', 2, element, vr, len(value)) + value
+    return '\0' * 128 + 'DICM' + struct.pack('<HH2sHI', 2, 0, 'UL', 4, len(elements)) + elements
+
+
+class Association(object):
+
+    """An association between two application entities, on a connected socket."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.peer_max_pdu = MAX_PDU_LENGTH
+        self.contexts = {}      # accepted presentation context id -> (abstract syntax, transfer syntax)
+        self.calling_aet = self.called_aet = None
+        self.message_id = 0
+        self.sent_cnt = 0       # messages sent completely
+
+    @classmethod
+    def request(cls, host, port, calling_aet, called_aet, abstract_syntaxes, timeout=None, dimse_timeout=None):
+        """
+        Request an association, proposing implicit VR little endian for each abstract syntax.
+
+        timeout applies to connecting and negotiating the association, dimse_timeout to every wait for a message
+        thereafter; peers need not send pending responses during a C-MOVE, so the latter is best long, or None.
+        """
+        assoc = cls(socket.create_connection((host, int(port)), timeout))
+        assoc.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        assoc.calling_aet, assoc.called_aet = calling_aet, called_aet
+        proposed = dict((2*i + 1, syntax) for i, syntax in enumerate(abstract_syntaxes))
+        items = item(APPLICATION_CONTEXT_ITEM, APPLICATION_CONTEXT)
+        for pcid, syntax in sorted(proposed.iteritems()):
+            items += item(PRESENTATION_CONTEXT_RQ_ITEM, struct.pack('>B3x', pcid)
+                    + item(ABSTRACT_SYNTAX_ITEM, syntax) + item(TRANSFER_SYNTAX_ITEM, IMPLICIT_VR_LE))
+        assoc.send_pdu(A_ASSOCIATE_RQ, struct.pack('>H2x16s16s32x', 1, called_aet.ljust(16), calling_aet.ljust(16)) + items + user_info_item())
+        pdu_type, data = assoc.recv_pdu()
+        if pdu_type != A_ASSOCIATE_AC:
+            assoc.close()
+            raise DimseError('association with %s@%s:%s rejected' % (called_aet, host, port))
+        for type_, value in iter_items(data[68:]):
+            if type_ == PRESENTATION_CONTEXT_AC_ITEM and ord(value[2]) == 0:
+                assoc.contexts[ord(value[0])] = (proposed[ord(value[0])], dict(iter_items(value[4:]))[TRANSFER_SYNTAX_ITEM].rstrip('\0'))
+            elif type_ == USER_INFO_ITEM:
+                assoc.set_peer_max_pdu(value)
+        assoc.sock.settimeout(dimse_timeout)
+        return assoc
+
+    def accept(self, data):
+        """Accept a requested association, and every presentation context in it (see StorageHandler)."""
+        self.called_aet, self.calling_aet = data[4:20].strip(), data[20:36].strip()
+        items = item(APPLICATION_CONTEXT_ITEM, APPLICATION_CONTEXT)
+        for type_, value in iter_items(data[68:]):
+            if type_ == PRESENTATION_CONTEXT_RQ_ITEM:
+                pcid, sub_items = ord(value[0]), list(iter_items(value[4:]))
+                abstract_syntax = [v.rstrip('\0') for t, v in sub_items if t == ABSTRACT_SYNTAX_ITEM][0]
+                transfer_syntaxes = [v.rstrip('\0') for t, v in sub_items if t == TRANSFER_SYNTAX_ITEM]
+                preferred = [ts for ts in (EXPLICIT_VR_LE, IMPLICIT_VR_LE) if ts in transfer_syntaxes]
+                self.contexts[pcid] = (abstract_syntax, (preferred or transfer_syntaxes)[0])
+                items += item(PRESENTATION_CONTEXT_AC_ITEM, struct.pack('>B3x', pcid) + item(TRANSFER_SYNTAX_ITEM, self.contexts[pcid][1]))
+            elif type_ == USER_INFO_ITEM:
+                self.set_peer_max_pdu(value)
+        self.send_pdu(A_ASSOCIATE_AC, data[:68] + items + user_info_item())
+
+    def reject(self, reason):
+        """Reject a requested association permanently."""
+        self.send_pdu(A_ASSOCIATE_RJ, struct.pack('>xBBB', 1, 1, reason))
+        self.close()
+
+    def set_peer_max_pdu(self, user_info):
+        max_length = dict(iter_items(user_info)).get(MAX_LENGTH_ITEM)
+        if max_length:
+            self.peer_max_pdu = struct.unpack('>I', max_length)[0] or MAX_PDU_LENGTH   # 0 means unlimited
+
+    def context_id(self, abstract_syntax):
+        for pcid, (syntax, transfer_syntax) in self.contexts.iteritems():
+            if syntax == abstract_syntax:
+                return pcid
+        raise DimseError('%s not accepted by %s' % (abstract_syntax, self.called_aet))
+
+    def next_message_id(self):
+        self.message_id = self.message_id % 0xffff + 1
+        return self.message_id
+
+    def send_pdu(self, pdu_type, data):
+        self.sock.sendall(struct.pack('>BxI', pdu_type, len(data)) + data)
+
+    def recv_pdu(self):
+        pdu_type, length = struct.unpack('>BxI', self.recv(6))
+        return pdu_type, self.recv(length)
+
+    def recv(self, size):
+        chunks = []
+        while size:
+            chunk = self.sock.recv(min(size, MAX_PDU_LENGTH))
+            if not chunk:
+                raise DimseError('connection closed by peer')
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    def send_message(self, pcid, command, dataset=None):
+        """Send a command, and its dataset, if any, fragmented to the peer's maximum PDU length."""
+        command['CommandDataSetType'] = NO_DATASET if dataset is None else 0
+        max_fragment = self.peer_max_pdu - 6
+        for control, data in ((0x01, encode_command(command)), (0x00, dataset)):
+            if data is None:
+                continue
+            for start in range(0, max(len(data), 1), max_fragment):
+                fragment = data[start:start+max_fragment]
+                last = 0x02 if start + max_fragment >= len(data) else 0
+                self.send_pdu(P_DATA_TF, struct.pack('>IBB', len(fragment) + 2, pcid, control | last) + fragment)
+        self.sent_cnt += 1
+
+    def recv_message(self):
+        """Return the next (presentation context id, command, dataset), or None if the peer released the association."""
+        command, fragments = None, {0x01: [], 0x00: []}
+        while True:
+            pdu_type, data = self.recv_pdu()
+            if pdu_type == A_RELEASE_RQ:
+                self.send_pdu(A_RELEASE_RP, '\0' * 4)
+                self.close()
+                return None
+            elif pdu_type != P_DATA_TF:
+                self.close()
+                raise DimseError('association aborted' if pdu_type == A_ABORT else 'unexpected PDU type %d' % pdu_type)
+            offset = 0
+            while offset < len(data):
+                length, pcid, control = struct.unpack_from('>IBB', data, offset)
+                fragments[control & 0x01].append(data[offset+6:offset+4+length])
+                offset += 4 + length
+                if control & 0x02 and control & 0x01:
+                    command = decode_command(''.join(fragments[0x01]))
+                    if command.get('CommandDataSetType') == NO_DATASET:
+                        return pcid, command, None
+                elif control & 0x02 and command is not None:
+                    return pcid, command, ''.join(fragments[0x00])
+
+    def find(self, identifier, sop_class=STUDY_ROOT_FIND):
+        """Return the identifiers (pydicom datasets) matching a C-FIND identifier."""
+        self.send_message(self.context_id(sop_class), dict(CommandField=C_FIND_RQ, AffectedSOPClassUID=sop_class,
+                MessageID=self.next_message_id(), Priority=0), encode_dataset(identifier))
+        matches = []
+        while True:
+            pcid, response, data = self.recv_response()
+            if response['Status'] in (PENDING, PENDING_WARNING):
+                matches.append(decode_dataset(data))
+            elif response['Status'] == SUCCESS:
+                return matches
+            else:
+                raise DimseError('C-FIND failed with status 0x%04x' % response['Status'])
+
+    def move(self, identifier, move_destination, sop_class=STUDY_ROOT_MOVE):
+        """Retrieve the instances matching a C-MOVE identifier to move_destination; return the final response."""
+        self.send_message(self.context_id(sop_class), dict(CommandField=C_MOVE_RQ, AffectedSOPClassUID=sop_class,
+                MessageID=self.next_message_id(), Priority=0, MoveDestination=move_destination), encode_dataset(identifier))
+        while True:
+            pcid, response, data = self.recv_response()
+            if response['Status'] not in (PENDING, PENDING_WARNING):
+                return response
+
+    def recv_response(self):
+        message = self.recv_message()
+        if message is None:
+            raise DimseError('association released by %s' % self.called_aet)
+        return message
+
+    def is_stale(self):
+        """Return True if an idle association has been released, aborted or closed by the peer."""
+        try:
+            return bool(select.select([self.sock], [], [], 0)[0])   # an idle peer has nothing to say
+        except (select.error, socket.error, ValueError):
+            return True
+
+    def release(self):
+        try:
+            self.send_pdu(A_RELEASE_RQ, '\0' * 4)
+            self.recv_pdu()
+        except (socket.error, DimseError, struct.error):
+            pass
+        self.close()
+
+    def abort(self):
+        try:
+            self.send_pdu(A_ABORT, '\0' * 4)
+        except socket.error:
+            pass
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+
+class StorageHandler(SocketServer.BaseRequestHandler):
+
+    """Serve one association with a storage SCP; every presentation context is accepted."""
+
+    def handle(self):
+        assoc = Association(self.request)
+        try:
+            pdu_type, data = assoc.recv_pdu()
+            if pdu_type != A_ASSOCIATE_RQ:
+                return assoc.abort()
+            calling_aet = data[20:36].strip()
+            if self.server.peer_aet and calling_aet != self.server.peer_aet:
+                log.warning('Rejecting association from %s@%s' % (calling_aet, self.client_address[0]))
+                return assoc.reject(CALLING_AET_NOT_RECOGNIZED)
+            assoc.accept(data)
+            while True:
+                message = assoc.recv_message()
+                if message is None:
+                    return
+                pcid, command, data = message
+                response = dict(CommandField=command['CommandField'] | RESPONSE, MessageIDBeingRespondedTo=command['MessageID'],
+                        AffectedSOPClassUID=command.get('AffectedSOPClassUID', VERIFICATION), Status=SUCCESS)
+                if command['CommandField'] == C_STORE_RQ:
+                    response['AffectedSOPInstanceUID'] = command['AffectedSOPInstanceUID']
+                    response['Status'] = self.server.store(assoc.contexts[pcid][1], assoc.calling_aet, command, data)
+                elif command['CommandField'] != C_ECHO_RQ:
+                    return assoc.abort()
+                assoc.send_message(pcid, response)
+        except (socket.error, DimseError, struct.error) as ex:
+            log.debug('%s: %s' % (self.client_address[0], ex))
+            assoc.close()
+
+
+class StorageSCP(SocketServer.ThreadingTCPServer):
+
+    """
+    A storage SCP, serving on a thread of its own, that writes the instances it receives into its destination.
+
+    begin() and end() bracket the retrieval into one destination; instances received outside a retrieval are refused.
+    If peer_aet is given, associations from any other calling AE title are rejected. Instances are stored by their SOP
+    instance UID, so instances whose UID is not a plain UID are refused.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, aet, host='', peer_aet=None):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, int(port)), StorageHandler)
+        self.aet = aet
+        self.peer_aet = peer_aet
+        self.lock = threading.Lock()
+        self.destination = None
+        self.stored_cnt = 0
+        self.thread = threading.Thread(target=self.serve_forever, name='StorageSCP-%s' % port)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def begin(self, destination):
+        with self.lock:
+            self.destination, self.stored_cnt = destination, 0
+
+    def end(self):
+        """End the retrieval into the current destination; return the number of instances stored."""
+        with self.lock:
+            self.destination = None
+            return self.stored_cnt
+
+    def store(self, transfer_syntax, calling_aet, command, data):
+        """Write a received instance; return the C-STORE status."""
+        with self.lock:
+            destination = self.destination
+        if not destination:
+            log.warning('Refusing %s from %s: no retrieval in progress' % (command['AffectedSOPInstanceUID'], calling_aet))
+            return OUT_OF_RESOURCES
+        if not UID_PATTERN.match(command['AffectedSOPInstanceUID']):
+            log.warning('Refusing %r from %s: not a valid SOP instance UID' % (command['AffectedSOPInstanceUID'], calling_aet))
+            return CANNOT_UNDERSTAND
+        filename = os.path.join(destination, command['AffectedSOPInstanceUID'] + '.dcm')
+        try:
+            with open(filename, 'wb') as fd:
+                fd.write(file_meta(command['AffectedSOPClassUID'], command['AffectedSOPInstanceUID'], transfer_syntax, calling_aet))
+                fd.write(data)
+        except IOError as ex:
+            log.warning('Could not store %s: %s' % (filename, ex))
+            if os.path.exists(filename):
+                os.remove(filename)
+            return OUT_OF_RESOURCES
+        with self.lock:
+            self.stored_cnt += 1
+        return SUCCESS
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
@@ -3,7 +3,6 @@
 # @author: Gunnar Schaefer
 
 import os
-import glob
 import time
 import shutil
 import signal
@@ -15,18 +14,20 @@ import nimsutil
 
 class FileReaper(object):
 
-    def __init__(self, id_, data_glob, reap_stage, sort_stage, datetime_file, sleep_time, log):
+    """Reap files as they are completed; files are recorded in the reap state, and not reaped again unless changed."""
+
+    def __init__(self, id_, data_glob, reap_stage, sort_stage, state, sleep_time, log, poll=False):
         super(FileReaper, self).__init__()
         self.id_ = id_
         self.data_glob = data_glob
         self.reap_stage = reap_stage
         self.sort_stage = sort_stage
-        self.datetime_file = datetime_file
+        self.state = state
         self.sleep_time = sleep_time
         self.log = log
+        self.poll = poll
 
-        self.current_file_timestamp = nimsutil.get_reference_datetime(self.datetime_file)
-        self.monitored_files = {}
+        self.current_file_timestamp = self.state.get_reference_datetime(datetime.datetime.now())
         self.alive = True
 
         # stage any files left behind from a previous run
@@ -38,37 +39,28 @@ class FileReaper(object):
         self.alive = False
 
     def run(self):
+        watcher = nimsutil.watcher.watch_glob(self.data_glob, self.sleep_time, poll=self.poll)
+        failed = []
         while self.alive:
-            reap_files = [ReapFile(f, self.id_, self.reap_stage, self.sort_stage, self.log) for f in glob.glob(data_glob)]
-            reap_files = sorted(filter(lambda f: f.mod_time >= self.current_file_timestamp, reap_files), key=lambda f: f.mod_time)
-
-            if not reap_files:
-                self.log.warning('No matching files found (or error while checking for files)')
-                time.sleep(self.sleep_time)
-                continue
-
-            for rf in reap_files:
-                if rf.path in self.monitored_files:
-                    mf = self.monitored_files[rf.path]
-                    if rf.size == mf.size and mf.needs_reaping:
-                        success = rf.reap()
-                        if success:
-                            nimsutil.update_reference_datetime(self.datetime_file, rf.mod_time)
-                            self.current_file_timestamp = rf.mod_time
-                    elif mf.needs_reaping:
-                        self.log.info('Monitoring %s' % mf)
-                    elif rf.size == mf.size:
-                        rf.needs_reaping = False
+            complete = failed + [os.path.join(watcher.path, name) for name in watcher.wait(self.sleep_time)]
+            reap_files = [ReapFile(f, self.id_, self.reap_stage, self.sort_stage, self.log) for f in complete if os.path.isfile(f)]
+            reap_files = [f for f in reap_files if f.mod_time >= self.current_file_timestamp and not self.state.is_reaped('file', f.path, f.size, f.mtime)]
+            failed = []
+            for rf in sorted(reap_files, key=lambda f: f.mod_time):
+                self.log.info('Discovered %s' % rf)
+                if rf.reap():
+                    self.state.mark('file', rf.path, nimsutil.reapstate.REAPED, size=rf.size, mtime=rf.mtime)
+                    self.state.set_reference_datetime(rf.mod_time)
+                    self.current_file_timestamp = rf.mod_time
                 else:
-                    self.log.info('Discovered %s' % rf)
-
-            self.monitored_files = dict(zip([rf.path for rf in reap_files], reap_files))
-            time.sleep(self.sleep_time)
+                    failed.append(rf.path)
+            self.state.forget_expired('file', self.current_file_timestamp)
+        watcher.close()
 
 
 class ReapFile(object):
 
-    def __init__(self, path, repaer_id, reap_stage, sort_stage, log):
+    def __init__(self, path, reaper_id, reap_stage, sort_stage, log):
         self.path = path
         self.reaper_id = reaper_id
         self.reap_stage = reap_stage
@@ -76,7 +68,8 @@ class ReapFile(object):
         self.log = log
 
         self.size = os.path.getsize(path)
-        self.mod_time = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+        self.mtime = os.path.getmtime(path)
+        self.mod_time = datetime.datetime.fromtimestamp(self.mtime)
         self.needs_reaping = True
 
     def __repr__(self):
@@ -97,7 +90,7 @@ class ReapFile(object):
             success = False
             self.log.warning('Error while reaping %s' % self)
         else:
-            shutil.move(reap_path, sort_stage)
+            shutil.move(reap_path, self.sort_stage)
             self.needs_reaping = False
             success = True
             self.log.info('Reaped     %s' % self)
@@ -111,7 +104,8 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('stage_path', help='path to staging area')
         self.add_argument('data_path', help='path to data source')
         self.add_argument('-g', '--fileglob', default='*', help='glob for files to reap (default: "*")')
-        self.add_argument('-s', '--sleeptime', type=int, default=30, help='time to sleep before checking for new data')
+        self.add_argument('-s', '--sleeptime', type=int, default=30, help='time to wait for new data before checking again')
+        self.add_argument('-p', '--poll', action='store_true', help='poll for new files rather than rely on inotify (network filesystems are always polled)')
         self.add_argument('-n', '--logname', default=os.path.splitext(os.path.basename(__file__))[0], help='process name for log')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='path to log file')
@@ -126,8 +120,9 @@ if __name__ == '__main__':
     reap_stage = nimsutil.make_joined_path(args.stage_path, 'reap')
     sort_stage = nimsutil.make_joined_path(args.stage_path, 'sort')
     datetime_file = os.path.join(os.path.dirname(__file__), '.%s.datetime' % reaper_id)
+    state = nimsutil.reapstate.ReapState(os.path.join(os.path.dirname(__file__), '.%s.state' % reaper_id), datetime_file)
 
-    reaper = FileReaper(reaper_id, data_glob, reap_stage, sort_stage, datetime_file, args.sleeptime, log)
+    reaper = FileReaper(reaper_id, data_glob, reap_stage, sort_stage, state, args.sleeptime, log, args.poll)
 
     def term_handler(signum, stack):
         reaper.halt()
@@ -135,4 +130,5 @@ if __name__ == '__main__':
     signal.signal(signal.SIGTERM, term_handler)
 
     reaper.run()
+    state.close()
     log.warning('Process halted')
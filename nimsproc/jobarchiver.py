@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+#
+# @author:  Gunnar Schaefer
+
+import os
+import argparse
+import datetime
+
+import sqlalchemy
+
+import nimsutil
+from nimsgears.model import *
+
+
+class ArgumentParser(argparse.ArgumentParser):
+
+    def __init__(self):
+        super(ArgumentParser, self).__init__()
+        self.description = """Move done jobs older than the given number of days from the job table into the job history."""
+        self.add_argument('db_uri', help='database URI')
+        self.add_argument('-d', '--days', type=int, default=30, help='age in days of the jobs to archive')
+        self.add_argument('-b', '--batchsize', type=int, default=10000, help='number of jobs to move per transaction')
+        self.add_argument('-n', '--logname', default=os.path.splitext(os.path.basename(__file__))[0], help='process name for log')
+        self.add_argument('-f', '--logfile', help='path to log file')
+        self.add_argument('-l', '--loglevel', default='info', help='path to log file')
+
+
+if __name__ == '__main__':
+    args = ArgumentParser().parse_args()
+
+    log = nimsutil.get_logger(args.logname, args.logfile, args.loglevel)
+    init_model(sqlalchemy.create_engine(args.db_uri))
+
+    archived_cnt = Job.archive(datetime.datetime.now() - datetime.timedelta(days=args.days), args.batchsize)
+    log.info('Archived %d jobs older than %d days' % (archived_cnt, args.days))
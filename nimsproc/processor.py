@@ -10,6 +10,7 @@ import shutil
 import signal
 import argparse
 import threading
+import multiprocessing
 
 import sqlalchemy
 import transaction
@@ -19,58 +20,116 @@ from nimsgears.model import *
 
 DS_TYPES = {
     'nifti': u'NIfTI (raw)',
+    'nifti_uncompressed': u'NIfTI (raw, uncompressed)',
     'bitmap': u'Bitmap'
 }
 
 
 class Processor(object):
 
-    def __init__(self, db_uri, nims_path, physio_path, task, log, max_jobs, reset, sleeptime):
+    def __init__(self, db_uri, nims_path, physio_path, task, log, max_jobs, reset, sleeptime, num_workers=1, streaming=False, incremental=False, compression='gzip', backend='thread'):
         super(Processor, self).__init__()
+        self.db_uri = db_uri
         self.nims_path = nims_path
         self.physio_path = physio_path
         self.task = unicode(task) if task else None
         self.log = log
         self.max_jobs = max_jobs
         self.sleeptime = sleeptime
+        self.num_workers = num_workers
+        self.streaming = streaming
+        self.incremental = incremental
+        self.compression = compression
+        self.backend = backend
+        self.workers = []
+        self.pipelines = []
+        self.done_queue = multiprocessing.Queue()
 
         self.alive = True
-        init_model(sqlalchemy.create_engine(db_uri))
+        self.engine = sqlalchemy.create_engine(db_uri)
+        init_model(self.engine)
+        self.listener = NotificationListener(self.engine, JOB_CHANNEL)
         if reset: self.reset_all()
 
     def halt(self):
         self.alive = False
 
     def run(self):
+        if self.backend == 'process':
+            for i in range(self.max_jobs):
+                self.start_worker()
         while self.alive:
-            if threading.active_count()-1 < self.max_jobs:
-                Job_A = sqlalchemy.orm.aliased(Job)
-                subquery = sqlalchemy.exists().where(Job_A.data_container_id == DataContainer.id)
-                #subquery = subquery.where((Job_A.id < Job.id) & ((Job_A.status == u'new') | (Job_A.status == u'active')))
-                subquery = subquery.where((Job_A.id < Job.id) & (Job_A.status != u'done'))
-                query = Job.query.join(DataContainer).filter(Job.status==u'new')
-                if self.task:
-                    query = query.filter(Job.task==self.task)
-                job = query.filter(~subquery).order_by(Job.id).with_lockmode('update').first()
-
-                if job:
-                    if isinstance(job.data_container, Epoch):
-                        ds = job.data_container.primary_dataset
-                        if isinstance(ds, DicomData):
-                            pipeline_class = DicomPipeline
-                        elif isinstance(ds, GEPFile):
-                            pipeline_class = PFilePipeline
-
-                    pipeline = pipeline_class(job, self.nims_path, self.physio_path, self.log)
-                    job.status = u'active'      # make sure that this job is not picked up again in the next iteration
+            if self.backend == 'process':
+                self.check_workers()
+            idle_slots = self.idle_slots()
+            if idle_slots > 0:
+                jobs = Job.claim(idle_slots, self.task)     # claimed jobs are active, so they are not picked up again
+                if jobs and self.backend == 'process':
+                    job_ids = [job.id for job in jobs]
                     transaction.commit()
-                    pipeline.start()
+                    for job_id, worker in zip(job_ids, [w for w in self.workers if w.job_id is None]):
+                        worker.assign(job_id)
+                elif jobs:
+                    pipelines = [self.pipeline(job) for job in jobs]
+                    transaction.commit()
+                    for pipeline in pipelines:
+                        pipeline.start()
+                    self.pipelines += pipelines
                 else:
                     self.log.debug('Waiting for work...')
-                    time.sleep(self.sleeptime)
+                    self.listener.wait(self.sleeptime)
             else:
                 self.log.debug('Waiting for jobs to finish...')
-                time.sleep(self.sleeptime)
+                self.listener.wait(self.sleeptime)
+        for worker in self.workers:
+            worker.assign(None)         # workers finish their current job, then exit
+        for worker in self.workers:
+            worker.join()
+
+    def pipeline(self, job):
+        """Return the pipeline for a job."""
+        if isinstance(job.data_container, Epoch):
+            ds = job.data_container.primary_dataset
+            if isinstance(ds, DicomData):
+                pipeline_class = DicomPipeline
+            elif isinstance(ds, GEPFile):
+                pipeline_class = PFilePipeline
+        return pipeline_class(job, self.nims_path, self.physio_path, self.log, self.num_workers, self.streaming, self.incremental, self.compression)
+
+    def idle_slots(self):
+        """Return the number of jobs to claim; pipelines may run threads of their own, so only pipelines count."""
+        if self.backend == 'process':
+            return len([w for w in self.workers if w.job_id is None])
+        else:
+            self.pipelines = [p for p in self.pipelines if p.is_alive()]
+            return max(0, self.max_jobs - len(self.pipelines))
+
+    def start_worker(self):
+        """Start a worker process; it must not inherit any open database connections."""
+        transaction.commit()
+        DBSession.remove()
+        self.engine.dispose()
+        worker = WorkerProcess(self)
+        worker.start()
+        self.workers.append(worker)
+
+    def check_workers(self):
+        """Take note of finished jobs, and mark the jobs of crashed workers as failed and replace those workers."""
+        while not self.done_queue.empty():
+            job_id = self.done_queue.get()
+            for worker in self.workers:
+                if worker.job_id == job_id:
+                    worker.job_id = None
+        for worker in [w for w in self.workers if not w.is_alive()]:
+            self.log.warning('Worker process %d died with exit code %s' % (worker.pid, worker.exitcode))
+            job = worker.job_id and Job.get(worker.job_id)
+            if job and job.status == u'active':
+                job.status = u'failed'
+                job.activity = u'failed: worker process died with exit code %s' % worker.exitcode
+                self.log.info(u'%d %s %s' % (job.id, job, job.activity))
+            transaction.commit()
+            self.workers.remove(worker)
+            self.start_worker()
 
     def reset_all(self):
         """Reset all active jobs to new."""
@@ -89,16 +148,48 @@ class Processor(object):
         transaction.commit()
 
 
+class WorkerProcess(multiprocessing.Process):
+
+    """
+    Process that runs one job at a time, as assigned by the Processor.
+
+    Each worker has its own database engine and session. Job state transitions are made in the database by the
+    pipeline, as with the thread backend; the Processor is told of finished jobs through its done_queue.
+    """
+
+    def __init__(self, processor):
+        super(WorkerProcess, self).__init__()
+        self.processor = processor
+        self.job_queue = multiprocessing.Queue()
+        self.job_id = None              # the job assigned to this worker, as seen from the Processor
+
+    def assign(self, job_id):
+        self.job_id = job_id
+        self.job_queue.put(job_id)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)   # the Processor shuts down its workers
+        init_model(sqlalchemy.create_engine(self.processor.db_uri))
+        for job_id in iter(self.job_queue.get, None):
+            self.processor.pipeline(Job.get(job_id)).run()
+            DBSession.remove()
+            self.processor.done_queue.put(job_id)
+
+
 class Pipeline(threading.Thread):
 
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, job, nims_path, physio_path, log):
+    def __init__(self, job, nims_path, physio_path, log, num_workers=1, streaming=False, incremental=False, compression='gzip'):
         super(Pipeline, self).__init__()
         self.job = job
         self.nims_path = nims_path
         self.physio_path = physio_path
         self.log = log
+        self.num_workers = num_workers
+        self.streaming = streaming
+        self.incremental = incremental
+        self.compression = compression
 
     def run(self):
         DBSession.add(self.job)
@@ -150,6 +241,12 @@ class Pipeline(threading.Thread):
     def process(self):
         pass
 
+    def ds_type(self, conv_res):
+        """Return the datatype of a conversion result, as written with this pipeline's compression."""
+        if conv_res == 'nifti' and nimsutil.niftiutil.parse_compression(self.compression)[0] == 'none':
+            conv_res = 'nifti_uncompressed'
+        return DS_TYPES[conv_res]
+
 
 class DicomPipeline(Pipeline):
 
@@ -162,14 +259,29 @@ class DicomPipeline(Pipeline):
         ds = self.job.data_container.primary_dataset
         with nimsutil.TempDirectory() as outputdir:
             outbase = os.path.join(outputdir, ds.container.name)
-            dcm_series = nimsutil.dicomutil.DicomSeries(os.path.join(self.nims_path, ds.relpath), self.log)
-            conv_res, conv_file = dcm_series.convert(outbase)
+            dcm_series = nimsutil.dicomutil.DicomSeries(os.path.join(self.nims_path, ds.relpath), self.log, self.num_workers)
+            if self.incremental and ds.file_cnt_tgt and (ds.file_cnt_act or 0) < ds.file_cnt_tgt:
+                # still acquiring: convert as the remaining files arrive, then do the scheduler's bookkeeping
+                # for the complete series, so that it is not converted a second time once it has cooled
+                self.job.activity = u'converting incrementally (%d of %d files)' % (ds.file_cnt_act or 0, ds.file_cnt_tgt)
+                self.log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
+                file_cnt_tgt = ds.file_cnt_tgt
+                transaction.commit()    # show the activity while the conversion blocks for the rest of the acquisition
+                conv_res, conv_file = dcm_series.convert(outbase, self.streaming, file_cnt_tgt, self.compression)
+                DBSession.add(self.job)
+                ds = self.job.data_container.primary_dataset
+                ds.update_file_cnt_and_digest(self.nims_path)    # with the scheduler's hash, as recorded in the manifest
+                self.job.data_container.needs_finding = True
+                transaction.commit()
+                DBSession.add(self.job)
+            else:
+                conv_res, conv_file = dcm_series.convert(outbase, self.streaming, compression=self.compression)
 
             if conv_res:
                 outputdir_list = os.listdir(outputdir)
                 self.job.activity = u'generated %s' % (', '.join([f for f in outputdir_list]))
                 self.log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
-                conv_ds = Dataset.at_path(self.nims_path, None, DS_TYPES[conv_res])
+                conv_ds = Dataset.at_path(self.nims_path, None, self.ds_type(conv_res))
                 DBSession.add(self.job)
                 DBSession.add(self.job.data_container)
 
@@ -212,13 +324,13 @@ class PFilePipeline(Pipeline):
         with nimsutil.TempDirectory() as outputdir:
             if u'sprt' in ds.psd:
                 pfilepath = os.path.join(self.nims_path, ds.relpath, os.listdir(os.path.join(self.nims_path, ds.relpath))[0])
-                pf = nimsutil.pfile.PFile(pfilepath, self.log).to_nii(os.path.join(outputdir, ds.container.name))
+                pf = nimsutil.pfile.PFile(pfilepath, self.log).to_nii(os.path.join(outputdir, ds.container.name), compression=self.compression)
 
             outputdir_list = os.listdir(outputdir)
             if outputdir_list:
                 self.job.activity = u'generated %s' % (', '.join([f for f in outputdir_list]))
                 self.log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
-                dataset = Dataset.at_path(self.nims_path, None, u'NIfTI (raw)')
+                dataset = Dataset.at_path(self.nims_path, None, self.ds_type('nifti'))
                 DBSession.add(self.job)
                 DBSession.add(self.job.data_container)
                 dataset.file_cnt_act = 0
@@ -241,7 +353,12 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('nims_path', metavar='DATA_PATH', help='data location')
         self.add_argument('physio_path', metavar='PHYSIO_PATH', help='path to physio data')
         self.add_argument('-t', '--task', help='find|proc  (default is all)')
-        self.add_argument('-j', '--jobs', type=int, default=1, help='maximum number of concurrent threads')
+        self.add_argument('-j', '--jobs', type=int, default=1, help='maximum number of concurrent jobs')
+        self.add_argument('-b', '--backend', choices=['thread', 'process'], default='thread', help='run each job in a thread, or in one of JOBS worker processes')
+        self.add_argument('-w', '--workers', type=int, default=1, help='number of processes per job for decoding image data')
+        self.add_argument('-m', '--streaming', action='store_true', help='convert volume by volume to bound memory use')
+        self.add_argument('-i', '--incremental', action='store_true', help='convert dicom series while they are still arriving')
+        self.add_argument('-z', '--compression', type=nimsutil.niftiutil.compression_spec, default='gzip', help='nifti compression: none, gzip[:LEVEL] or pgzip[:LEVEL] (multi-threaded)')
         self.add_argument('-r', '--reset', action='store_true', help='reset currently active (crashed) jobs')
         self.add_argument('-s', '--sleeptime', type=int, default=10, help='time to sleep between db queries')
         self.add_argument('-n', '--logname', default=os.path.splitext(os.path.basename(__file__))[0], help='process name for log')
@@ -258,7 +375,7 @@ if __name__ == '__main__':
     import datetime # used in nimsutil
     datetime.datetime.strptime('0', '%S')
 
-    processor = Processor(args.db_uri, args.nims_path, args.physio_path, args.task, log, args.jobs, args.reset, args.sleeptime)
+    processor = Processor(args.db_uri, args.nims_path, args.physio_path, args.task, log, args.jobs, args.reset, args.sleeptime, args.workers, args.streaming, args.incremental, args.compression, args.backend)
 
     def term_handler(signum, stack):
         processor.halt()
@@ -37,16 +37,21 @@ class Restager(object):
             self.alive = False
             self.log.error('Cannot set up remote staging area')
 
+        watcher = nimsutil.watcher.watch(self.source_stage, self.sleep_time, atomic=True)
+        pending = []
         while self.alive:
-            stage_contents = [os.path.join(self.source_stage, sc) for sc in os.listdir(self.source_stage)]
-            if stage_contents:
-                item_path = min(stage_contents, key=os.path.getmtime)
+            pending += [os.path.join(self.source_stage, item) for item in watcher.wait(0 if pending else self.sleep_time)]
+            if pending:
+                item_path = pending.pop(0)
+                if not os.path.exists(item_path):
+                    continue
                 try:
                     self.log.info('Restaging %s' % os.path.basename(item_path))
                     subprocess.check_call(shlex.split(self.scp_cmd % item_path))
                     subprocess.check_call(shlex.split(self.move_cmd % os.path.basename(item_path)))
                 except subprocess.CalledProcessError:
                     self.log.info('Failed to restage %s' % os.path.basename(item_path))
+                    pending.append(item_path)
                 else:
                     if os.path.isdir(item_path):
                         shutil.rmtree(item_path)
@@ -55,7 +60,7 @@ class Restager(object):
                     self.log.info('Restaged  %s' % os.path.basename(item_path))
             else:
                 self.log.debug('Waiting for work...')
-                time.sleep(self.sleep_time)
+        watcher.close()
 
 
 class ArgumentParser(argparse.ArgumentParser):
@@ -64,7 +69,7 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('source_stage', help='path to source staging area')
         self.add_argument('data_host', help='username@hostname of data destination')
         self.add_argument('remote_stage', help='path to destination staging area')
-        self.add_argument('-s', '--sleeptime', type=int, default=30, help='time to sleep before checking for new data')
+        self.add_argument('-s', '--sleeptime', type=int, default=30, help='time to wait for new data before checking again')
         self.add_argument('-n', '--logname', default=os.path.splitext(os.path.basename(__file__))[0], help='process name for log')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='path to log file')
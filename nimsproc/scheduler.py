@@ -9,6 +9,7 @@ import shutil
 import signal
 import argparse
 import datetime
+import multiprocessing.pool
 
 import sqlalchemy
 import transaction
@@ -19,43 +20,92 @@ from nimsgears.model import *
 
 class Scheduler(object):
 
-    def __init__(self, db_uri, nims_path, log, sleeptime, cooltime):
+    def __init__(self, db_uri, nims_path, log, sleeptime, cooltime, incremental=False, batch_size=1, num_threads=1, hash_name=nimsutil.digestutil.DEFAULT_HASH):
         super(Scheduler, self).__init__()
         self.nims_path = nims_path
         self.log = log
         self.sleeptime = sleeptime
         self.cooltime = datetime.timedelta(seconds=cooltime)
+        self.incremental = incremental
+        self.batch_size = batch_size
+        self.hash_name = hash_name
+        self.pool = multiprocessing.pool.ThreadPool(num_threads)
+        self.proc_job_states = [u'new', u'active'] if incremental else [u'new']
+        self.inspected_cnt = 0
+        self.inspection_time = 0.
         self.alive = True
-        init_model(sqlalchemy.create_engine(db_uri))
+        engine = sqlalchemy.create_engine(db_uri)
+        init_model(engine)
+        self.listener = NotificationListener(engine, UPDATE_CHANNEL)
 
     def halt(self):
         self.alive = False
 
     def run(self):
         while self.alive:
-            query = DataContainer.query
-            query = query.filter((DataContainer.updated == True) | (DataContainer.needs_finding == True) | (DataContainer.needs_processing == True))
-            query = query.filter(~DataContainer.datasets.any(Dataset.updatetime > (datetime.datetime.now() - self.cooltime)))
-            dc = query.with_lockmode('update').first()
-            if dc:
-                self.log.info(u'Inspecting  %s' % dc)
-                if dc.updated and dc.primary_dataset.update_file_cnt_and_digest(self.nims_path):
-                    dc.needs_finding = True
-                    dc.needs_processing = True
-                if dc.needs_finding:    # seems redundant, but needed for externally-triggered re-finding
-                    if not Job.query.filter_by(data_container=dc).filter_by(task=u'find').filter_by(status=u'new').first():
-                        job = Job(data_container=dc, task=u'find', nims_path=self.nims_path)
-                        self.log.info(u'Created job %s' % job)
-                    dc.needs_finding = False
-                if dc.needs_processing: # seems redundant, but needed for externally-triggered re-processing
-                    if not Job.query.filter_by(data_container=dc).filter_by(task=u'proc').filter_by(status=u'new').first():
-                        job = Job(data_container=dc, task=u'proc', nims_path=self.nims_path)
-                        self.log.info(u'Created job %s' % job)
-                    dc.needs_processing = False
-                dc.updated = False
-                transaction.commit()
-            else:
-                time.sleep(self.sleeptime)
+            if self.incremental:
+                self.schedule_acquiring()
+            if not self.inspect():
+                self.listener.wait(self.sleeptime)
+        self.pool.close()
+        self.pool.join()
+
+    @property
+    def containers_per_second(self):
+        """Overall inspection rate since startup."""
+        return self.inspected_cnt / max(self.inspection_time, 1e-6)
+
+    def inspect(self):
+        """Inspect a batch of ready data containers and create their jobs in one transaction; return the batch size."""
+        start = time.time()
+        query = DataContainer.query
+        query = query.filter((DataContainer.updated == True) | (DataContainer.needs_finding == True) | (DataContainer.needs_processing == True))
+        query = query.filter(~DataContainer.datasets.any(Dataset.updatetime > (datetime.datetime.now() - self.cooltime)))
+        containers = query.order_by(DataContainer.id).limit(self.batch_size).with_lockmode('update').all()
+        if not containers:
+            return 0
+        updated_ids = [dc.id for dc in containers if dc.updated]
+        if updated_ids:
+            datasets = Dataset.query.filter(Dataset.container_id.in_(updated_ids)).filter_by(kind=u'primary').all()
+            for ds in datasets:
+                file_cnt_and_digest = Dataset.file_cnt_and_digest(os.path.join(self.nims_path, ds.relpath), self.hash_name, self.pool)
+                if ds.update_file_cnt_and_digest(self.nims_path, file_cnt_and_digest):
+                    ds.container.needs_finding = True
+                    ds.container.needs_processing = True
+        query = DBSession.query(Job.data_container_id, Job.task).filter(Job.data_container_id.in_([dc.id for dc in containers]))
+        query = query.filter(((Job.task == u'find') & (Job.status == u'new')) | ((Job.task == u'proc') & Job.status.in_(self.proc_job_states)))
+        pending_jobs = set(query.all())
+        new_jobs = []
+        for dc in containers:
+            self.log.info(u'Inspecting  %s' % dc)
+            if dc.needs_finding:    # seems redundant, but needed for externally-triggered re-finding
+                if (dc.id, u'find') not in pending_jobs:
+                    new_jobs.append((dc, u'find'))
+                dc.needs_finding = False
+            if dc.needs_processing: # seems redundant, but needed for externally-triggered re-processing
+                if (dc.id, u'proc') not in pending_jobs:
+                    new_jobs.append((dc, u'proc'))
+                dc.needs_processing = False
+            dc.updated = False
+        Job.create_many(new_jobs, self.nims_path)
+        for dc, task in new_jobs:
+            self.log.info(u'Created job %s#%s' % (dc, task))
+        transaction.commit()
+        elapsed = time.time() - start
+        self.inspected_cnt += len(containers)
+        self.inspection_time += elapsed
+        self.log.info(u'Inspected %d containers in %.2fs (%.1f/s, %.1f/s overall), created %d jobs'
+                % (len(containers), elapsed, len(containers) / max(elapsed, 1e-6), self.containers_per_second, len(new_jobs)))
+        return len(containers)
+
+    def schedule_acquiring(self):
+        """Create proc jobs for dicom series that are still arriving, so that they are converted as they arrive."""
+        query = DicomData.query.filter(DicomData.kind == u'primary').filter(DicomData.file_cnt_act < DicomData.file_cnt_tgt)
+        query = query.join(DataContainer).filter(DataContainer.updated == True).filter(~DataContainer.jobs.any(Job.task == u'proc'))
+        for ds in query.all():
+            job = Job(data_container=ds.container, task=u'proc', nims_path=self.nims_path)
+            self.log.info(u'Created job %s' % job)
+        transaction.commit()
 
 
 class ArgumentParser(argparse.ArgumentParser):
@@ -66,6 +116,10 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('nims_path', help='data location')
         self.add_argument('-s', '--sleeptime', type=int, default=10, help='time to sleep between db queries')
         self.add_argument('-c', '--cooltime', type=int, default=30, help='time to let data cool before processing')
+        self.add_argument('-b', '--batchsize', type=int, default=1, help='number of data containers to inspect per transaction')
+        self.add_argument('-t', '--threads', type=int, default=1, help='number of threads for hashing dataset files')
+        self.add_argument('-H', '--hash', default=nimsutil.digestutil.DEFAULT_HASH, choices=sorted(nimsutil.digestutil.HASHES), help='file hash for detecting changed datasets')
+        self.add_argument('-i', '--incremental', action='store_true', help='start converting dicom series while they are still arriving')
         self.add_argument('-n', '--logname', default=os.path.splitext(os.path.basename(__file__))[0], help='process name for log')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='path to log file')
@@ -76,7 +130,7 @@ if __name__ == '__main__':
 
     log = nimsutil.get_logger(args.logname, args.logfile, args.loglevel)
 
-    scheduler = Scheduler(args.db_uri, args.nims_path, log, args.sleeptime, args.cooltime)
+    scheduler = Scheduler(args.db_uri, args.nims_path, log, args.sleeptime, args.cooltime, args.incremental, args.batchsize, args.threads, args.hash)
 
     def term_handler(signum, stack):
         scheduler.halt()
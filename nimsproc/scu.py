@@ -5,7 +5,8 @@
 SCU is a module that wraps the findscu and movescu commands, which are part of DCMTK.
 
 Usage involves the instantiation of an SCU object, which maintains knowledge of the caller and callee (data requester
-and data source, respectively).
+and data source, respectively). NativeSCU is a drop-in replacement that speaks DIMSE in-process (see dimse.py),
+instead of spawning a DCMTK process per query.
 
 Specific Query objects are constructed (e.g., SeriesQuery, if you intend to search for or move a series) and passed to
 the find() or move() methods of an SCU object.
@@ -13,9 +14,17 @@ the find() or move() methods of an SCU object.
 
 import re
 import shlex
+import socket
+import struct
 import logging
+import threading
 import subprocess
 
+import dicom.dataset
+import dicom.datadict
+
+import dimse
+
 RESPONSE_RE = re.compile("""
 W: # Dicom-Data-Set
 W: # Used TransferSyntax: (?P<transfer_syntax>.+)
@@ -56,9 +65,14 @@ class SCU(object):
         else:
             return []
 
-    def move(self, query, dest_path='.'):
-        """Construct a movescu query. Return the count of images successfully transferred."""
-        cmd = 'movescu --verbose -od %s +P %s %s' % (dest_path, self.incoming_port, self.query_string(query))
+    def move(self, query, dest_path='.', aet=None, incoming_port=None):
+        """
+        Construct a movescu query. Return the count of images successfully transferred.
+
+        Concurrent moves each need their own storage port, and thus their own caller AE title, which the callee
+        maps to that port; aet and incoming_port override the defaults of this SCU.
+        """
+        cmd = 'movescu --verbose -od %s +P %s %s' % (dest_path, incoming_port or self.incoming_port, self.query_string(query, aet))
         self.log.debug(cmd)
         output = ''
         try:
@@ -72,9 +86,94 @@ class SCU(object):
             img_cnt = 0
         return img_cnt
 
-    def query_string(self, query):
+    def query_string(self, query, aet=None):
         """Convert a query into a string to be appended to a findscu or movescu call."""
-        return '-S -aet %s -aec %s %s %s %s' % (self.aet, self.aec, query, self.host, str(self.port))
+        return '-S -aet %s -aec %s %s %s %s' % (aet or self.aet, self.aec, query, self.host, str(self.port))
+
+    def close(self):
+        pass
+
+
+class NativeSCU(SCU):
+
+    """
+    SCU that speaks DIMSE in-process.
+
+    C-FINDs reuse one persistent association. Moves retrieve into a long-running storage SCP per incoming port, which
+    accepts associations from the callee AE title only, over a persistent association per caller AE title; concurrent
+    moves must use distinct AE titles and ports. Stale associations, e.g., closed by the callee while idle, are
+    re-established before a request; a request is sent again only if it could not be sent on a stale association, so a
+    move is never started twice.
+
+    timeout limits connecting and negotiating an association, dimse_timeout every wait for a response; a C-MOVE may
+    well run for minutes without pending responses.
+    """
+
+    def __init__(self, host, port, aet, aec, incoming_port=None, log=None, timeout=60, dimse_timeout=None):
+        super(NativeSCU, self).__init__(host, port, aet, aec, incoming_port, log)
+        self.timeout = timeout
+        self.dimse_timeout = dimse_timeout
+        self.lock = threading.Lock()
+        self.associations = {}      # (caller AE title, 'find' or 'move') -> dimse.Association
+        self.scps = {}              # incoming port -> dimse.StorageSCP
+
+    def find(self, query):
+        """Return a list of Response objects."""
+        try:
+            datasets = self.request(self.aet, 'find', query.dataset())
+        except (dimse.DimseError, socket.error, struct.error) as ex:
+            self.log.debug(ex)
+            return []
+        return [DatasetResponse(ds, self.log) for ds in datasets]
+
+    def move(self, query, dest_path='.', aet=None, incoming_port=None):
+        """Return the count of images successfully transferred."""
+        aet = aet or self.aet
+        scp = self.storage_scp(incoming_port or self.incoming_port, aet)
+        scp.begin(dest_path)
+        try:
+            response = self.request(aet, 'move', query.dataset(), aet)
+        except (dimse.DimseError, socket.error, struct.error) as ex:
+            self.log.debug(ex)
+            response = {}
+        stored_cnt = scp.end()
+        return response.get('NumberOfCompletedSuboperations', stored_cnt)
+
+    def request(self, aet, operation, *args):
+        """Run a DIMSE operation on the persistent association of a caller AE title."""
+        key = (aet, operation)
+        for attempt in range(2):
+            with self.lock:
+                assoc = self.associations.pop(key, None)
+            if assoc and assoc.is_stale():
+                assoc.abort()
+                assoc = None
+            reused, sent_cnt = assoc is not None, assoc and assoc.sent_cnt
+            try:
+                assoc = assoc or dimse.Association.request(self.host, self.port, aet, self.aec, [dimse.STUDY_ROOT_FIND, dimse.STUDY_ROOT_MOVE], self.timeout, self.dimse_timeout)
+                result = getattr(assoc, operation)(*args)
+            except (dimse.DimseError, socket.error, struct.error):
+                assoc and assoc.abort()
+                if attempt or not reused or assoc.sent_cnt != sent_cnt:     # the request may have reached the callee
+                    raise
+            else:
+                with self.lock:
+                    self.associations[key] = assoc
+                return result
+
+    def storage_scp(self, port, aet):
+        with self.lock:
+            if port not in self.scps:
+                self.scps[port] = dimse.StorageSCP(port, aet, peer_aet=self.aec)
+            return self.scps[port]
+
+    def close(self):
+        with self.lock:
+            for assoc in self.associations.itervalues():
+                assoc.release()
+            for scp in self.scps.itervalues():
+                scp.close()
+            self.associations, self.scps = {}, {}
 
 
 class Query(object):
@@ -89,11 +188,22 @@ class Query(object):
         self.kwargs = kwargs
 
     def __str__(self):
-        string = '-k QueryRetrieveLevel=%s' % self.retrieve_level
+        string = '-k QueryRetrieveLevel=%s' % self.retrieve_level.upper()
         for key, value in self.kwargs.items():
             string += ' -k %s="%s"' % (str(key), str(value))
         return string
 
+    def dataset(self):
+        """Return the query as a C-FIND or C-MOVE identifier."""
+        ds = dicom.dataset.Dataset()
+        ds.QueryRetrieveLevel = self.retrieve_level.upper()
+        for key, value in self.kwargs.items():
+            tag = dicom.datadict.tag_for_name(key)
+            if tag is None:
+                raise ValueError('unknown query key %s' % key)
+            ds.add_new(tag, dicom.datadict.dictionaryVR(tag), str(value))
+        return ds
+
     def __repr__(self):
         return 'Query<retrieve_level=%s, kwargs=%s>' % (self.retrieve_level, self.kwargs)
 
@@ -152,3 +262,22 @@ class Response(dict):
         else:
             self.log.debug('Response: %s' % self)
             raise AttributeError, name
+
+
+class DatasetResponse(Response):
+
+    """Response built from a C-FIND identifier received by a NativeSCU, labelled with the DICOM keywords, like DCMTK's."""
+
+    def __init__(self, dataset, log, transfer_syntax=dimse.IMPLICIT_VR_LE):
+        dict.__init__(self)
+        self.log = log
+        self.transfer_syntax = transfer_syntax
+        self.dicom_cv_list = []
+        for data_element in dataset:
+            value = data_element.value
+            value = '\\'.join(map(str, value)) if data_element.VM > 1 else str(value)
+            self.dicom_cv_list.append(DicomCV(dict(idx_0='%04x' % data_element.tag.group, idx_1='%04x' % data_element.tag.elem,
+                    type=data_element.VR, value=value, length=str(len(value)), n_elems=str(data_element.VM),
+                    label=dicom.datadict.keyword_for_tag(data_element.tag))))
+        for cv in self.dicom_cv_list:
+            self[cv.label] = cv.value
@@ -6,97 +6,316 @@
 import os
 import sys
 import time
+import errno
 import shutil
 import signal
+import socket
 import argparse
 import datetime
+import itertools
+import threading
+import collections
+import multiprocessing
 
 import sqlalchemy
 import transaction
 
 import nimsutil
 from nimsgears import model
+from nimsgears.model import DBSession
+
+
+SortTarget = collections.namedtuple('SortTarget', 'id relpath filename_ext')
+
+
+def get_metadata(filepath):
+    """Return the appropriate PrimaryMRData subclass and the metadata of a file, or (None, None); touches no db state."""
+    for dataset_class in sorted(model.PrimaryMRData.__subclasses__(), key=lambda cls: cls.priority):
+        metadata = dataset_class.get_metadata(filepath)
+        if metadata:
+            return dataset_class, metadata
+    return None, None
+
+
+def move_file(src, dst):
+    """Move a file, by renaming it if src and dst are on the same filesystem."""
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+
+def process_alive(pid):
+    """Return True if a process with the given pid exists on this host."""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
 
 
 class Sorter(object):
 
-    def __init__(self, db_uri, stage_path, unsort_path, nims_path, dir_mode, preserve_mode, sleep_time, log):
+    """
+    Sort staged files into datasets on one or more worker threads, as they are moved into the stage.
+
+    Each worker claims a stage entry by renaming it into its own claim directory, <host>-<pid>-<worker index>, so
+    entries are never sorted twice, even by other sorters on the same stage. Entries left in the claim directories of
+    sorters on this host that have exited, e.g., crashed, are returned to the stage on startup, and the files that
+    remain in them are sorted again. An entry that fails to sort is returned to the stage right away, to be retried.
+
+    Claim directories of other hosts are never released, so those left by a host that was renamed or retired must
+    be moved back to the stage by hand.
+    """
+
+    def __init__(self, db_uri, stage_path, unsort_path, nims_path, dir_mode, preserve_mode, sleep_time, log, cache_size=256, grouped=False, num_jobs=1, claim_path=None, num_workers=1):
         super(Sorter, self).__init__()
         self.stage_path = stage_path
         self.unsort_path = unsort_path
         self.nims_path = nims_path
+        self.claim_path = claim_path or os.path.join(os.path.dirname(stage_path), 'claimed')
         self.dir_mode = dir_mode
         self.preserve_mode = preserve_mode
         self.sleep_time = sleep_time
         self.log = log
+        self.grouped = grouped
+        self.num_workers = num_workers
+        self.pool = multiprocessing.Pool(num_jobs) if num_jobs > 1 else None     # forked before any db connection
         self.alive = True
-        self.dataset_classes = sorted(model.PrimaryMRData.__subclasses__(), key=lambda cls: cls.priority)
+        self.datasets = nimsutil.LRUCache(cache_size)  # (dataset class, series uid, acq no) -> SortTarget, shared by all workers
+        self.datasets_lock = threading.Lock()
+        self.stage_entries = collections.deque()
+        self.stage_lock = threading.Lock()
         model.init_model(sqlalchemy.create_engine(db_uri))
 
     def halt(self):
         self.alive = False
 
     def run(self):
-        while self.alive:
-            stage_contents = [os.path.join(self.stage_path, sc) for sc in os.listdir(self.stage_path)]
-            if stage_contents:
-                sort_path = min(stage_contents, key=os.path.getmtime)   # oldest first
-                self.log.info('Sorting %s' % os.path.basename(sort_path))
+        self.release_claims()
+        self.watcher = nimsutil.watcher.watch(self.stage_path, self.sleep_time, atomic=True)
+        claim_prefix = '%s-%d' % (socket.gethostname(), os.getpid())
+        workers = [SortWorker(self, nimsutil.make_joined_path(self.claim_path, '%s-%d' % (claim_prefix, i))) for i in range(self.num_workers)]
+        for worker in workers:
+            worker.start()
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(1)     # with a timeout, so that signals are handled
+        for worker in workers:
+            if not os.listdir(worker.claim_path):
+                os.rmdir(worker.claim_path)
+        self.watcher.close()
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+
+    def release_claims(self):
+        """
+        Return the entries of claim directories whose sorter has exited to the stage, and remove those directories.
+
+        Claim directories of sorters on other hosts are left alone, since only their own host can tell whether they
+        are still running; so are those of other live processes on this host. Those bearing our own pid were left by
+        an earlier sorter, e.g., before a container restart, and are released before any worker reuses them.
+        """
+        if not os.path.isdir(self.claim_path):
+            return
+        hostname = socket.gethostname()
+        for claim_dir in os.listdir(self.claim_path):
+            owner = claim_dir.rsplit('-', 2)     # host names may contain dashes
+            if len(owner) == 3 and owner[1].isdigit():
+                pid = int(owner[1])
+                if owner[0] != hostname or (pid != os.getpid() and process_alive(pid)):
+                    continue
+            for entry in os.listdir(os.path.join(self.claim_path, claim_dir)):
+                self.log.warning('Releasing %s, claimed by a sorter that has exited' % entry)
+                os.rename(os.path.join(self.claim_path, claim_dir, entry), os.path.join(self.stage_path, entry))
+            os.rmdir(os.path.join(self.claim_path, claim_dir))
+
+    def next_entry(self):
+        """Return the name of the oldest new stage entry not handed out yet, waiting up to sleep_time for one, or None."""
+        with self.stage_lock:
+            if not self.stage_entries:
+                mtimes = {}
+                for entry in self.watcher.wait(self.sleep_time):
+                    try:
+                        mtimes[entry] = os.path.getmtime(os.path.join(self.stage_path, entry))
+                    except OSError:     # claimed by another sorter meanwhile
+                        pass
+                self.stage_entries.extend(sorted(mtimes, key=mtimes.get))
+            return self.stage_entries.popleft() if self.stage_entries else None
+
+    def dataset_for_metadata(self, dataset_class, metadata, pending_id=None):
+        """
+        Return the SortTarget of the dataset that a file with the given class and metadata belongs in, or None.
+
+        Targets are cached by series, so that only the first file of a series needs to touch the database. Lookups
+        are serialized and committed right away, so that no two workers create the same dataset, and no worker holds
+        a row lock while it waits. A cached target other than the one a worker has files pending for (pending_id) is
+        checked to still exist first, since its dataset may have been deleted, or trashed and purged, meanwhile.
+        """
+        if not metadata:
+            return None
+        key = (dataset_class, metadata.series_uid, metadata.acq_no)
+        with self.datasets_lock:
+            target = self.datasets.get(key)
+            if target and target.id != pending_id:
+                if not model.Dataset.query.filter_by(id=target.id).count():
+                    self.log.warning('Dataset %d of series %s was removed; looking it up again' % (target.id, metadata.series_uid))
+                    self.datasets.pop(key)
+                    target = None
+                transaction.commit()
+            if not target:
+                dataset = dataset_class.from_metadata(metadata)
+                nimsutil.make_joined_path(self.nims_path, dataset.relpath)
+                target = SortTarget(dataset.id, dataset.relpath, dataset.filename_ext)
+                transaction.commit()
+                self.datasets[key] = target
+        return target
+
+    def forget_dataset(self, dataset_id):
+        """Drop the cached targets of a dataset."""
+        with self.datasets_lock:
+            for key in [key for key, target in self.datasets.items.iteritems() if target.id == dataset_id]:
+                self.datasets.pop(key)
+
+
+class SortWorker(threading.Thread):
+
+    def __init__(self, sorter, claim_path):
+        super(SortWorker, self).__init__()
+        self.sorter = sorter
+        self.claim_path = claim_path
+        self.log = sorter.log
+        self.pending_dataset = None
+        self.pending_cnt = 0
+        self.file_cnt = 0
+
+    def run(self):
+        while self.sorter.alive:
+            entry = self.sorter.next_entry()
+            if entry is None:
+                self.log.debug('Waiting for work...')
+                continue
+            sort_path = os.path.join(self.claim_path, entry)
+            try:
+                os.rename(os.path.join(self.sorter.stage_path, entry), sort_path)
+            except OSError:     # claimed by another sorter
+                continue
+            self.log.info('Sorting %s' % entry)
+            start, self.file_cnt = time.time(), 0
+            try:
                 if os.path.isdir(sort_path):
                     self.sort_files(sort_path)
                 else:
                     self.sort_file(sort_path)
-                self.log.info('Sorted  %s' % os.path.basename(sort_path))
-            else:
-                self.log.debug('Waiting for work...')
-                time.sleep(self.sleep_time)
+                self.commit()
+            except Exception as ex:
+                self.log.error('Failed  %s: %s' % (entry, ex))
+                transaction.abort()
+                self.pending_dataset, self.pending_cnt = None, 0
+                self.release(entry)
+                time.sleep(self.sorter.sleep_time)  # before retrying, e.g., while the database is unavailable
+                continue
+            elapsed = time.time() - start
+            self.log.info('Sorted  %s: %d files in %.1fs (%.1f files/s)' % (entry, self.file_cnt, elapsed, self.file_cnt / max(elapsed, 1e-6)))
+        DBSession.remove()
+
+    def release(self, entry):
+        """Return what is left of a claimed entry to the stage, where it is picked up again."""
+        sort_path = os.path.join(self.claim_path, entry)
+        if os.path.lexists(sort_path):
+            try:
+                os.rename(sort_path, os.path.join(self.sorter.stage_path, entry))
+            except OSError as ex:   # released on the next startup
+                self.log.error('Cannot release %s: %s' % (entry, ex))
 
     def sort_files(self, sort_path):
         """Insert files, if valid, into database and associated filesystem."""
         for dirpath, dirnames, filenames in os.walk(sort_path, topdown=False):
-            if self.dir_mode and filenames and not dirnames:    # at lowest sub-directory
+            if self.sorter.dir_mode and filenames and not dirnames:    # at lowest sub-directory
                 self.sort_directory(dirpath, filenames)
+            elif self.sorter.grouped and filenames:
+                self.sort_grouped([os.path.join(dirpath, filename) for filename in filenames])
             else:
                 for filename in filenames:
-                    if not self.alive: return
+                    if not self.sorter.alive: return
                     self.sort_file(os.path.join(dirpath, filename))
+            if not self.sorter.alive: return
         shutil.rmtree(sort_path)
 
     def sort_file(self, filepath):
         self.log.debug('Sorting %s' % os.path.basename(filepath))
-        dataset = self.dataset_at_path(self.nims_path, filepath)
+        dataset = self.sorter.dataset_for_metadata(*get_metadata(filepath), pending_id=self.pending_dataset)
         if dataset:
-            ext = dataset.filename_ext if os.path.splitext(filepath)[1] != dataset.filename_ext else ''
-            shutil.move(filepath, os.path.join(self.nims_path, dataset.relpath, os.path.basename(filepath) + ext))
-            dataset.updatetime = datetime.datetime.now()
-            dataset.untrash()
-            transaction.commit()
-        elif self.preserve_mode:
-            unsort_path = nimsutil.make_joined_path(self.unsort_path, os.path.dirname(os.path.relpath(filepath, self.stage_path)))
-            shutil.move(filepath, unsort_path)
+            self.move(dataset, [filepath])
         else:
-            os.remove(filepath)
+            self.unsortable(filepath)
 
     def sort_directory(self, dirpath, filenames):
         self.log.debug('Sorting %s in directory mode' % os.path.basename(dirpath))
-        dataset = self.dataset_at_path(self.nims_path, os.path.join(dirpath, filenames[0]))
+        dataset = self.sorter.dataset_for_metadata(*get_metadata(os.path.join(dirpath, filenames[0])), pending_id=self.pending_dataset)
         if dataset:
-            for filepath in [os.path.join(dirpath, filename) for filename in filenames]:
-                ext = dataset.filename_ext if os.path.splitext(filepath)[1] != dataset.filename_ext else ''
-                shutil.move(filepath, os.path.join(self.nims_path, dataset.relpath, os.path.basename(filepath) + ext))
-            dataset.updatetime = datetime.datetime.now()
-            dataset.untrash()
-            transaction.commit()
-        elif self.preserve_mode:
-            unsort_path = nimsutil.make_joined_path(self.unsort_path, os.path.dirname(os.path.relpath(dirpath, self.stage_path)))
+            self.move(dataset, [os.path.join(dirpath, filename) for filename in filenames])
+        elif self.sorter.preserve_mode:
+            unsort_path = nimsutil.make_joined_path(self.sorter.unsort_path, os.path.dirname(os.path.relpath(dirpath, self.claim_path)))
             shutil.move(dirpath, unsort_path)
 
-    def dataset_at_path(self, nims_path, filepath):
-        """Return instance of appropriate MRIDataset subclass for provided file."""
-        for dataset_class in self.dataset_classes:
-            dataset = dataset_class.at_path(nims_path, filepath)
-            if dataset: break
-        return dataset
+    def sort_grouped(self, filepaths):
+        """Read all file headers, on the process pool if any, and move the files one series at a time."""
+        self.log.debug('Sorting %s in grouped mode' % os.path.basename(os.path.dirname(filepaths[0])))
+        pool = self.sorter.pool
+        buckets = collections.OrderedDict()
+        for filepath, (dataset_class, metadata) in zip(filepaths, (pool.imap if pool else itertools.imap)(get_metadata, filepaths)):
+            key = (dataset_class, metadata.series_uid, metadata.acq_no) if metadata else None
+            buckets.setdefault(key, (dataset_class, metadata, []))[2].append(filepath)
+        for dataset_class, metadata, bucket in buckets.itervalues():
+            if not self.sorter.alive: return
+            dataset = self.sorter.dataset_for_metadata(dataset_class, metadata, self.pending_dataset)
+            if dataset:
+                self.move(dataset, bucket)
+                self.commit()
+            else:
+                for filepath in bucket:
+                    self.unsortable(filepath)
+
+    def unsortable(self, filepath):
+        """Move an unsortable file to the unsortable directory, or remove it, unless it is a pfile we cannot parse yet."""
+        unsupported = hasattr(nimsutil, 'pfile') and nimsutil.pfile.is_unsupported(filepath)
+        if unsupported:
+            self.log.warning('Preserving %s: no parser for its pfile header revision' % os.path.basename(filepath))
+        if self.sorter.preserve_mode or unsupported:
+            unsort_path = nimsutil.make_joined_path(self.sorter.unsort_path, os.path.dirname(os.path.relpath(filepath, self.claim_path)))
+            shutil.move(filepath, unsort_path)
+        else:
+            os.remove(filepath)
+
+    def move(self, dataset, filepaths):
+        """Move files into a dataset; they are recorded by the next commit(), which happens when the dataset changes."""
+        if dataset.id != self.pending_dataset:
+            self.commit()
+        for filepath in filepaths:
+            ext = dataset.filename_ext if os.path.splitext(filepath)[1] != dataset.filename_ext else ''
+            move_file(filepath, os.path.join(self.sorter.nims_path, dataset.relpath, os.path.basename(filepath) + ext))
+        self.pending_dataset = dataset.id
+        self.pending_cnt += len(filepaths)
+        self.file_cnt += len(filepaths)
+
+    def commit(self):
+        """Record the files moved into the pending dataset, in one transaction."""
+        if self.pending_cnt:
+            dataset = model.Dataset.query.filter_by(id=self.pending_dataset).with_lockmode('update').first()
+            if dataset:
+                dataset.file_cnt_act = (dataset.file_cnt_act or 0) + self.pending_cnt
+                dataset.updatetime = datetime.datetime.now()
+                dataset.untrash()
+            else:   # removed since it was looked up
+                self.log.error('Dataset %d was removed while %d files were moved into it' % (self.pending_dataset, self.pending_cnt))
+                self.sorter.forget_dataset(self.pending_dataset)
+        transaction.commit()
+        self.pending_dataset = None
+        self.pending_cnt = 0
 
 
 class ArgumentParser(argparse.ArgumentParser):
@@ -108,7 +327,11 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('nims_path', help='data destination')
         self.add_argument('-d', '--dirmode', action='store_true', help='assume files are pre-sorted by directory')
         self.add_argument('-p', '--preserve', action='store_true', help='preserve unsortable files')
-        self.add_argument('-s', '--sleeptime', type=int, default=10, help='time to sleep before checking for new files')
+        self.add_argument('-s', '--sleeptime', type=int, default=10, help='time to wait for new files before checking again')
+        self.add_argument('-g', '--grouped', action='store_true', help='read all headers of a directory first, and sort its files by series')
+        self.add_argument('-j', '--jobs', type=int, default=1, help='number of processes reading headers in grouped mode')
+        self.add_argument('-w', '--workers', type=int, default=1, help='number of worker threads sorting stage entries concurrently')
+        self.add_argument('-c', '--cachesize', type=int, default=256, help='number of series to remember the datasets of')
         self.add_argument('-n', '--logname', default=os.path.splitext(os.path.basename(__file__))[0], help='process name for log')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='path to log file')
@@ -120,9 +343,10 @@ if __name__ == '__main__':
     log = nimsutil.get_logger(args.logname, args.logfile, args.loglevel)
     stage_path = nimsutil.make_joined_path(args.stage_path, 'sort')
     unsort_path = nimsutil.make_joined_path(args.stage_path, 'unsortable')
+    claim_path = nimsutil.make_joined_path(args.stage_path, 'claimed')
     nims_path = nimsutil.make_joined_path(args.nims_path)
 
-    sorter = Sorter(args.db_uri, stage_path, unsort_path, nims_path, args.dirmode, args.preserve, args.sleeptime, log)
+    sorter = Sorter(args.db_uri, stage_path, unsort_path, nims_path, args.dirmode, args.preserve, args.sleeptime, log, args.cachesize, args.grouped, args.jobs, claim_path, args.workers)
 
     def term_handler(signum, stack):
         sorter.halt()
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the dicom reaper.
+
+Concurrent moves are tested against a local DCMTK dcmqrscp standing in for the scanner, and skipped unless dcmqrscp,
+storescu and movescu are on the path; the native backend is tested against dcmqrscp as well. Incremental reaping is
+tested against a scripted SCU.
+"""
+
+import os
+import sys
+import time
+import datetime
+import socket
+import shutil
+import logging
+import tempfile
+import subprocess
+import distutils.spawn
+
+import numpy as np
+import dicom
+import dicom.dataset
+from nose.tools import assert_equals
+from nose.plugins.skip import SkipTest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import scu
+import dicomreaper
+from nimsutil import reapstate
+
+STUDY_UID = '1.2.826.0.1.3680043.2.1143.1'
+SERIES_SIZES = [40, 5, 5, 20]    # images per series; the first, long series is moved alongside the others
+
+DCMQRSCP_CFG = """
+NetworkTCPPort = %(port)d
+MaxPDUSize = 16384
+MaxAssociations = 16
+
+HostTable BEGIN
+%(movers)s
+HostTable END
+
+VendorTable BEGIN
+VendorTable END
+
+AETable BEGIN
+SCANNER %(db_path)s RW (200, 1024mb) ANY
+AETable END
+"""
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def make_series(dcm_dir, series_no, image_cnt, first=0):
+    """Write a small synthetic MR series that dcmqrscp can index."""
+    for i in range(first, image_cnt):
+        meta = dicom.dataset.Dataset()
+        meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+        meta.MediaStorageSOPInstanceUID = '%s.%d.%d' % (STUDY_UID, series_no, i+1)
+        meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+        meta.ImplementationClassUID = '1.2.3.4'
+        dcm = dicom.dataset.FileDataset('', {}, file_meta=meta, preamble='\x00' * 128)
+        dcm.is_little_endian = True
+        dcm.is_implicit_VR = False
+        dcm.SOPClassUID = meta.MediaStorageSOPClassUID
+        dcm.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        dcm.PatientName = 'reaper^test'
+        dcm.PatientID = 'reapertest'
+        dcm.StudyInstanceUID = STUDY_UID
+        dcm.StudyID = '1234'
+        dcm.StudyDate = '20130101'
+        dcm.StudyTime = '120000'
+        dcm.SeriesInstanceUID = '%s.%d' % (STUDY_UID, series_no)
+        dcm.SeriesNumber = series_no
+        dcm.Modality = 'MR'
+        dcm.InstanceNumber = i+1
+        dcm.ImagesinAcquisition = image_cnt
+        dcm.Rows = dcm.Columns = 8
+        dcm.BitsAllocated = dcm.BitsStored = 16
+        dcm.HighBit = 15
+        dcm.PixelRepresentation = 1
+        dcm.SamplesperPixel = 1
+        dcm.PhotometricInterpretation = 'MONOCHROME2'
+        dcm.PixelData = np.zeros((8, 8), np.int16).tostring()
+        dcm[0x7fe00010].VR = 'OW'
+        dcm.save_as(os.path.join(dcm_dir, 's%02d_i%04d.dcm' % (series_no, i+1)))
+
+
+class LogRecorder(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestConcurrentMoves(object):
+
+    def setUp(self):
+        if not all(distutils.spawn.find_executable(cmd) for cmd in ('dcmqrscp', 'storescu', 'movescu')):
+            raise SkipTest('DCMTK is not installed')
+        self.tmp_dir = tempfile.mkdtemp()
+        self.port = free_port()
+        self.movers = [('REAPER%d' % i, free_port()) for i in range(3)]
+        db_path = os.path.join(self.tmp_dir, 'db')
+        os.mkdir(db_path)
+        config = os.path.join(self.tmp_dir, 'dcmqrscp.cfg')
+        with open(config, 'w') as fd:
+            fd.write(DCMQRSCP_CFG % {
+                    'port': self.port,
+                    'movers': '\n'.join('%s = (%s, localhost, %d)' % (aet.lower(), aet, port) for aet, port in self.movers),
+                    'db_path': db_path,
+                    })
+        self.server = subprocess.Popen(['dcmqrscp', '-c', config], stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        time.sleep(1)
+        dcm_dir = os.path.join(self.tmp_dir, 'dicoms')
+        os.mkdir(dcm_dir)
+        for series_no, image_cnt in enumerate(SERIES_SIZES, 1):
+            make_series(dcm_dir, series_no, image_cnt)
+        dcm_files = sorted(os.path.join(dcm_dir, f) for f in os.listdir(dcm_dir))
+        subprocess.check_call(['storescu', '-aec', 'SCANNER', 'localhost', str(self.port)] + dcm_files)
+
+        self.log = logging.getLogger('test_dicomreaper')
+        self.log.setLevel(logging.INFO)
+        self.recorder = LogRecorder()
+        self.log.addHandler(self.recorder)
+        self.reap_stage = os.path.join(self.tmp_dir, 'reap')
+        self.sort_stage = os.path.join(self.tmp_dir, 'sort')
+        os.mkdir(self.reap_stage)
+        os.mkdir(self.sort_stage)
+
+    def tearDown(self):
+        self.log.removeHandler(self.recorder)
+        self.server.terminate()
+        self.server.wait()
+        shutil.rmtree(self.tmp_dir)
+
+    def reap(self, movers, scu_class=scu.SCU):
+        scu_ = scu_class('localhost', self.port, movers[0][0], 'SCANNER', log=self.log)
+        reaper = dicomreaper.DicomReaper('localhost', scu_, self.reap_stage, self.sort_stage, reapstate.ReapState(':memory:'), 1, self.log, movers)
+        exam = dicomreaper.Exam('1234', STUDY_UID, None, reaper)
+        series_list = [dicomreaper.Series(exam, reaper, series_no, '%s.%d' % (STUDY_UID, series_no), image_cnt) for series_no, image_cnt in enumerate(SERIES_SIZES, 1)]
+        for cycle in range(2):      # moves all images, then finds them all reaped
+            for series in series_list:
+                series.reap(series.image_count)
+            while reaper.moves:
+                reaper.stage_reaped(1)
+        scu_.close()
+        return series_list
+
+    def check_staged(self, series_list):
+        assert not any(series.needs_reaping for series in series_list)
+        staged = sorted(os.listdir(self.sort_stage))
+        assert_equals(len(staged), len(SERIES_SIZES))
+        for stage_dir, image_cnt in zip(staged, SERIES_SIZES):
+            assert_equals(len(os.listdir(os.path.join(self.sort_stage, stage_dir))), image_cnt)
+        reaped = [msg for msg in self.recorder.messages if msg.startswith('Reaped')]
+        assert_equals(reaped, ['Reaped     %s' % series for series in series_list])
+        assert_equals(os.listdir(self.reap_stage), [])
+
+    def test_single_mover(self):
+        self.check_staged(self.reap(self.movers[:1]))
+
+    def test_concurrent_movers(self):
+        self.check_staged(self.reap(self.movers))
+
+    def test_native_concurrent_movers(self):
+        self.check_staged(self.reap(self.movers, scu.NativeSCU))
+
+
+class ScannerResponse(dict):
+    __getattr__ = dict.__getitem__
+
+
+class ScannerSCU(object):
+
+    """SCU of a scripted scanner, whose series grow as images are acquired and whose moves may lose images."""
+
+    aet, incoming_port = 'NIMS', 4006
+
+    def __init__(self, image_counts):
+        self.image_counts = image_counts    # series number -> images acquired so far
+        self.lost_images = set()            # (series number, instance number) to lose in the next move
+        self.moved_images = []
+
+    def find(self, query):
+        series_no = int(query.kwargs['SeriesInstanceUID'].rsplit('.', 1)[1])
+        return [ScannerResponse(SOPInstanceUID='%s.%d.%d' % (STUDY_UID, series_no, i+1), InstanceNumber=str(i+1)) for i in range(self.image_counts[series_no])]
+
+    def move(self, query, dest_path, aet, incoming_port):
+        moved = 0
+        for instance_uid in query.kwargs['SOPInstanceUID'].split('\\'):
+            series_no, instance_no = map(int, instance_uid.rsplit('.', 2)[1:])
+            if (series_no, instance_no) in self.lost_images:
+                self.lost_images.remove((series_no, instance_no))
+                continue
+            make_series(dest_path, series_no, instance_no, instance_no - 1)
+            self.moved_images.append((series_no, instance_no))
+            moved += 1
+        return moved
+
+
+class TestIncrementalReaping(object):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.reap_stage = os.path.join(self.tmp_dir, 'reap')
+        self.sort_stage = os.path.join(self.tmp_dir, 'sort')
+        os.mkdir(self.reap_stage)
+        os.mkdir(self.sort_stage)
+        self.scu = ScannerSCU({1: 0})
+        self.restart()
+
+    def tearDown(self):
+        self.reaper.pool.close()
+        self.reaper.state.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def restart(self, image_cnt=0):
+        if hasattr(self, 'reaper'):
+            self.reaper.pool.close()
+            self.reaper.state.close()
+        state = reapstate.ReapState(os.path.join(self.tmp_dir, '.state'))
+        self.reaper = dicomreaper.DicomReaper('localhost', self.scu, self.reap_stage, self.sort_stage, state, 0, logging.getLogger('test_dicomreaper'))
+        self.series = dicomreaper.Series(dicomreaper.Exam('1234', STUDY_UID, None, self.reaper), self.reaper, 1, '%s.1' % STUDY_UID, image_cnt)
+
+    def cycle(self, image_cnt):
+        self.scu.image_counts[1] = image_cnt
+        self.series.reap(image_cnt)
+        while self.reaper.moves:
+            self.reaper.stage_reaped(1)
+
+    def staged_images(self):
+        return sorted(int(f.split('_i')[1][:4]) for d in os.listdir(self.sort_stage) for f in os.listdir(os.path.join(self.sort_stage, d)))
+
+    def test_streaming(self):
+        self.cycle(30)
+        assert_equals(self.staged_images(), range(1, 31))
+        self.cycle(250)
+        assert_equals(self.staged_images(), range(1, 251))
+        assert_equals(len(os.listdir(self.sort_stage)), 1 + 3)     # one batch, then three batches of at most 100
+        assert self.series.needs_reaping
+        self.cycle(250)
+        assert not self.series.needs_reaping
+        assert_equals(sorted(self.scu.moved_images), [(1, i) for i in range(1, 251)])
+
+    def test_resume(self):
+        self.scu.lost_images.update([(1, 3), (1, 7)])
+        self.cycle(10)
+        assert_equals(self.staged_images(), [1, 2, 4, 5, 6, 8, 9, 10])
+        self.cycle(10)
+        assert_equals(self.staged_images(), range(1, 11))
+        assert_equals(self.scu.moved_images[-2:], [(1, 3), (1, 7)])
+        assert self.series.needs_reaping
+        self.cycle(10)
+        assert not self.series.needs_reaping
+        assert_equals(os.listdir(self.reap_stage), [])
+
+    def test_restart(self):
+        self.scu.lost_images.update([(1, 3), (1, 7)])
+        self.cycle(10)
+        self.restart()
+        self.cycle(10)
+        assert_equals(sorted(self.scu.moved_images), [(1, i) for i in range(1, 11)])
+        self.cycle(10)
+        assert not self.series.needs_reaping
+        self.restart(10)
+        assert not self.series.needs_reaping
+        self.cycle(12)
+        assert_equals(self.scu.moved_images[-2:], [(1, 11), (1, 12)])
+        assert_equals(len(self.scu.moved_images), 12)
+
+
+class StudySCU(object):
+
+    """SCU of a scripted scanner that answers study and series queries, and records them."""
+
+    aet, incoming_port = 'NIMS', 4006
+
+    def __init__(self):
+        self.studies = {}       # study uid -> (study datetime, {series number: image count})
+        self.queries = []
+
+    def find(self, query):
+        self.queries.append(query)
+        if query.retrieve_level == 'Study':
+            return [ScannerResponse(StudyInstanceUID=uid, StudyID=uid[-4:], StudyDate=dt.strftime('%Y%m%d'), StudyTime=dt.strftime('%H%M%S'),
+                    NumberOfStudyRelatedInstances=str(sum(series.values()))) for uid, (dt, series) in self.studies.iteritems() if self.matches(query, uid, dt)]
+        return [ScannerResponse(SeriesInstanceUID='%s.%d' % (query.kwargs['StudyInstanceUID'], number), SeriesNumber=str(number), ImagesInAcquisition=str(image_cnt))
+                for number, image_cnt in self.studies[query.kwargs['StudyInstanceUID']][1].iteritems()]
+
+    def matches(self, query, uid, dt):
+        date, time_ = query.kwargs['StudyDate'], query.kwargs['StudyTime']
+        if query.kwargs['StudyInstanceUID']:
+            return uid in query.kwargs['StudyInstanceUID'].split('\\')
+        if date.endswith('-'):
+            return dt.strftime('%Y%m%d') >= date[:-1]
+        return dt.strftime('%Y%m%d') == date and (not time_ or dt.strftime('%H%M%S') >= time_[:-1])
+
+
+class TestStudyIndex(object):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp_dir, 'reap'))
+        self.index_file = os.path.join(self.tmp_dir, '.index')
+        self.now = datetime.datetime.combine(datetime.date.today(), datetime.time(12))
+        with open(os.path.join(self.tmp_dir, '.datetime'), 'w') as fd:
+            fd.write((self.now - datetime.timedelta(hours=1)).strftime('%c\n'))
+        self.scu = StudySCU()
+        self.scu.studies['1.2.3.1001'] = (self.now - datetime.timedelta(minutes=30), {1: 10, 2: 20})
+        self.reaper = self.make_reaper()
+
+    def tearDown(self):
+        self.reaper.pool.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def make_reaper(self, window=2):
+        state = reapstate.ReapState(os.path.join(self.tmp_dir, '.state'), os.path.join(self.tmp_dir, '.datetime'))
+        return dicomreaper.DicomReaper('localhost', self.scu, os.path.join(self.tmp_dir, 'reap'), self.tmp_dir, state,
+                30, logging.getLogger('test_dicomreaper'), index_file=self.index_file, max_sleep_time=240, window=window)
+
+    def test_delta_queries(self):
+        exams = self.reaper.get_outstanding_exams()
+        assert_equals([exam.uid for exam in exams], ['1.2.3.1001'])
+        assert_equals(self.scu.queries[-1].kwargs['StudyDate'], (self.now - datetime.timedelta(hours=1)).strftime('%Y%m%d-'))
+        self.reaper.monitored_exams.append(exams[0])
+        self.scu.studies['1.2.3.1002'] = (self.now, {1: 5})
+        exams = self.reaper.get_outstanding_exams()
+        assert_equals([exam.uid for exam in exams], ['1.2.3.1001', '1.2.3.1002'])
+        newest, monitored = self.scu.queries[-2:]
+        assert_equals(newest.kwargs['StudyTime'], (self.now - datetime.timedelta(minutes=30)).strftime('%H%M%S-'))
+        assert_equals(monitored.kwargs['StudyInstanceUID'], '1.2.3.1001')
+
+    def test_series_cached_until_study_changes(self):
+        exam = self.reaper.get_outstanding_exams()[0]
+        for i in range(3):
+            self.reaper.get_outstanding_exams()
+            assert_equals(sorted((s.id_, s.image_count) for s in exam.get_series_list()), [(1, 10), (2, 20)])
+        assert_equals([q.retrieve_level for q in self.scu.queries].count('Series'), 1)
+        self.scu.studies['1.2.3.1001'][1][3] = 1
+        self.reaper.get_outstanding_exams()
+        assert_equals(sorted((s.id_, s.image_count) for s in exam.get_series_list()), [(1, 10), (2, 20), (3, 1)])
+        assert_equals([q.retrieve_level for q in self.scu.queries].count('Series'), 2)
+
+    def test_persistence(self):
+        self.reaper.get_outstanding_exams()[0].get_series_list()
+        self.reaper.index.save()
+        del self.scu.queries[:]
+        reaper = self.make_reaper()
+        assert_equals(sorted(reaper.index.get_series('1.2.3.1001')), [('1.2.3.1001.1', 1, 10), ('1.2.3.1001.2', 2, 20)])
+
+    def test_back_off(self):
+        self.reaper.get_outstanding_exams()
+        sleep_times = [self.reaper.next_sleep_time() for i in range(6)]
+        assert_equals(sleep_times, [30, 60, 120, 240, 240, 240])
+        self.scu.studies['1.2.3.1002'] = (self.now, {1: 5})
+        self.reaper.get_outstanding_exams()
+        assert_equals(self.reaper.next_sleep_time(), 30)
+
+    def test_window(self):
+        for i in (2, 3, 4):
+            self.scu.studies['1.2.3.100%d' % i] = (self.now + datetime.timedelta(minutes=i), {1: 5})
+        self.reaper.window = 3
+        self.reaper.update_monitored_exams(self.reaper.get_outstanding_exams())
+        assert_equals([exam.uid for exam in self.reaper.monitored_exams], ['1.2.3.1001', '1.2.3.1002', '1.2.3.1003'])
+        for series_no, image_cnt in ((1, 10), (2, 20)):
+            self.reaper.state.mark('series', '1.2.3.1001.%d' % series_no, reapstate.REAPED, '1.2.3.1001', image_cnt)
+        self.reaper.monitored_exams[0].reap()
+        self.reaper.update_monitored_exams(self.reaper.get_outstanding_exams())
+        assert_equals([exam.uid for exam in self.reaper.monitored_exams], ['1.2.3.1002', '1.2.3.1003', '1.2.3.1004'])
+        assert self.reaper.state.is_reaped('exam', '1.2.3.1001', 30)
+        reaper = self.make_reaper(window=3)
+        assert_equals(reaper.current_exam_datetime, self.now + datetime.timedelta(minutes=2))
+        assert_equals([exam.uid for exam in reaper.get_outstanding_exams()], ['1.2.3.1002', '1.2.3.1003', '1.2.3.1004'])
+        reaper.pool.close()
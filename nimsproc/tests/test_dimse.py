@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""Tests for the in-process DIMSE backend, against a fake query/retrieve SCP built from the same primitives."""
+
+import os
+import sys
+import time
+import socket
+import shutil
+import logging
+import tempfile
+import threading
+import SocketServer
+
+import numpy as np
+import dicom
+import dicom.dataset
+from nose.tools import assert_equals, assert_raises
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import scu
+import dimse
+
+MR_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+STUDY_UID = '1.2.826.0.1.3680043.2.1143.2'
+SERIES = {'%s.1' % STUDY_UID: (1, 3), '%s.2' % STUDY_UID: (2, 2)}     # series uid -> (series number, image count)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def make_instance(series_uid, instance_no):
+    ds = dicom.dataset.Dataset()
+    ds.SOPClassUID = MR_STORAGE
+    ds.SOPInstanceUID = '%s.%d' % (series_uid, instance_no)
+    ds.StudyInstanceUID = STUDY_UID
+    ds.SeriesInstanceUID = series_uid
+    ds.InstanceNumber = instance_no
+    ds.Rows = ds.Columns = 200      # larger than a PDU, so instances are fragmented
+    ds.BitsAllocated = 16
+    ds.PixelData = np.arange(200 * 200, dtype=np.int16).tostring()
+    return ds
+
+
+class QueryRetrieveHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        self.server.association_cnt += 1
+        assoc = dimse.Association(self.request)
+        pdu_type, data = assoc.recv_pdu()
+        assoc.accept(data)
+        while True:
+            message = assoc.recv_message()
+            if message is None:
+                return
+            pcid, command, data = message
+            identifier = dimse.decode_dataset(data)
+            response = dict(CommandField=command['CommandField'] | dimse.RESPONSE, MessageIDBeingRespondedTo=command['MessageID'],
+                    AffectedSOPClassUID=command['AffectedSOPClassUID'])
+            if command['CommandField'] == dimse.C_FIND_RQ:
+                for series_uid, (series_no, image_cnt) in sorted(SERIES.iteritems()):
+                    match = dicom.dataset.Dataset()
+                    match.StudyInstanceUID = STUDY_UID
+                    match.SeriesInstanceUID = series_uid
+                    match.SeriesNumber = series_no
+                    match.ImagesInAcquisition = image_cnt
+                    assoc.send_message(pcid, dict(response, Status=dimse.PENDING), dimse.encode_dataset(match))
+                assoc.send_message(pcid, dict(response, Status=dimse.SUCCESS))
+            else:
+                self.server.move_cnt += 1
+                if self.server.fail_moves:
+                    return assoc.close()
+                completed = self.store(command['MoveDestination'], identifier.SeriesInstanceUID)
+                time.sleep(self.server.move_delay)
+                assoc.send_message(pcid, dict(response, Status=dimse.SUCCESS, NumberOfCompletedSuboperations=completed,
+                        NumberOfFailedSuboperations=SERIES[identifier.SeriesInstanceUID][1] - completed, NumberOfRemainingSuboperations=0))
+            if self.server.drop_associations:
+                return assoc.close()
+
+    def store(self, move_destination, series_uid):
+        store_assoc = dimse.Association.request('localhost', self.server.destinations[move_destination], 'SCANNER', move_destination, [MR_STORAGE])
+        pcid = store_assoc.context_id(MR_STORAGE)
+        completed = 0
+        for instance_no in range(1, SERIES[series_uid][1] + 1):
+            ds = make_instance(series_uid, instance_no)
+            store_assoc.send_message(pcid, dict(CommandField=dimse.C_STORE_RQ, AffectedSOPClassUID=MR_STORAGE,
+                    AffectedSOPInstanceUID=ds.SOPInstanceUID, MessageID=instance_no, Priority=0), dimse.encode_dataset(ds))
+            completed += store_assoc.recv_message()[1]['Status'] == dimse.SUCCESS
+        store_assoc.release()
+        return completed
+
+
+class TestNativeSCU(object):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = SocketServer.ThreadingTCPServer(('localhost', 0), QueryRetrieveHandler)
+        self.server.daemon_threads = True
+        self.server.association_cnt = 0
+        self.server.drop_associations = False
+        self.server.move_cnt = 0
+        self.server.move_delay = 0
+        self.server.fail_moves = False
+        self.server.destinations = {'NIMS1': free_port(), 'NIMS2': free_port()}
+        threading.Thread(target=self.server.serve_forever).start()
+        self.scu = scu.NativeSCU('localhost', self.server.server_address[1], 'NIMS1', 'SCANNER', self.server.destinations['NIMS1'], logging.getLogger('test_dimse'))
+
+    def tearDown(self):
+        self.scu.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_find(self):
+        query = scu.SeriesQuery(StudyInstanceUID=STUDY_UID, SeriesNumber='', SeriesInstanceUID='', ImagesInAcquisition='')
+        for i in range(3):
+            responses = self.scu.find(query)
+            assert_equals([(int(r.SeriesNumber), r.SeriesInstanceUID, int(r.ImagesInAcquisition)) for r in responses],
+                    [(1, '%s.1' % STUDY_UID, 3), (2, '%s.2' % STUDY_UID, 2)])
+        assert_equals(self.server.association_cnt, 1)
+
+    def test_reassociate(self):
+        self.server.drop_associations = True
+        query = scu.StudyQuery(StudyInstanceUID=STUDY_UID, SeriesInstanceUID='')
+        assert_equals(len(self.scu.find(query)), 2)
+        assert_equals(len(self.scu.find(query)), 2)
+        assert_equals(self.server.association_cnt, 2)
+
+    def test_move(self):
+        for aet, series_no in (('NIMS1', 1), ('NIMS2', 2)):
+            series_uid = '%s.%d' % (STUDY_UID, series_no)
+            dest_path = os.path.join(self.tmp_dir, aet)
+            os.mkdir(dest_path)
+            reap_cnt = self.scu.move(scu.SeriesQuery(StudyInstanceUID=STUDY_UID, SeriesInstanceUID=series_uid), dest_path, aet, self.server.destinations[aet])
+            assert_equals(reap_cnt, SERIES[series_uid][1])
+            for filename in os.listdir(dest_path):
+                dcm = dicom.read_file(os.path.join(dest_path, filename))
+                expected = make_instance(series_uid, dcm.InstanceNumber)
+                assert_equals(filename, expected.SOPInstanceUID + '.dcm')
+                assert_equals(dcm.file_meta.TransferSyntaxUID, dimse.IMPLICIT_VR_LE)
+                assert_equals(dcm.PixelData, expected.PixelData)
+            assert_equals(len(os.listdir(dest_path)), SERIES[series_uid][1])
+
+    def test_slow_move(self):
+        self.scu.timeout = 0.2      # limits association only, not the wait for the move response
+        self.server.move_delay = 0.5
+        series_uid = '%s.1' % STUDY_UID
+        reap_cnt = self.scu.move(scu.SeriesQuery(StudyInstanceUID=STUDY_UID, SeriesInstanceUID=series_uid), self.tmp_dir)
+        assert_equals(reap_cnt, SERIES[series_uid][1])
+        assert_equals(self.server.association_cnt, 1)
+        assert_equals(self.server.move_cnt, 1)
+
+    def test_no_move_reissue(self):
+        query = scu.SeriesQuery(StudyInstanceUID=STUDY_UID, SeriesInstanceUID='%s.1' % STUDY_UID)
+        self.scu.move(query, self.tmp_dir)
+        self.server.fail_moves = True
+        self.scu.move(query, self.tmp_dir)
+        assert_equals(self.server.association_cnt, 1)
+        assert_equals(self.server.move_cnt, 2)
+
+    def test_refuse_outside_retrieval(self):
+        scp = self.scu.storage_scp(self.server.destinations['NIMS1'], 'NIMS1')
+        status = scp.store(dimse.IMPLICIT_VR_LE, 'SCANNER', dict(AffectedSOPClassUID=MR_STORAGE, AffectedSOPInstanceUID='1.2.3'), '')
+        assert_equals(status, dimse.OUT_OF_RESOURCES)
+
+    def test_refuse_invalid_uid(self):
+        scp = self.scu.storage_scp(self.server.destinations['NIMS1'], 'NIMS1')
+        dest_path = os.path.join(self.tmp_dir, 'NIMS1')
+        os.mkdir(dest_path)
+        scp.begin(dest_path)
+        for uid in ('../../x', '1.2.3/4', '1.2.3\n', ''):
+            status = scp.store(dimse.IMPLICIT_VR_LE, 'SCANNER', dict(AffectedSOPClassUID=MR_STORAGE, AffectedSOPInstanceUID=uid), '')
+            assert_equals(status, dimse.CANNOT_UNDERSTAND)
+        assert_equals(scp.end(), 0)
+        assert_equals(os.listdir(self.tmp_dir), ['NIMS1'])
+        assert_equals(os.listdir(dest_path), [])
+
+    def test_reject_other_callers(self):
+        self.scu.storage_scp(self.server.destinations['NIMS1'], 'NIMS1')
+        assert_raises(dimse.DimseError, dimse.Association.request, 'localhost', self.server.destinations['NIMS1'], 'INTRUDER', 'NIMS1', [MR_STORAGE])
+        dimse.Association.request('localhost', self.server.destinations['NIMS1'], 'SCANNER', 'NIMS1', [MR_STORAGE]).release()
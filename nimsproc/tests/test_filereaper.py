@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Tests for the file reaper, with a reap state seeded from a legacy datetime file."""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import datetime
+import tempfile
+import threading
+
+from nose.tools import assert_equals
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import filereaper
+from nimsutil import reapstate
+
+
+def touch(path, mod_time):
+    with open(path, 'w') as fd:
+        fd.write(os.path.basename(path))
+    os.utime(path, (time.mktime(mod_time.timetuple()),) * 2)
+
+
+class TestFileReaper(object):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_path = os.path.join(self.tmp_dir, 'data')
+        self.reap_stage = os.path.join(self.tmp_dir, 'reap')
+        self.sort_stage = os.path.join(self.tmp_dir, 'sort')
+        for path in (self.data_path, self.reap_stage, self.sort_stage):
+            os.mkdir(path)
+        self.reference = datetime.datetime.now().replace(microsecond=0) - datetime.timedelta(hours=1)
+        with open(os.path.join(self.tmp_dir, '.datetime'), 'w') as fd:
+            fd.write(self.reference.strftime('%c\n'))
+        self.state = reapstate.ReapState(os.path.join(self.tmp_dir, '.state'), os.path.join(self.tmp_dir, '.datetime'))
+        self.reaper = filereaper.FileReaper('data', os.path.join(self.data_path, '*'), self.reap_stage, self.sort_stage,
+                self.state, 0.1, logging.getLogger('test_filereaper'), poll=True)
+
+    def tearDown(self):
+        self.state.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def run_reaper(self, until):
+        thread = threading.Thread(target=self.reaper.run)
+        thread.start()
+        deadline = time.time() + 10
+        while not until() and time.time() < deadline:
+            time.sleep(0.1)
+        self.reaper.halt()
+        thread.join()
+
+    def test_legacy_reference_datetime(self):
+        assert_equals(self.reaper.current_file_timestamp, self.reference)
+        touch(os.path.join(self.data_path, 'P00512.7'), self.reference - datetime.timedelta(minutes=30))
+        touch(os.path.join(self.data_path, 'P01024.7'), self.reference + datetime.timedelta(minutes=30))
+        self.run_reaper(lambda: os.listdir(self.sort_stage))
+        staged = os.listdir(self.sort_stage)
+        assert_equals(len(staged), 1)
+        assert_equals(os.listdir(os.path.join(self.sort_stage, staged[0])), ['P01024.7'])
+        assert self.state.is_reaped('file', os.path.join(self.data_path, 'P01024.7'))
+        assert_equals(self.state.get('file', os.path.join(self.data_path, 'P00512.7')), None)
+        assert_equals(self.state.get_reference_datetime(), self.reference + datetime.timedelta(minutes=30))
+
+    def test_forget_expired_files(self):
+        self.state.mark('file', '/gone/P00256.7', reapstate.REAPED)
+        self.state.execute('UPDATE items SET updated = ?', (time.mktime(self.reference.timetuple()) - reapstate.RETENTION - 60,))
+        self.state.mark('file', '/gone/P00384.7', reapstate.REAPED)
+        self.run_reaper(lambda: len(self.state.keys('file')) == 1)
+        assert_equals(self.state.keys('file'), set(['/gone/P00384.7']))
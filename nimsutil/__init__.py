@@ -7,6 +7,21 @@ try:
 except:
     print 'Warning: could not import pyramid module'
 
+try:
+    import watcher
+except:
+    print 'Warning: could not import watcher module'
+
+try:
+    import digestutil
+except:
+    print 'Warning: could not import digestutil module'
+
+try:
+    import niftiutil
+except:
+    print 'Warning: could not import niftiutil module'
+
 try:
     import dicomutil
 except:
@@ -16,3 +31,8 @@ try:
     import pfile
 except:
     print 'Warning: could not import pfile module'
+
+try:
+    import reapstate
+except:
+    print 'Warning: could not import reapstate module'
@@ -6,15 +6,19 @@
 from __future__ import print_function
 
 import os
+import time
 import signal
 import argparse
 import datetime
+import multiprocessing
+import multiprocessing.sharedctypes
 
 import dicom
 import numpy as np
 import nibabel
 
 import png
+import niftiutil
 
 TYPE_ORIGINAL = ['ORIGINAL', 'PRIMARY', 'OTHER']
 TYPE_EPI =      ['ORIGINAL', 'PRIMARY', 'EPI', 'NONE']
@@ -71,6 +75,7 @@ class DicomFile(object):
             self.series_desc = dcm.SeriesDescription
             self.timestamp = datetime.datetime.strptime(acq_date(dcm) + acq_time(dcm), '%Y%m%d%H%M%S')
             self.duration = datetime.timedelta() # FIXME
+            self.image_cnt = int(dcm.ImagesinAcquisition) if 'ImagesinAcquisition' in dcm else None
             self.patient_id = dcm.PatientID
             self.patient_name = dcm.PatientsName
             self.patient_dob = dcm.PatientsBirthDate
@@ -78,12 +83,120 @@ class DicomFile(object):
 
 class DicomSeries(object):
 
-    def __init__(self, dcm_dir, log=None):
-        self.dcm_list = sorted([dicom.read_file(os.path.join(dcm_dir, f)) for f in os.listdir(dcm_dir)], key=lambda dcm: dcm.InstanceNumber)
-        self.first_dcm = self.dcm_list[0]
-        self.log = log
+    """
+    Load a directory of dicoms as one ordered series.
+
+    Headers are read first, without pixel data, to order and validate the slices. Pixel data is then decoded,
+    optionally across a pool of worker processes, directly into a single preallocated volume.
+    """
 
-    def convert(self, outbase):
+    def __init__(self, dcm_dir, log=None, num_workers=1):
+        self.dcm_dir = dcm_dir
+        self.log = log
+        self.num_workers = num_workers
+        self.dcm_list = []
+        self.filenames = []
+        if not self.refresh():
+            raise DicomError('no readable dicoms in %s' % dcm_dir)
+        self.validate()
+        self._image_data = None
+
+    def refresh(self):
+        """Read the headers of dicoms that were added to the series directory; return the number of new dicoms."""
+        headers = zip(self.dcm_list, self.filenames)
+        known = set(self.filenames)
+        new_cnt = 0
+        for filename in [os.path.join(self.dcm_dir, f) for f in os.listdir(self.dcm_dir)]:
+            if filename in known: continue
+            try:
+                headers.append((dicom.read_file(filename, stop_before_pixels=True), filename))
+                new_cnt += 1
+            except (IOError, dicom.filereader.InvalidDicomError):
+                msg = 'skipping unreadable dicom %s' % os.path.basename(filename)
+                self.log and self.log.warning(msg) or print(msg)
+        if new_cnt:
+            headers.sort(key=lambda hdr: hdr[0].InstanceNumber)
+            self.dcm_list = [dcm for dcm, filename in headers]
+            self.filenames = [filename for dcm, filename in headers]
+            self.first_dcm = self.dcm_list[0]
+            self._image_data = None
+        return new_cnt
+
+    def wait_for(self, slices_total, poll_interval, timeout):
+        """Wait until the series holds at least slices_total dicoms; return False if it stalls for timeout seconds."""
+        last_arrival = time.time()
+        while len(self.dcm_list) < slices_total:
+            if time.time() - last_arrival > timeout:
+                return False
+            time.sleep(poll_interval)
+            if self.refresh():
+                last_arrival = time.time()
+        return True
+
+    def validate(self):
+        """Check that the ordered slices form a consistent series."""
+        instance_numbers = [dcm.InstanceNumber for dcm in self.dcm_list]
+        if len(set(instance_numbers)) != len(instance_numbers):
+            msg = 'duplicate InstanceNumbers in series %s' % self.first_dcm.SeriesNumber
+            self.log and self.log.warning(msg) or print(msg)
+        if 'Rows' in self.first_dcm and 'Columns' in self.first_dcm:
+            for dcm in self.dcm_list:
+                if (dcm.Rows, dcm.Columns) != (self.first_dcm.Rows, self.first_dcm.Columns):
+                    raise DicomError('inconsistent image dimensions in series %s' % self.first_dcm.SeriesNumber)
+
+    @property
+    def pixel_dtype(self):
+        """Data type of the decoded pixel data, as derived from the header."""
+        return np.dtype('%sint%d' % ('' if self.first_dcm.PixelRepresentation else 'u', self.first_dcm.BitsAllocated))
+
+    @property
+    def image_data(self):
+        """Pixel data of all slices, stacked along the third axis, as (Columns, Rows, slices)."""
+        if self._image_data is None:
+            volumes = self.iter_volumes(np.arange(len(self.filenames))[:,np.newaxis])
+            self._image_data = volumes.next()
+            volumes.close()
+        return self._image_data
+
+    def iter_volumes(self, slice_index):
+        """
+        Yield volumes of pixel data, decoding each slice only when its volume is needed.
+
+        Column t of slice_index lists the positions in the ordered series of the slices making up volume t;
+        negative entries are zero-filled. Every volume is decoded, using num_workers processes, into the same
+        preallocated (Columns, Rows, slices) buffer, which is overwritten by the next volume.
+        """
+        shape = (self.first_dcm.Columns, self.first_dcm.Rows, slice_index.shape[0])
+        dtype = self.pixel_dtype
+        pool = None
+        if self.num_workers > 1 and slice_index.shape[0] > 1:
+            buf = multiprocessing.sharedctypes.RawArray('c', int(np.prod(shape)) * dtype.itemsize)
+            volume = np.frombuffer(buf, dtype=dtype).reshape(shape, order='F')
+            pool = multiprocessing.Pool(self.num_workers, _init_decode_worker, (buf, dtype, shape))
+        else:
+            volume = np.empty(shape, dtype=dtype, order='F')
+        try:
+            for vol_index in slice_index.T:
+                volume[:,:,vol_index < 0] = 0
+                decode_list = [(i, self.filenames[j]) for i, j in enumerate(vol_index) if j >= 0]
+                if pool:
+                    pool.map(_decode_slice, decode_list, chunksize=max(1, len(decode_list) / (4 * self.num_workers)))
+                else:
+                    for i, filename in decode_list:
+                        volume[:,:,i] = np.swapaxes(dicom.read_file(filename).pixel_array, 0, 1)
+                yield volume
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def convert(self, outbase, streaming=False, image_cnt=None, compression=niftiutil.DEFAULT_COMPRESSION):
+        """
+        Convert the series as appropriate for its image type.
+
+        If the expected number of images is given, the series may still be arriving and the nifti is written
+        incrementally; the other conversions then see the complete series.
+        """
         result = None
         main_file = None
         try:
@@ -92,6 +205,9 @@ class DicomSeries(object):
             msg = 'dicom conversion failed for %s: ImageType not set in dicom header' % os.path.basename(outbase)
             self.log and self.log.warning(msg) or print(msg)
         else:
+            if image_cnt and 'PRIMARY' in image_type:
+                main_file = self.to_nii_incremental(outbase, image_cnt, compression=compression)
+                self.refresh()
             if image_type == TYPE_SCREEN:
                 self.to_img(outbase)
                 result = 'bitmap'
@@ -99,7 +215,7 @@ class DicomSeries(object):
                 self.to_dti(outbase)
                 result = 'dti'
             if 'PRIMARY' in image_type:
-                main_file = self.to_nii(outbase)
+                main_file = main_file or self.to_nii(outbase, streaming, compression)
                 result = 'nifti'
             if not result:
                 msg = 'dicom conversion failed for %s: no applicable conversion defined' % os.path.basename(outbase)
@@ -108,7 +224,7 @@ class DicomSeries(object):
 
     def to_img(self, outbase):
         """Create bitmap files for each image in a list of dicoms."""
-        for i, pixels in enumerate([dcm.pixel_array for dcm in self.dcm_list]):
+        for i, pixels in enumerate([dicom.read_file(f).pixel_array for f in self.filenames]):
             filename = outbase + '_%d.png' % (i+1)
             with open(filename, 'wb') as fd:
                 if pixels.ndim == 2:
@@ -137,43 +253,56 @@ class DicomSeries(object):
             bvecs_file.write(' '.join(['%f' % value for value in bvecs[2,:]]) + '\n')
         self.log and self.log.debug('generated %s' % os.path.basename(filename))
 
-    def to_nii(self, outbase):
-        """Create a single nifti file from an ordered list of dicoms."""
-        flipped = False
-        slice_loc = [dcm_i.SliceLocation for dcm_i in self.dcm_list]
-        slice_num = [dcm_i.InstanceNumber for dcm_i in self.dcm_list]
-        image_position = [dcm_i.ImagePositionPatient for dcm_i in self.dcm_list]
-        image_data = np.dstack([np.swapaxes(dcm_i.pixel_array, 0, 1) for dcm_i in self.dcm_list])
-
-        unique_slice_loc = np.unique(slice_loc)
-        slices_per_volume = len(unique_slice_loc) # also: image[TAG_SLICES_PER_VOLUME].value
-        num_volumes = self.first_dcm.ImagesinAcquisition / slices_per_volume
-        dims = np.array((self.first_dcm.Rows, self.first_dcm.Columns, slices_per_volume, num_volumes))
+    def slice_index(self, slices_per_volume, num_volumes):
+        """
+        Return a (slices, volumes) array of the position of each slice in the ordered series.
 
+        Slices are assigned to volumes in acquisition order, except for multi-echo data, where all volumes of one
+        slice location are adjacent. Positions past the end of an incomplete series are set to -1.
+        """
         slices_total = len(self.dcm_list)
-
-        # If we can figure the dimensions out, reshape the matrix
-        if np.prod(dims) == np.size(image_data):
-            image_data = image_data.reshape(dims, order='F')
+        slice_loc = [dcm_i.SliceLocation for dcm_i in self.dcm_list]
+        if slices_per_volume * num_volumes == slices_total:
+            num_volumes_act = num_volumes
         else:
             self.log and self.log.debug("dimensions inconsistent with size, attempting to construct volume")
             # round up slices to nearest multiple of slices_per_volume
-            slices_total_rounded_up = ((slices_total + slices_per_volume - 1) / slices_per_volume) * slices_per_volume
-            slices_padding = slices_total_rounded_up - slices_total
-            if slices_padding: #LOOK AT THIS MORE CLOSELY TODO
+            num_volumes_act = (slices_total + slices_per_volume - 1) / slices_per_volume
+            if slices_per_volume * num_volumes_act > slices_total:
                 self.log and self.log.debug("dimensions indicate missing slices from volume - zero padding the gap")
-                padding = np.zeros((self.first_dcm.Rows, self.first_dcm.Columns, slices_padding))
-                image_data = np.dstack([image_data, padding])
-            volume_start_indices = range(0, slices_total_rounded_up, slices_per_volume)
-            image_data = np.concatenate([image_data[:,:,index:(index + slices_per_volume),np.newaxis] for index in volume_start_indices], axis=3)
-
-        # Check for multi-echo data where duplicate slices might be interleaved
-        # TODO: we only handle the 4d case here, but this could in theory happen with others.
-        if num_volumes>1 and slice_loc[0::num_volumes]==slice_loc[1::num_volumes] and image_data.ndim==4:
-            tmp = image_data.copy()
-            for vol_num in range(num_volumes):
-                image_data[:,:,:,vol_num] = tmp[:,:,vol_num::num_volumes,:].reshape(image_data.shape[0:3], order='F')
-
+        slice_index = np.arange(slices_per_volume * num_volumes_act)
+        # Check for multi-echo data where duplicate slices are interleaved
+        if num_volumes>1 and slice_loc[0::num_volumes]==slice_loc[1::num_volumes]:
+            slice_index = slice_index.reshape((slices_per_volume, num_volumes_act))
+        else:
+            slice_index = slice_index.reshape((slices_per_volume, num_volumes_act), order='F')
+        slice_index[slice_index >= slices_total] = -1
+        return slice_index
+
+    @staticmethod
+    def reorder(slices, slice_index, shape):
+        """
+        Gather a stack of slices into an array of the given shape, ordered as specified by slice_index.
+
+        The reordering is done as a single gather of whole slices, straight into the preallocated output;
+        negative entries of slice_index are zero-filled. If no reordering is needed, a reshaped view is returned.
+        """
+        if np.array_equal(slice_index.ravel(order='F'), np.arange(slices.shape[-1])):
+            return slices.reshape(shape, order='F')
+        image_data = np.empty(shape, dtype=slices.dtype, order='F')
+        slice_rows = slices.reshape((-1, slices.shape[-1]), order='F').T
+        output_rows = image_data.reshape((-1, slice_index.size), order='F').T
+        np.take(slice_rows, slice_index.ravel(order='F'), axis=0, out=output_rows, mode='clip')
+        image_data[:,:,slice_index < 0] = 0
+        return image_data
+
+    def nifti_header(self, slices_per_volume, dcm_list):
+        """
+        Return the nifti header for the series, and whether its slices have to be flipped.
+
+        The geometry is taken from the first and last of the given dicoms, the slice timing from the first volume.
+        """
+        image_position = [dcm_list[0].ImagePositionPatient, dcm_list[-1].ImagePositionPatient]
         mm_per_vox = np.hstack((self.first_dcm.PixelSpacing, self.first_dcm.SpacingBetweenSlices)).astype(float)
 
         row_cosines = self.first_dcm.ImageOrientationPatient[0:3]
@@ -193,13 +322,11 @@ class DicomSeries(object):
         qto_xyz[2,1] = col_cosines[2]
         qto_xyz[2,2] = slice_norm[2]
 
+        flipped = False
         if np.dot(slice_norm, image_position[0]) > np.dot(slice_norm, image_position[-1]):
             self.log and self.log.debug('flipping image order')
             flipped = True
-            slice_num = slice_num[::-1]
-            slice_loc = slice_loc[::-1]
             image_position = image_position[::-1]
-            image_data = image_data[:,:,::-1,:]
 
         pos = image_position[0]
         qto_xyz[:,3] = np.array((-pos[0], -pos[1], pos[2], 1)).T
@@ -213,8 +340,8 @@ class DicomSeries(object):
         nii_header['slice_start'] = 0
         nii_header['slice_end'] = slices_per_volume - 1
         slice_order = SLICE_ORDER_UNKNOWN
-        if slices_total >= slices_per_volume and 'TriggerTime' in self.first_dcm and self.first_dcm.TriggerTime != '':
-            first_volume = self.dcm_list[0:slices_per_volume]
+        if len(dcm_list) >= slices_per_volume and 'TriggerTime' in self.first_dcm and self.first_dcm.TriggerTime != '':
+            first_volume = dcm_list[0:slices_per_volume]
             trigger_times = np.array([dcm_i.TriggerTime for dcm_i in first_volume])
             trigger_times_from_first_slice = trigger_times[0] - trigger_times
             if slices_per_volume > 2:
@@ -235,16 +362,111 @@ class DicomSeries(object):
         nii_header.set_dim_info(*fps_dim)
 
         nii_header.structarr['pixdim'][4] = float(self.first_dcm.RepetitionTime) / 1000.
+        return nii_header, flipped
 
-        if image_data.dtype == np.dtype('int16'):
+    def to_nii(self, outbase, streaming=False, compression=niftiutil.DEFAULT_COMPRESSION):
+        """
+        Create a single nifti file from an ordered list of dicoms.
+
+        In streaming mode, each volume is written as soon as its slices are decoded, so that only one volume of
+        pixel data is held in memory at a time. The output is identical to that of the default mode.
+        The nifti is compressed as specified by compression (see niftiutil).
+        """
+        slice_loc = [dcm_i.SliceLocation for dcm_i in self.dcm_list]
+        slices_per_volume = len(np.unique(slice_loc)) # also: image[TAG_SLICES_PER_VOLUME].value
+        num_volumes = self.first_dcm.ImagesinAcquisition / slices_per_volume
+        slice_index = self.slice_index(slices_per_volume, num_volumes)
+
+        nii_header, flipped = self.nifti_header(slices_per_volume, self.dcm_list)
+        if flipped:
+            slice_index = slice_index[::-1,:]
+
+        # zero-padded (incomplete) series are stored as float
+        if self.pixel_dtype == np.dtype('int16') and (slice_index >= 0).all():
             nii_header.set_data_dtype(np.int16)
 
-        nifti = nibabel.Nifti1Image(image_data, None, nii_header)
-        filename = outbase + '.nii.gz'
-        nibabel.save(nifti, filename)
+        shape = (self.first_dcm.Rows, self.first_dcm.Columns) + slice_index.shape
+        if streaming:
+            filename = outbase + niftiutil.extension(compression)
+            with niftiutil.NiftiWriter(filename, nii_header, shape, nii_header.get_data_dtype(), compression) as writer:
+                for volume in self.iter_volumes(slice_index):
+                    writer.write(volume)
+        else:
+            image_data = self.reorder(self.image_data, slice_index, shape)
+            nifti = nibabel.Nifti1Image(image_data, None, nii_header)
+            filename = niftiutil.save(nifti, outbase, compression)
         self.log and self.log.debug('generated %s' % os.path.basename(filename))
         return filename
 
+    def to_nii_incremental(self, outbase, image_cnt, poll_interval=2, timeout=120, compression=niftiutil.DEFAULT_COMPRESSION):
+        """
+        Create a single nifti file from a series that is still being acquired.
+
+        Each volume is written as soon as all of its slices have arrived, so that the nifti is complete moments
+        after the last dicom of the series. The output is identical to that of to_nii() for the complete series.
+        Returns None, after discarding any partial output, if the series stalls for timeout seconds or if dicoms
+        arrive out of order; the caller should then fall back to to_nii().
+
+        Series that cannot be split into volumes up front, i.e., interleaved multi-echo data, are converted with
+        to_nii() once complete.
+        """
+        slices_per_volume = self.first_dcm[TAG_SLICES_PER_VOLUME].value if TAG_SLICES_PER_VOLUME in self.first_dcm else 0
+        if not slices_per_volume or image_cnt % slices_per_volume:
+            return self.wait_for(image_cnt, poll_interval, timeout) and self.to_nii(outbase, True, compression) or None
+        if not self.wait_for(slices_per_volume, poll_interval, timeout):
+            return None
+        num_volumes = image_cnt / slices_per_volume
+        first_volume = self.dcm_list[:slices_per_volume]
+        slice_loc = [dcm_i.SliceLocation for dcm_i in first_volume]
+        if len(np.unique(slice_loc)) != slices_per_volume:
+            return self.wait_for(image_cnt, poll_interval, timeout) and self.to_nii(outbase, True, compression) or None
+
+        nii_header, flipped = self.nifti_header(slices_per_volume, first_volume)
+        slice_index = np.arange(image_cnt).reshape((slices_per_volume, num_volumes), order='F')
+        if flipped:
+            slice_index = slice_index[::-1,:]
+        if self.pixel_dtype == np.dtype('int16'):
+            nii_header.set_data_dtype(np.int16)
+
+        shape = (self.first_dcm.Rows, self.first_dcm.Columns) + slice_index.shape
+        filename = outbase + niftiutil.extension(compression)
+        converted = []
+        volumes = self.iter_volumes(slice_index)
+        try:
+            with niftiutil.NiftiWriter(filename, nii_header, shape, nii_header.get_data_dtype(), compression) as writer:
+                for vol_num in range(num_volumes):
+                    slices_total = (vol_num + 1) * slices_per_volume
+                    if not self.wait_for(slices_total, poll_interval, timeout) or self.filenames[:len(converted)] != converted:
+                        raise DicomError('series %s incomplete or out of order' % self.first_dcm.SeriesNumber)
+                    writer.write(volumes.next())
+                    converted = self.filenames[:slices_total]
+                    self.log and self.log.debug('converted volume %d of %d' % (vol_num + 1, num_volumes))
+        except DicomError as ex:
+            self.log and self.log.debug('incremental conversion abandoned: %s' % ex)
+            os.remove(filename)
+            return None
+        finally:
+            volumes.close()
+        if self.filenames[:image_cnt] != converted:
+            os.remove(filename)
+            return None
+        self.log and self.log.debug('generated %s' % os.path.basename(filename))
+        return filename
+
+
+_decode_volume = None
+
+def _init_decode_worker(buf, dtype, shape):
+    """Attach a decode worker process to the shared volume buffer."""
+    global _decode_volume
+    _decode_volume = np.frombuffer(buf, dtype=dtype).reshape(shape, order='F')
+
+
+def _decode_slice(args):
+    """Decode the pixel data of one dicom file into its slot in the shared volume."""
+    i, filename = args
+    _decode_volume[:,:,i] = np.swapaxes(dicom.read_file(filename).pixel_array, 0, 1)
+
 
 class ArgumentParser(argparse.ArgumentParser):
 
@@ -253,9 +475,12 @@ class ArgumentParser(argparse.ArgumentParser):
         self.description = """Convert a directory of dicom images to a NIfTI or bitmap."""
         self.add_argument('dcm_dir', help='directory of dicoms to convert')
         self.add_argument('outbase', nargs='?', help='basename for output files (default: dcm_dir)')
+        self.add_argument('-w', '--workers', type=int, default=1, help='number of processes for decoding image data')
+        self.add_argument('-s', '--streaming', action='store_true', help='write nifti volume by volume to bound memory use')
+        self.add_argument('-z', '--compression', type=niftiutil.compression_spec, default=niftiutil.DEFAULT_COMPRESSION, help='nifti compression: none, gzip[:LEVEL] or pgzip[:LEVEL] (multi-threaded)')
 
 
 if __name__ == '__main__':
     args = ArgumentParser().parse_args()
-    dcm_series = DicomSeries(args.dcm_dir)
-    dcm_series.convert(args.outbase or os.path.basename(args.dcm_dir.rstrip('/')))
+    dcm_series = DicomSeries(args.dcm_dir, num_workers=args.workers)
+    dcm_series.convert(args.outbase or os.path.basename(args.dcm_dir.rstrip('/')), args.streaming, compression=args.compression)
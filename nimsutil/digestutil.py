@@ -0,0 +1,176 @@
+# @author:  Gunnar Schaefer
+
+"""
+Dataset digests computed from a per-file digest manifest.
+
+The manifest of a dataset directory is stored next to it, as <directory>.manifest, and records each file's size,
+mtime and digest; remove_dataset() removes both. Updating the manifest only hashes files that are new or whose size
+or mtime changed; the dataset digest is the SHA-1 of the manifest's sorted (filename, file digest) pairs.
+
+Files are hashed on an optional pool of threads (hashlib and zlib release the GIL), and read through mmap. Files
+larger than BLOCK_SIZE are hashed in blocks, which can be hashed concurrently; their digest is the hash of the
+concatenated block digests. Digests therefore do not depend on the number of threads.
+
+File digests are computed with one of:
+    sha1        cryptographic; the default
+    adler32     zlib's checksum; much faster, but only suited to change detection
+    xxh64       faster still; requires the xxhash module
+A manifest is rebuilt when a different hash is asked for, which changes the dataset digest. Without a hash, the one
+the manifest was built with is used, so that a digest update does not depend on knowing who built the manifest.
+"""
+
+import os
+import json
+import shutil
+import mmap
+import zlib
+import hashlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+READ_SIZE = 1 << 20         # files up to this size are read, larger ones are mapped
+BLOCK_SIZE = 1 << 26        # files larger than this are hashed in blocks; a multiple of mmap.ALLOCATIONGRANULARITY
+
+
+class Adler32(object):
+
+    """hashlib-style wrapper around zlib.adler32."""
+
+    def __init__(self):
+        self.value = zlib.adler32('')
+
+    def update(self, data):
+        self.value = zlib.adler32(data, self.value)
+
+    def hexdigest(self):
+        return '%08x' % (self.value & 0xffffffff)
+
+
+HASHES = {'sha1': hashlib.sha1, 'adler32': Adler32}
+if xxhash:
+    HASHES['xxh64'] = xxhash.xxh64
+DEFAULT_HASH = 'sha1'
+
+
+def _hash_block(args):
+    """Return the hex digest of length bytes of a file, starting at offset."""
+    filename, offset, length, hash_name = args
+    block_hash = HASHES[hash_name]()
+    with open(filename, 'rb') as fd:
+        if length <= READ_SIZE:
+            fd.seek(offset)
+            block_hash.update(fd.read(length))
+        else:
+            block = mmap.mmap(fd.fileno(), length, access=mmap.ACCESS_READ, offset=offset)
+            try:
+                block_hash.update(block)
+            finally:
+                block.close()
+    return block_hash.hexdigest()
+
+
+def hash_files(filenames, hash_name=DEFAULT_HASH, pool=None):
+    """
+    Return the hex digests of the given files, in order.
+
+    With a thread pool (e.g., multiprocessing.pool.ThreadPool), the files, and the blocks of large files, are
+    hashed concurrently.
+    """
+    blocks = []
+    block_cnts = []
+    for filename in filenames:
+        size = os.path.getsize(filename)
+        offsets = range(0, size, BLOCK_SIZE) or [0]
+        blocks += [(filename, offset, min(BLOCK_SIZE, size - offset), hash_name) for offset in offsets]
+        block_cnts.append(len(offsets))
+    block_digests = iter(pool.map(_hash_block, blocks, chunksize=1) if pool else map(_hash_block, blocks))
+    digests = []
+    for block_cnt in block_cnts:
+        file_digests = [block_digests.next() for i in range(block_cnt)]
+        if block_cnt == 1:
+            digests.append(file_digests[0])
+        else:
+            file_hash = HASHES[hash_name]()
+            file_hash.update(''.join(file_digests))
+            digests.append(file_hash.hexdigest())
+    return digests
+
+
+def hash_file(filename, hash_name=DEFAULT_HASH, pool=None):
+    """Return the hex digest of a file, as computed by hash_files()."""
+    return hash_files([filename], hash_name, pool)[0]
+
+
+class DigestManifest(object):
+
+    """
+    Per-file digests of the files in a directory, kept in <directory>.manifest.
+
+    Example:
+        file_cnt, digest = DigestManifest('/nims/data/123/00000123').update()
+
+    If hash_name is None, the hash recorded in the manifest is used, or DEFAULT_HASH for a new manifest.
+    """
+
+    def __init__(self, path, hash_name=None):
+        if hash_name is not None and hash_name not in HASHES:
+            raise ValueError('unknown hash %r; available hashes are %s' % (hash_name, ', '.join(sorted(HASHES))))
+        self.path = path.rstrip(os.sep)
+        self.filename = self.path + '.manifest'
+        self.hash_name = hash_name or DEFAULT_HASH
+        self.files = {}
+        try:
+            with open(self.filename) as fd:
+                manifest = json.load(fd)
+        except (IOError, ValueError):   # missing or unreadable manifests are rebuilt
+            pass
+        else:
+            if hash_name is None and manifest.get('hash') in HASHES:
+                self.hash_name = manifest['hash']
+            if manifest.get('hash') == self.hash_name:
+                self.files = manifest['files']
+
+    @property
+    def digest(self):
+        """The 20-byte dataset digest."""
+        return hashlib.sha1(''.join('%s\0%s\0' % (filename, self.files[filename][2]) for filename in sorted(self.files))).digest()
+
+    def update(self, pool=None):
+        """Hash new and changed files, drop removed ones and save the manifest; return file count and digest."""
+        files = {}
+        for filename in os.listdir(self.path):
+            stat = os.stat(os.path.join(self.path, filename))
+            entry = self.files.get(filename)
+            if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+                files[filename] = entry
+            else:
+                files[filename] = [stat.st_size, stat.st_mtime, None]
+        new_files = sorted(filename for filename in files if files[filename][2] is None)
+        for filename, digest in zip(new_files, hash_files([os.path.join(self.path, f) for f in new_files], self.hash_name, pool)):
+            files[filename][2] = digest
+        changed = bool(new_files) or len(files) != len(self.files)
+        self.files = files
+        if changed:
+            self.save()
+        return len(self.files), self.digest
+
+    def save(self):
+        """Write the manifest atomically."""
+        with open(self.filename + '.tmp', 'w') as fd:
+            json.dump({'hash': self.hash_name, 'files': self.files}, fd)
+        os.rename(self.filename + '.tmp', self.filename)
+
+
+def file_cnt_and_digest(path, hash_name=None, pool=None):
+    """Return the number of files in a directory and its dataset digest, updating its manifest (see DigestManifest)."""
+    return DigestManifest(path, hash_name).update(pool)
+
+
+def remove_dataset(path):
+    """Remove a dataset directory and its manifest."""
+    shutil.rmtree(path)
+    if os.path.exists(path.rstrip(os.sep) + '.manifest'):
+        os.remove(path.rstrip(os.sep) + '.manifest')
@@ -33,6 +33,86 @@ FORMAT_CHARS = {
 NODE_DICT = {}
 OBJECT_DICT = {}
 
+NUMPY_RUNTIME = r'''
+DTYPE_FORMATS = {'b': 'i1', 'h': '<i2', 'H': '<u2', 'i': '<i4', 'I': '<u4', 'Q': '<u8', 'f': '<f4', 'd': '<f8'}
+
+
+def _dtype_format(format_):
+    count, code = format_[:-1], format_[-1]
+    if code == 's':
+        return 'S' + (count or '1')     # a scalar char is one byte, but a bare 'S' has no width
+    return (DTYPE_FORMATS[code], int(count)) if count else DTYPE_FORMATS[code]
+
+_names = sorted(FIELDS, key=lambda name: FIELDS[name][0])
+HEADER_DTYPE = np.dtype({
+        'names': _names,
+        'formats': [_dtype_format(FIELDS[name][1]) for name in _names],
+        'offsets': [FIELDS[name][0] for name in _names],
+        'itemsize': HEADER_SIZE,
+        })
+
+STRUCTS = set()         # paths of structs, e.g., 'rec' or 'rec.dab[0]'
+ARRAY_LENGTHS = {}      # paths of arrays of structs or strings, e.g., 'rec.dab'
+for _name in FIELDS:
+    _parts = _name.split('.')
+    STRUCTS.update('.'.join(_parts[:i]) for i in range(1, len(_parts)))
+    for _path in ['.'.join(_parts[:i]) for i in range(1, len(_parts) + 1)]:
+        _match = re.match(r'(.*)\[(\d+)\]$', _path)
+        if _match:
+            ARRAY_LENGTHS[_match.group(1)] = max(ARRAY_LENGTHS.get(_match.group(1), 0), int(_match.group(2)) + 1)
+
+
+def _lookup(record, path):
+    if path in FIELDS:
+        value = record[path]
+        if isinstance(value, str):
+            return value.split('\x00', 1)[0]
+        elif isinstance(value, np.ndarray):
+            return tuple(value.tolist())
+        return value.item()
+    elif path in ARRAY_LENGTHS:
+        return [_lookup(record, '%s[%d]' % (path, i)) for i in range(ARRAY_LENGTHS[path])]
+    elif path in STRUCTS:
+        return HeaderStruct(record, path + '.')
+    raise KeyError(path)
+
+
+class HeaderStruct(object):
+
+    """Attribute access to a header record, e.g., header.image.tr; fields are decoded on first access."""
+
+    def __init__(self, record, prefix=''):
+        self._record = record
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            value = _lookup(self._record, self._prefix + name)
+        except KeyError:
+            raise AttributeError(name)
+        setattr(self, name, value)
+        return value
+
+
+def get_header(file_object):
+    if isinstance(file_object, basestring):
+        with open(file_object, 'rb') as fp:
+            buf = fp.read(HEADER_SIZE)
+        name = file_object
+    else:
+        buf = file_object.read(HEADER_SIZE)
+        name = file_object.name
+    if len(buf) < HEADER_SIZE:
+        raise PfheaderError, "Error reading header field in pfile %s" % name
+    pool_header = HeaderStruct(np.frombuffer(buf, HEADER_DTYPE, 1)[0])
+    logo = pool_header.rec.logo
+    if logo != "GE_MED_NMR" and logo != "INVALIDNMR":
+        raise PfheaderError, "%s is not a valid pfile" % name
+    return pool_header
+'''
+
 
 class Member:
 
@@ -150,6 +230,28 @@ def get_type(node):
     return object_
 
 
+def field_layout(type_, name='', offset=0):
+    """
+    Return (name, offset, format) of each leaf field of a type, laid out as the generated parser reads it (packed).
+
+    Names are dotted paths, e.g., 'image.tr' or 'rec.dab[0].start_rcv'. Arrays of fundamental types are one field.
+    """
+    if isinstance(type_, StructType):
+        layout = []
+        for member in type_.members:
+            layout += field_layout(member.type, name + '.' + member.name if name else member.name, offset)
+            offset += member.type.get_size()
+    elif isinstance(type_, ArrayType) and isinstance(type_.elem_type, (ArrayType, StructType)):
+        layout = []
+        for i in range(type_.num_elems):
+            layout += field_layout(type_.elem_type, '%s[%d]' % (name, i), offset + i * type_.elem_type.get_size())
+    elif isinstance(type_, ArrayType):
+        layout = [(name, offset, '%d%s' % (type_.num_elems, FORMAT_CHARS[type_.elem_type.type_name]))]
+    else:
+        layout = [(name, offset, FORMAT_CHARS[type_.type_name])]
+    return layout
+
+
 def get_pool_header(xml_path):
     all_children = list(et.parse(xml_path).iter())
     acceptable_children = filter(lambda element: element.tag in ACCEPTABLE_TYPES, all_children)
@@ -164,7 +266,7 @@ def get_pool_header(xml_path):
     return pool_header
 
 
-def print_parser(pool_header, object_dict):
+def print_parser(pool_header, object_dict, revision=None):
     objects = list(object_dict.itervalues())
     structs = set(filter(lambda object_: isinstance(object_, StructType), objects))
     print '\n"""AUTO-GENERATED FILE. DO NOT EDIT. USE %s"""\n' % os.path.basename(__file__)
@@ -173,6 +275,8 @@ def print_parser(pool_header, object_dict):
     print '\n'
     print 'class PfheaderError(Exception):'
     print '    pass'
+    print '\n'
+    print 'REVISION = %r' % revision
 
     for struct in structs:
         print '\n'
@@ -203,6 +307,33 @@ def print_parser(pool_header, object_dict):
     print '            file_object.close()'
     print '    return pool_header'
 
+    print '\n'
+    print_fields(pool_header)
+
+
+def print_fields(pool_header):
+    print '# offset and little-endian struct format of each leaf field, for decoding selected fields directly'
+    print 'FIELDS = {'
+    for name, offset, format_ in field_layout(pool_header):
+        print '    %r: (%d, %r),' % (name, offset, format_)
+    print '    }'
+
+
+def print_numpy_parser(pool_header, revision=None):
+    """Emit a parser that reads the whole header with one np.frombuffer() call into a flat structured dtype."""
+    print '\n"""AUTO-GENERATED FILE. DO NOT EDIT. USE %s"""\n' % os.path.basename(__file__)
+    print 'import re'
+    print 'import numpy as np'
+    print '\n'
+    print 'class PfheaderError(Exception):'
+    print '    pass'
+    print '\n'
+    print 'REVISION = %r' % revision
+    print 'HEADER_SIZE = %d' % pool_header.get_size()
+    print ''
+    print_fields(pool_header)
+    print NUMPY_RUNTIME,
+
 
 class ArgumentParser(argparse.ArgumentParser):
 
@@ -213,6 +344,8 @@ class ArgumentParser(argparse.ArgumentParser):
         self.description += 'To generate XML, run:\n'
         self.description += '    gccxml -fxml=pfheader.xml -include unistd.h -I../header_file -DREV22 writeathdr23.c'
         self.add_argument('xml_file', help='path to xml file')
+        self.add_argument('-r', '--revision', type=float, help='header revision (rec.rdbm_rev) the parser is for; save the output\nas pfheader_<revision>.py, e.g., pfheader_20_006.py, see pfheaders.py')
+        self.add_argument('-b', '--backend', choices=['struct', 'numpy'], default='struct', help='parser to emit: classes that unpack field by field (default),\nor one flat numpy structured dtype with lazy attribute access')
 
     def error(self, message):
         self.print_help()
@@ -222,4 +355,7 @@ class ArgumentParser(argparse.ArgumentParser):
 if __name__ == '__main__':
     args = ArgumentParser().parse_args()
     pool_header = get_pool_header(args.xml_file)
-    print_parser(pool_header, OBJECT_DICT)
+    if args.backend == 'numpy':
+        print_numpy_parser(pool_header, args.revision)
+    else:
+        print_parser(pool_header, OBJECT_DICT, args.revision)
@@ -0,0 +1,220 @@
+# @author:  Gunnar Schaefer
+
+"""
+Helpers for writing NIfTI files.
+
+Output compression is given as a string:
+    none            uncompressed .nii
+    gzip[:LEVEL]    .nii.gz, written with zlib at the given level (default: nibabel's level)
+    pgzip[:LEVEL]   .nii.gz, written as independently deflated blocks on several threads; the result is a
+                    standard gzip stream, slightly larger than that of gzip at the same level
+"""
+
+import os
+import time
+import zlib
+import struct
+import collections
+import multiprocessing
+import multiprocessing.pool
+
+import numpy as np
+import nibabel
+import nibabel.openers
+import nibabel.fileholders
+
+COMPRESSION_CODECS = ['none', 'gzip', 'pgzip']
+DEFAULT_COMPRESSION = 'gzip'
+
+
+def parse_compression(compression):
+    """Split a compression spec, e.g., 'gzip:6', into codec and level; the level is None if not given."""
+    codec, _, level = compression.partition(':')
+    if codec not in COMPRESSION_CODECS or (level and (codec == 'none' or not level.isdigit() or not 0 <= int(level) <= 9)):
+        raise ValueError('invalid nifti compression %r' % compression)
+    return codec, int(level) if level else None
+
+
+def compression_spec(compression):
+    """Validate a compression spec on the command line."""
+    parse_compression(compression)
+    return compression
+
+
+def extension(compression=DEFAULT_COMPRESSION):
+    """Return the filename extension of a nifti written with the given compression."""
+    return '.nii' if parse_compression(compression)[0] == 'none' else '.nii.gz'
+
+
+def open_nifti(filename, compression=DEFAULT_COMPRESSION):
+    """Open a nifti file for writing with the given compression."""
+    codec, level = parse_compression(compression)
+    if codec == 'none':
+        return open(filename, 'wb')
+    elif codec == 'pgzip':
+        return BlockGzipFile(filename, level if level is not None else nibabel.openers.Opener.default_compresslevel)
+    elif level is not None:
+        return nibabel.openers.Opener(filename, 'wb', compresslevel=level)
+    else:
+        return nibabel.openers.Opener(filename, 'wb')
+
+
+def save(nifti, outbase, compression=DEFAULT_COMPRESSION):
+    """Save a nifti image to outbase plus the extension for the given compression; return the filename."""
+    filename = outbase + extension(compression)
+    fileobj = open_nifti(filename, compression)
+    try:
+        nifti.to_file_map({'image': nibabel.fileholders.FileHolder(filename, fileobj)})
+    finally:
+        fileobj.close()
+    return filename
+
+
+def _deflate_block(args):
+    """Deflate one block of data, ending on a byte boundary so that blocks can be concatenated."""
+    data, compresslevel = args
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class BlockGzipFile(object):
+
+    """
+    Write-only gzip file that compresses blocks of data on a pool of threads.
+
+    zlib releases the GIL while compressing, so the blocks are deflated in parallel, and written in order as
+    they complete. Only the checksum is computed serially.
+    """
+
+    block_size = 1 << 20
+
+    def __init__(self, filename, compresslevel=1, num_threads=None):
+        self.name = filename
+        self.compresslevel = compresslevel
+        self.num_threads = num_threads or multiprocessing.cpu_count()
+        self.fileobj = open(filename, 'wb')
+        self.fileobj.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, zlib.DEFLATED, 0, int(time.time()), 0, 255))
+        self.pool = multiprocessing.pool.ThreadPool(self.num_threads)
+        self.pending = collections.deque()
+        self.buffer = []
+        self.buffer_size = 0
+        self.crc = zlib.crc32('') & 0xffffffff
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.fileobj.close()    # the caller deals with the incomplete file
+        else:
+            self.close()
+
+    @property
+    def closed(self):
+        return self.fileobj is None
+
+    def write(self, data):
+        data = str(data) if not isinstance(data, memoryview) else data.tobytes()
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+        self.size += len(data)
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= self.block_size:
+            self._flush_buffer()
+
+    def read(self, size=-1):
+        raise IOError('%s is open for writing only' % self.name)
+
+    def tell(self):
+        return self.size
+
+    def seek(self, offset, whence=0):
+        """Only seeking forward is possible; the gap is filled with zeros."""
+        if whence == 1:
+            offset += self.size
+        if whence == 2 or offset < self.size:
+            raise IOError('%s can only seek forward' % self.name)
+        self.write('\x00' * (offset - self.size))
+
+    def flush(self):
+        pass
+
+    def _flush_buffer(self):
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffer_size = 0
+        for start in range(0, len(data), self.block_size):
+            self.pending.append(self.pool.apply_async(_deflate_block, ((data[start:start+self.block_size], self.compresslevel),)))
+        while len(self.pending) > 2 * self.num_threads:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def close(self):
+        if self.fileobj is None:
+            return
+        try:
+            self._flush_buffer()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().get())
+            self.fileobj.write(zlib.compressobj(self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS).flush(zlib.Z_FINISH))
+            self.fileobj.write(struct.pack('<II', self.crc, self.size & 0xffffffff))
+        finally:
+            self.pool.close()
+            self.pool.join()
+            self.fileobj.close()
+            self.fileobj = None
+
+
+class NiftiWriter(object):
+
+    """
+    Write a single-file NIfTI-1 image one volume at a time.
+
+    Only the volume currently being written needs to be held in memory. The output is the same as that of
+    nibabel.save() for an unscaled image with the same header, shape and data type.
+
+    Example:
+        writer = NiftiWriter('func.nii.gz', nii_header, (64, 64, 30, 200), np.int16)
+        for volume in volumes:
+            writer.write(volume)
+        writer.close()
+    """
+
+    def __init__(self, filename, header, shape, dtype, compression=DEFAULT_COMPRESSION):
+        self.filename = filename
+        self.header = nibabel.Nifti1Header.from_header(header)
+        self.header.set_data_shape(shape)
+        self.header.set_data_dtype(dtype)
+        self.header.set_slope_inter(1.0, 0.0)
+        self.dtype = self.header.get_data_dtype()
+        self.volume_shape = tuple(shape[:3])
+        self.volumes_total = int(np.prod(shape[3:]))
+        self.volumes_written = 0
+        self.fileobj = open_nifti(filename, compression)
+        self.header.write_to(self.fileobj)
+        self.fileobj.write('\x00' * (self.header.get_data_offset() - self.fileobj.tell()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.fileobj.close()    # the caller deals with the incomplete file
+        else:
+            self.close()
+
+    def write(self, volume):
+        """Append one volume; the volume's elements are written in Fortran order."""
+        if self.volumes_written >= self.volumes_total:
+            raise ValueError('%s already holds %d volumes' % (self.filename, self.volumes_total))
+        if volume.size != np.prod(self.volume_shape):
+            raise ValueError('volume size %d does not match %s' % (volume.size, self.volume_shape))
+        self.fileobj.write(np.asarray(volume, dtype=self.dtype).tostring(order='F'))
+        self.volumes_written += 1
+
+    def close(self):
+        """Close the file; if it holds fewer volumes than its header declares, remove it and raise ValueError."""
+        self.fileobj.close()
+        if self.volumes_written != self.volumes_total:
+            os.remove(self.filename)
+            raise ValueError('%s holds %d of %d volumes' % (self.filename, self.volumes_written, self.volumes_total))
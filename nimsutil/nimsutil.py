@@ -8,6 +8,7 @@ import re
 import glob
 import shutil
 import difflib
+import collections
 import datetime
 import tempfile
 import logging, logging.handlers
@@ -27,6 +28,40 @@ class TempDirectory:
         shutil.rmtree(self.temp_dir)
 
 
+class LRUCache(object):
+
+    """Dictionary-like cache that holds at most max_size items, evicting the least recently used."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.items.pop(key, default)
+
+    def clear(self):
+        self.items.clear()
+
+
 def get_logger(name, filename=None, level='debug'):
     """Return a nims-configured logger."""
     logging._levelNames[10] = 'DBUG'
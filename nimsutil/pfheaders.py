@@ -0,0 +1,73 @@
+# @author:  Gunnar Schaefer
+
+"""
+Parse pfile headers with the parser for their header revision.
+
+Every pfile starts with its header revision (rec.rdbm_rev), a float. Parsers for specific revisions are pfheader
+modules generated with mkpfheader.py and saved in this package as pfheader_<revision>, with the decimal point
+replaced by an underscore, e.g.:
+    mkpfheader.py --revision 20.006 pfheader20.xml > nimsutil/pfheader_20_006.py
+    mkpfheader.py --revision 22 pfheader22.xml > nimsutil/pfheader_22.py
+A plain pfheader module, if present, parses all revisions that have no parser of their own. Parsers are imported
+on first use and cached.
+"""
+
+import struct
+
+REVISION_STRUCT = struct.Struct('<f')
+PARSERS = {}    # revision -> parser module, or None
+
+
+class PfheaderError(Exception):
+    pass
+
+
+class UnknownRevisionError(PfheaderError):
+    pass
+
+
+def read_revision(filename):
+    """Return the header revision of a pfile, rounded to 3 decimals, or None if the file does not start with one."""
+    with open(filename, 'rb') as fp:
+        buf = fp.read(REVISION_STRUCT.size)
+    if len(buf) < REVISION_STRUCT.size:
+        return None
+    revision = REVISION_STRUCT.unpack(buf)[0]
+    return round(revision, 3) if 5 <= revision < 100 else None
+
+
+def module_name(revision):
+    return 'pfheader_' + ('%.3f' % revision).rstrip('0').rstrip('.').replace('.', '_')
+
+
+def _import(name):
+    try:
+        return __import__(name, globals())
+    except ImportError:
+        return None
+
+
+def get_parser(revision):
+    """Return the parser module for a header revision."""
+    if revision not in PARSERS:
+        PARSERS[revision] = _import(module_name(revision)) or _import('pfheader')
+    if not PARSERS[revision]:
+        raise UnknownRevisionError('no parser for pfile header revision %s' % revision)
+    return PARSERS[revision]
+
+
+def get_parser_for(filename):
+    """Return the parser module for a pfile."""
+    revision = read_revision(filename)
+    if revision is None:
+        raise PfheaderError('%s is not a pfile' % filename)
+    return get_parser(revision)
+
+
+def get_header(filename, parser=None):
+    """Parse the header of a pfile, with the given parser or the one for its revision."""
+    parser = parser or get_parser_for(filename)
+    try:
+        return parser.get_header(filename)
+    except parser.PfheaderError as e:
+        raise PfheaderError(str(e))
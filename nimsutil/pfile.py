@@ -6,7 +6,9 @@
 from __future__ import print_function
 
 import os
+import re
 import shlex
+import struct
 import shutil
 import argparse
 import datetime
@@ -16,13 +18,128 @@ import subprocess as sp
 import numpy as np
 import nibabel
 
-import pfheader
+import pfheaders
+import niftiutil
 
 
 class PFileError(Exception):
     pass
 
 
+# header fields used by PFile.load_header
+PROBE_FIELDS = [
+        'rec.logo', 'rec.nslices', 'rec.dab[0].start_rcv', 'rec.dab[0].stop_rcv', 'rec.nechoes', 'rec.npasses',
+        'rec.im_size', 'rec.scan_date', 'rec.scan_time', 'rec.user0', 'rec.user2', 'rec.user6', 'rec.user8', 'rec.user15',
+        'exam.patidff', 'exam.patnameff', 'exam.dateofbirth', 'exam.ex_no', 'exam.study_uid',
+        'series.se_no', 'series.series_uid', 'series.se_desc',
+        'image.tr', 'image.dim_X', 'image.dim_Y', 'image.dfov', 'image.dfov_rect', 'image.psdname', 'image.psd_iname',
+        'image.scanactno', 'image.im_datetime', 'image.slquant', 'image.slthick', 'image.scanspacing',
+        ]
+
+
+class HeaderStruct(object):
+    pass
+
+
+class HeaderProbe(object):
+
+    """
+    Read selected pfile header fields with a single read and a single precompiled struct.Struct.
+
+    The result has the same attribute structure as the header returned by the parser's get_header(), e.g.,
+    header.image.tr, but only holds the selected fields. Requires a parser generated with field offsets.
+    """
+
+    def __init__(self, parser, fields):
+        layout = sorted(parser.FIELDS[field] + (field,) for field in fields)
+        format_ = '<'
+        position = 0
+        self.fields = []
+        for offset, field_format, field in layout:
+            format_ += '%dx%s' % (offset - position, field_format)
+            position = offset + struct.calcsize('<' + field_format)
+            count = int(field_format[:-1] or 1) if field_format[-1] != 's' else 1
+            self.fields.append((re.findall(r'(\w+)(?:\[(\d+)\])?', field), count, field_format[-1] == 's'))
+        self.struct = struct.Struct(format_)
+
+    def read(self, filename):
+        with open(filename, 'rb') as fp:
+            buf = fp.read(self.struct.size)
+        if len(buf) < self.struct.size:
+            raise PFileError('%s is too short for a pfile' % filename)
+        values = iter(self.struct.unpack(buf))
+        header = HeaderStruct()
+        for path, count, is_string in self.fields:
+            value = [values.next() for i in range(count)] if count > 1 else values.next()
+            self.set_field(header, path, value.split('\x00', 1)[0] if is_string else value)
+        if header.rec.logo not in ('GE_MED_NMR', 'INVALIDNMR'):
+            raise PFileError('%s is not a valid pfile' % filename)
+        return header
+
+    @staticmethod
+    def set_field(obj, path, value):
+        for i, (attr, index) in enumerate(path):
+            last = i == len(path) - 1
+            if index:
+                items = obj.__dict__.setdefault(attr, [])
+                items.extend(HeaderStruct() for j in range(int(index) + 1 - len(items)))
+                if last:
+                    items[int(index)] = value
+                obj = items[int(index)]
+            elif last:
+                setattr(obj, attr, value)
+            else:
+                obj = obj.__dict__.setdefault(attr, HeaderStruct())
+
+
+def kspace_memmap(filename, header):
+    """
+    Memory-map the raw k-space data of a pfile, as an (echo, slice, frame, receiver, view, sample) array.
+
+    GE stores the data receiver by receiver, each as rec.nslices blocks of rec.nechoes echoes, where rec.nslices
+    counts the slices of all rec.npasses frames. Every echo starts with a baseline view, which is skipped. Samples are
+    complex pairs of rec.point_size-byte integers; the array has a structured ('real', 'imag') dtype.
+    """
+    rec = header.rec
+    try:
+        num_receivers = rec.dab[0].stop_rcv - rec.dab[0].start_rcv + 1
+        num_frames = max(rec.npasses, 1)
+        num_views = rec.nframes + rec.hnover
+        rec.point_size, rec.frame_size, rec.off_data
+    except AttributeError:  # probed header, or a header revision without rec.off_data
+        raise PFileError('the header of %s does not describe its k-space data' % filename)
+    if rec.point_size not in (2, 4) or rec.nslices % num_frames:
+        raise PFileError('%s has an unsupported k-space layout' % filename)
+    itype = '<i%d' % rec.point_size
+    dtype = np.dtype([('real', itype), ('imag', itype)])
+    shape = (num_receivers, num_frames, rec.nslices / num_frames, rec.nechoes, num_views + 1, rec.frame_size)
+    if rec.off_data + np.prod(shape) * dtype.itemsize > os.path.getsize(filename):
+        raise PFileError('%s is too short for its k-space data' % filename)
+    kspace = np.memmap(filename, dtype=dtype, mode='r', offset=rec.off_data, shape=shape)
+    return kspace.transpose((3, 2, 1, 0, 4, 5))[:, :, :, :, 1:, :]
+
+
+PROBES = {}     # parser module -> HeaderProbe of PROBE_FIELDS, or None
+
+
+def header_probe(parser):
+    """Return the cached probe of PROBE_FIELDS for a pfheader parser, or None if the parser has no field offsets."""
+    if parser not in PROBES:
+        PROBES[parser] = HeaderProbe(parser, PROBE_FIELDS) if hasattr(parser, 'FIELDS') else None
+    return PROBES[parser]
+
+
+def is_unsupported(filename):
+    """Return True if a file looks like a pfile of a header revision that no parser is available for."""
+    try:
+        pfheaders.get_parser_for(filename)
+    except pfheaders.UnknownRevisionError:
+        return True
+    except (IOError, pfheaders.PfheaderError):
+        pass
+    return False
+
+
 class PFile(object):
     """
     Read pfile data and/or header.
@@ -36,22 +153,35 @@ class PFile(object):
         pf.to_nii(outbase='P56832.7')
     """
 
-    def __init__(self, pfilename, log=None):
+    def __init__(self, pfilename, log=None, probe=False):
+        """With probe, only the header fields that load_header() needs are read; such a PFile cannot be converted."""
         self.pfilename = pfilename
         self.log = log
-        self.load_header()
+        self.load_header(probe)
         self.image_data = None
         self.fm_data = None
+        self._kspace = None
+
+    @property
+    def kspace(self):
+        """The raw k-space data, memory-mapped on first access (see kspace_memmap)."""
+        if self._kspace is None:
+            self._kspace = kspace_memmap(self.pfilename, self.header)
+        return self._kspace
 
-    def load_header(self):
+    def load_header(self, probe=False):
 
         def unpack_uid(uid):
             """Convert packed PFile UID to standard DICOM UID."""
             return ''.join([str(i-1) if i < 11 else '.' for pair in [(ord(c) >> 4, ord(c) & 15) for c in uid] for i in pair if i > 0])
 
         try:
-            self.header = pfheader.get_header(self.pfilename)
-        except (IOError, pfheader.PfheaderError):
+            parser = pfheaders.get_parser_for(self.pfilename)
+            if probe and header_probe(parser):
+                self.header = header_probe(parser).read(self.pfilename)
+            else:
+                self.header = pfheaders.get_header(self.pfilename, parser)
+        except (IOError, pfheaders.PfheaderError):
             raise PFileError
 
         self.tr = self.header.image.tr / 1e6  # tr in seconds
@@ -144,8 +274,8 @@ class PFile(object):
             self.log and self.log.warning(msg) or print(msg)
             self.num_timepoints = self.image_data.shape[3]
 
-    def to_nii(self, outbase, spirec='spirec', saveInOut=False):
-        """Create NIFTI file from pfile."""
+    def to_nii(self, outbase, spirec='spirec', saveInOut=False, compression=niftiutil.DEFAULT_COMPRESSION):
+        """Create NIFTI file from pfile, compressed as specified by compression (see niftiutil)."""
         if self.image_data is None:
             self.recon(spirec)
 
@@ -236,13 +366,13 @@ class PFile(object):
 
         if self.num_echoes == 1:
             nifti = nibabel.Nifti1Image(self.image_data, None, nii_header)
-            nibabel.save(nifti, outbase + '.nii.gz')
+            niftiutil.save(nifti, outbase, compression)
         elif self.num_echoes == 2:
             if saveInOut:
                 nifti = nibabel.Nifti1Image(self.image_data[:,:,:,:,0], None, nii_header)
-                nibabel.save(nifti, outbase + '_in.nii.gz')
+                niftiutil.save(nifti, outbase + '_in', compression)
                 nifti = nibabel.Nifti1Image(self.image_data[:,:,:,:,1], None, nii_header)
-                nibabel.save(nifti, outbase + '_out.nii.gz')
+                niftiutil.save(nifti, outbase + '_out', compression)
             # FIXME: Do a more robust test for spiralio!
             # Assume spiralio, so do a weighted average of the two echos.
             # FIXME: should do a quick motion correction here
@@ -255,17 +385,17 @@ class PFile(object):
             for tp in range(self.image_data.shape[3]):
                 avg[:,:,:,tp] = w_in*self.image_data[:,:,:,tp,0] + w_out*self.image_data[:,:,:,tp,1]
             nifti = nibabel.Nifti1Image(avg, None, nii_header)
-            nibabel.save(nifti, outbase + '.nii.gz')
+            niftiutil.save(nifti, outbase, compression)
         else:
             for echo in range(self.num_echoes):
                 nifti = nibabel.Nifti1Image(self.image_data[:,:,:,:,echo], None, nii_header)
-                nibabel.save(nifti, outbase + '_echo%02d.nii.gz' % echo)
+                niftiutil.save(nifti, outbase + '_echo%02d' % echo, compression)
 
         if self.fm_data is not None:
             nii_header.structarr['cal_max'] = self.fm_data.max()
             nii_header.structarr['cal_min'] = self.fm_data.min()
             nifti = nibabel.Nifti1Image(self.fm_data, None, nii_header)
-            nibabel.save(nifti, outbase + '_B0.nii.gz')
+            niftiutil.save(nifti, outbase + '_B0', compression)
 
     def recon(self, spirec):
         """Do image reconstruction and populate self.image_data."""
@@ -279,9 +409,10 @@ class PFile(object):
         self.log and self.log.debug(cmd)
         sp.call(shlex.split(cmd), cwd=tmpdir, stdout=open('/dev/null', 'w'))
 
-        self.image_data = np.fromfile(file=basepath+'.mag_float', dtype=np.float32).reshape([self.size_x,self.size_y,self.num_timepoints,self.num_echoes,self.num_slices],order='F').transpose((0,1,4,2,3))
+        # memory-mapped, so the outputs are paged in as the NIfTI files are written; the mappings outlive the tmpdir
+        self.image_data = np.memmap(basepath+'.mag_float', dtype=np.float32, mode='r', shape=(self.size_x,self.size_y,self.num_timepoints,self.num_echoes,self.num_slices), order='F').transpose((0,1,4,2,3))
         if os.path.exists(basepath+'.B0freq2') and os.path.getsize(basepath+'.B0freq2')>0:
-            self.fm_data = np.fromfile(file=basepath+'.B0freq2', dtype=np.float32).reshape([self.size_x,self.size_y,self.num_echoes,self.num_slices],order='F').transpose((0,1,3,2))
+            self.fm_data = np.memmap(basepath+'.B0freq2', dtype=np.float32, mode='r', shape=(self.size_x,self.size_y,self.num_echoes,self.num_slices), order='F').transpose((0,1,3,2))
         shutil.rmtree(tmpdir)
 
 
@@ -295,6 +426,7 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('pfile', help='path to pfile')
         self.add_argument('outbase', nargs='?', help='basename for output files (default: [pfile_name].nii.gz in cwd)')
         self.add_argument('-m', '--matfile', help='path to reconstructed data in .mat format')
+        self.add_argument('-z', '--compression', type=niftiutil.compression_spec, default=niftiutil.DEFAULT_COMPRESSION, help='nifti compression: none, gzip[:LEVEL] or pgzip[:LEVEL] (multi-threaded)')
 
 
 if __name__ == '__main__':
@@ -302,4 +434,4 @@ if __name__ == '__main__':
     pf = PFile(args.pfile)
     if args.matfile:
         pf.set_image_data(args.matfile)
-    pf.to_nii(args.outbase or os.path.basename(args.pfile))
+    pf.to_nii(args.outbase or os.path.basename(args.pfile), compression=args.compression)
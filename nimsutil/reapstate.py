@@ -0,0 +1,117 @@
+# @author:  Gunnar Schaefer
+
+"""
+Persistent reaper state, in an SQLite database.
+
+The state holds the reference datetime of a reaper, and the status of every item it has reaped or started to reap.
+Items are identified by a kind and a key, e.g., ('series', series_uid) or ('file', path), and may belong to a parent,
+e.g., the images of a series. Their size and modification time, where known, tell a reaped item from a changed one.
+
+Example:
+    state = ReapState('/var/local/nims/.scanner.state', legacy_datetime_file='/var/local/nims/.scanner.datetime')
+    if not state.is_reaped('file', path, size, mtime):
+        reap(path)
+        state.mark('file', path, REAPED, size=size, mtime=mtime)
+"""
+
+import os
+import time
+import sqlite3
+import datetime
+import threading
+
+PENDING = 'pending'
+REAPED = 'reaped'
+RETENTION = 30 * 86400      # seconds to remember items after they were last updated
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reference (id INTEGER PRIMARY KEY CHECK (id = 0), datetime TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS items (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    parent TEXT,
+    status TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+CREATE INDEX IF NOT EXISTS items_by_parent ON items (kind, parent);
+"""
+
+
+class ReapState(object):
+
+    """
+    Reaper state in an SQLite database; ':memory:' keeps it in memory only.
+
+    A legacy datetime file, as written by nimsutil.update_reference_datetime, seeds the reference datetime of a new
+    state. Every update is committed immediately; the database is safe to use from several threads.
+    """
+
+    def __init__(self, filename, legacy_datetime_file=None):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        if legacy_datetime_file and os.access(legacy_datetime_file, os.R_OK) and not self.get_reference_datetime():
+            with open(legacy_datetime_file) as fd:
+                self.set_reference_datetime(datetime.datetime.strptime(fd.readline(), '%c\n'))
+
+    def execute(self, sql, args=(), many=False):
+        with self.lock:
+            with self.db:
+                return (self.db.executemany if many else self.db.execute)(sql, args).fetchall()
+
+    def get_reference_datetime(self, default=None):
+        """Return the reference datetime; a default is stored as the reference datetime of a new state."""
+        rows = self.execute('SELECT datetime FROM reference')
+        if rows:
+            return datetime.datetime.strptime(rows[0][0], DATETIME_FORMAT)
+        if default:
+            self.set_reference_datetime(default)
+        return default
+
+    def set_reference_datetime(self, new_datetime):
+        self.execute('INSERT OR REPLACE INTO reference VALUES (0, ?)', (new_datetime.strftime(DATETIME_FORMAT),))
+
+    def mark(self, kind, key, status, parent=None, size=None, mtime=None):
+        self.mark_many(kind, [key], status, parent, size, mtime)
+
+    def mark_many(self, kind, keys, status, parent=None, size=None, mtime=None):
+        """Set the status of several items of the same kind and parent, in one transaction."""
+        now = time.time()
+        self.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?)', [(kind, key, parent, status, size, mtime, now) for key in keys], many=True)
+
+    def get(self, kind, key):
+        """Return the (status, size, mtime) of an item, or None if it is unknown."""
+        rows = self.execute('SELECT status, size, mtime FROM items WHERE kind = ? AND key = ?', (kind, key))
+        return rows[0] if rows else None
+
+    def is_reaped(self, kind, key, size=None, mtime=None):
+        """Return True if an item has been reaped, and, where given, still has the same size and modification time."""
+        item = self.get(kind, key)
+        return bool(item) and item[0] == REAPED and size in (None, item[1]) and mtime in (None, item[2])
+
+    def keys(self, kind, parent=None, status=REAPED):
+        """Return the set of keys of the items of a kind, and parent, if given, that have a status."""
+        if parent is None:
+            rows = self.execute('SELECT key FROM items WHERE kind = ? AND status = ?', (kind, status))
+        else:
+            rows = self.execute('SELECT key FROM items WHERE kind = ? AND parent = ? AND status = ?', (kind, parent, status))
+        return set(row[0] for row in rows)
+
+    def forget_before(self, kind, timestamp):
+        """Remove the items of a kind that were last updated before a unix timestamp."""
+        self.execute('DELETE FROM items WHERE kind = ? AND updated < ?', (kind, timestamp))
+
+    def forget_expired(self, kind, reference_datetime, retention=RETENTION):
+        """Remove the items of a kind that were last updated more than retention seconds before a reference datetime."""
+        self.forget_before(kind, time.mktime(reference_datetime.timetuple()) - retention)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# @author:  Gunnar Schaefer
+
+"""
+Benchmark the slice reordering of DicomSeries.to_nii against the previous implementation.
+
+Runs on a synthetic stack of slices (no dicom files needed), e.g.:
+    python -m nimsutil.tests.bench_dicomutil --shape 128 128 60 500
+"""
+
+from __future__ import print_function
+
+import time
+import argparse
+
+import numpy as np
+
+from nimsutil import dicomutil
+
+
+def legacy_reorder(slices, shape, multi_echo, flipped):
+    """The reshape/concatenate/copy-and-loop reordering that DicomSeries.to_nii used to do."""
+    rows, cols, slices_per_volume, num_volumes = shape
+    slices_total = slices.shape[2]
+    image_data = slices
+    if np.prod(shape) == np.size(image_data):
+        image_data = image_data.reshape(shape, order='F')
+    else:
+        slices_total_rounded_up = ((slices_total + slices_per_volume - 1) / slices_per_volume) * slices_per_volume
+        slices_padding = slices_total_rounded_up - slices_total
+        if slices_padding:
+            padding = np.zeros((rows, cols, slices_padding))
+            image_data = np.dstack([image_data, padding])
+        volume_start_indices = range(0, slices_total_rounded_up, slices_per_volume)
+        image_data = np.concatenate([image_data[:,:,index:(index + slices_per_volume),np.newaxis] for index in volume_start_indices], axis=3)
+    if multi_echo:
+        tmp = image_data.copy()
+        for vol_num in range(num_volumes):
+            image_data[:,:,:,vol_num] = tmp[:,:,vol_num::num_volumes,:].reshape(image_data.shape[0:3], order='F')
+    if flipped:
+        image_data = image_data[:,:,::-1,:]
+    return np.ascontiguousarray(image_data.T).T     # nibabel.save needs the data in memory anyway
+
+
+def slice_index(slices_per_volume, num_volumes, slices_total, multi_echo, flipped):
+    """The slice index DicomSeries.slice_index computes for the given layout."""
+    num_volumes_act = (slices_total + slices_per_volume - 1) / slices_per_volume
+    index = np.arange(slices_per_volume * num_volumes_act)
+    if multi_echo:
+        index = index.reshape((slices_per_volume, num_volumes_act))
+    else:
+        index = index.reshape((slices_per_volume, num_volumes_act), order='F')
+    index[index >= slices_total] = -1
+    return index[::-1,:] if flipped else index
+
+
+def run(shape, missing, multi_echo, flipped):
+    rows, cols, slices_per_volume, num_volumes = shape
+    slices_total = slices_per_volume * num_volumes - missing
+    slices = np.empty((rows, cols, slices_total), dtype=np.int16, order='F')
+    for i in range(0, slices_total, slices_per_volume):
+        slices[:,:,i:i+slices_per_volume] = np.random.randint(0, 4096, size=slices[:,:,i:i+slices_per_volume].shape)
+    desc = '%d vols, %s%s%s' % (num_volumes, 'multi-echo' if multi_echo else 'single-echo', ', flipped' if flipped else '', ', %d missing' % missing if missing else '')
+    try:
+        legacy_slices = slices.copy(order='F')     # the old multi-echo loop reorders in place
+        start = time.time()
+        expected = legacy_reorder(legacy_slices, shape, multi_echo, flipped)
+        legacy_time = time.time() - start
+    except ValueError:
+        expected = None
+        legacy_time = np.nan
+    start = time.time()
+    index = slice_index(slices_per_volume, num_volumes, slices_total, multi_echo, flipped)
+    result = dicomutil.DicomSeries.reorder(slices, index, (rows, cols) + index.shape)
+    gather_time = time.time() - start
+    if expected is None:
+        expected = slices[:,:,index.clip(0)]
+        expected[:,:,index < 0] = 0
+    assert np.array_equal(expected, result)
+    if np.isnan(legacy_time):
+        print('%-44s legacy   fails   gather %7.2fs' % (desc, gather_time))
+    else:
+        print('%-44s legacy %7.2fs   gather %7.2fs   speedup %5.1fx' % (desc, legacy_time, gather_time, legacy_time / gather_time))
+
+
+class ArgumentParser(argparse.ArgumentParser):
+
+    def __init__(self):
+        super(ArgumentParser, self).__init__()
+        self.description = """Benchmark slice reordering on a synthetic series."""
+        self.add_argument('--shape', type=int, nargs=4, default=[128, 128, 60, 500], metavar=('X', 'Y', 'Z', 'T'), help='series dimensions')
+        self.add_argument('--missing', type=int, default=7, help='number of missing slices for the zero-padding case')
+
+
+if __name__ == '__main__':
+    args = ArgumentParser().parse_args()
+    print('series %s, %.0f MB of int16' % ('x'.join(map(str, args.shape)), np.prod(args.shape) * 2. / 2**20))
+    run(args.shape, 0, False, False)
+    run(args.shape, 0, False, True)
+    run(args.shape, 0, True, True)
+    # the old multi-echo loop only worked if slices_per_volume was a multiple of num_volumes
+    num_volumes = max([n for n in range(1, args.shape[3] + 1) if args.shape[2] % n == 0])
+    run(args.shape[:3] + [num_volumes], 0, True, True)
+    run(args.shape, args.missing, False, True)
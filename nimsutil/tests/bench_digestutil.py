@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# @author:  Gunnar Schaefer
+
+"""
+Benchmark dataset hashing with digestutil against the single-threaded whole-content hash Dataset used to compute.
+
+Creates a many-small-file and a few-huge-file dataset in a scratch directory and hashes each from the page cache
+(the first, untimed pass warms the cache), e.g.:
+    python -m nimsutil.tests.bench_digestutil --small 50000 65536 --huge 4 1073741824 --threads 8
+"""
+
+from __future__ import print_function
+
+import os
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import multiprocessing
+import multiprocessing.pool
+
+from nimsutil import digestutil
+
+
+def legacy_digest(path):
+    """The hash Dataset.update_file_cnt_and_digest used to compute."""
+    new_hash = hashlib.sha1()
+    filelist = os.listdir(path)
+    for filename in sorted(filelist):
+        with open(os.path.join(path, filename), 'rb') as fd:
+            for chunk in iter(lambda: fd.read(1048576 * new_hash.block_size), ''):
+                new_hash.update(chunk)
+    return len(filelist), new_hash.digest()
+
+
+def make_dataset(path, file_cnt, file_size):
+    os.mkdir(path)
+    data = os.urandom(min(file_size, 1 << 24))
+    for i in range(file_cnt):
+        with open(os.path.join(path, '%06d' % i), 'wb') as fd:
+            for written in range(0, file_size, len(data)):
+                fd.write(data[:file_size - written])
+
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def run(path, threads, hash_names):
+    size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)) / 2.**20
+    legacy_digest(path)
+    legacy_time = timed(legacy_digest, path)
+    print('  %-26s %8.2fs  %8.0f MB/s' % ('legacy sha1', legacy_time, size / legacy_time))
+    for hash_name in hash_names:
+        for num_threads in sorted(set([1, threads])):
+            pool = multiprocessing.pool.ThreadPool(num_threads) if num_threads > 1 else None
+            if os.path.exists(path + '.manifest'):
+                os.remove(path + '.manifest')
+            new_time = timed(digestutil.file_cnt_and_digest, path, hash_name, pool)
+            unchanged_time = timed(digestutil.file_cnt_and_digest, path, hash_name, pool)
+            print('  %-26s %8.2fs  %8.0f MB/s  %5.1fx   unchanged %6.3fs' % ('%s, %d thread%s' % (hash_name, num_threads, 's' if num_threads > 1 else ''),
+                    new_time, size / new_time, legacy_time / new_time, unchanged_time))
+            if pool:
+                pool.close()
+
+
+class ArgumentParser(argparse.ArgumentParser):
+
+    def __init__(self):
+        super(ArgumentParser, self).__init__()
+        self.description = """Benchmark dataset hashing on synthetic datasets."""
+        self.add_argument('--small', type=int, nargs=2, default=[20000, 65536], metavar=('N', 'BYTES'), help='many-small-file layout')
+        self.add_argument('--huge', type=int, nargs=2, default=[4, 1 << 30], metavar=('N', 'BYTES'), help='few-huge-file layout')
+        self.add_argument('--threads', type=int, default=multiprocessing.cpu_count(), help='number of hashing threads')
+        self.add_argument('--dir', help='scratch directory (default: a temporary directory)')
+
+
+if __name__ == '__main__':
+    args = ArgumentParser().parse_args()
+    tmp_dir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        for name, (file_cnt, file_size) in (('small', args.small), ('huge', args.huge)):
+            path = os.path.join(tmp_dir, name)
+            make_dataset(path, file_cnt, file_size)
+            print('%d files of %d bytes' % (file_cnt, file_size))
+            run(path, args.threads, sorted(digestutil.HASHES))
+            shutil.rmtree(path)
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+#
+# @author:  Gunnar Schaefer
+
+"""
+Benchmark the pfile header probe against the full header parser, and check that both agree on the probed fields.
+
+Needs pfheader modules generated with field offsets, and real pfiles, e.g.:
+    python -m nimsutil.tests.bench_pfile /scratch/pfiles/P*.7 --repeat 20
+"""
+
+from __future__ import print_function
+
+import time
+import argparse
+
+import numpy as np
+
+from nimsutil import pfile
+from nimsutil import pfheaders
+
+
+def time_calls(func, arg, repeat):
+    """Return the median time of a call."""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func(arg)
+        times.append(time.time() - start)
+    return np.median(times)
+
+
+class ArgumentParser(argparse.ArgumentParser):
+
+    def __init__(self):
+        super(ArgumentParser, self).__init__()
+        self.description = """Benchmark reading pfile headers."""
+        self.add_argument('pfiles', nargs='+', help='pfiles to read')
+        self.add_argument('--repeat', type=int, default=10, help='number of reads to time per pfile')
+
+
+if __name__ == '__main__':
+    args = ArgumentParser().parse_args()
+    print('%-24s %14s %14s %14s %9s' % ('pfile', 'get_header', 'probe', 'PFile(probe)', 'speedup'))
+    for filename in args.pfiles:
+        parser = pfheaders.get_parser_for(filename)
+        probe = pfile.header_probe(parser)
+        full, probed = parser.get_header(filename), probe.read(filename)
+        for field in pfile.PROBE_FIELDS:
+            assert eval('full.' + field) == eval('probed.' + field), '%s differs in %s' % (field, filename)
+        full_time = time_calls(parser.get_header, filename, args.repeat)
+        probe_time = time_calls(probe.read, filename, args.repeat)
+        pfile_time = time_calls(lambda f: pfile.PFile(f, probe=True), filename, args.repeat)
+        print('%-24s %12.2fms %12.2fms %12.2fms %8.0fx' % (filename[-24:], full_time * 1000, probe_time * 1000, pfile_time * 1000, full_time / probe_time))
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""Tests for the conversion of dicom series."""
+
+import os
+import time
+import hashlib
+import shutil
+import tempfile
+import threading
+import multiprocessing
+
+import numpy as np
+import dicom
+import dicom.dataset
+from nose.tools import assert_equals, assert_true
+
+from nimsutil import dicomutil
+from nimsutil.tests.test_niftiutil import assert_valid_gzip
+
+SERIES_SHAPE = (64, 64, 16, 60)     # rows, columns, slices, volumes
+
+# SHA-1 of the uncompressed nifti that the original, nibabel.save-based to_nii wrote for make_series(dir, (16, 16, 8, 4), flip)
+REFERENCE_DIGESTS = {False: 'bbcb7896f1bd8c122c272d44b8cadb48508704fb', True: 'dca37832ff215b9cdbb09eefeb7fc23b9f289d55'}
+
+
+def make_series(dcm_dir, shape, flip=False):
+    """Write a synthetic GE-style EPI series of int16 dicoms."""
+    rows, cols, slices, volumes = shape
+    rng = np.random.RandomState(0)
+    for i in range(slices * volumes):
+        meta = dicom.dataset.Dataset()
+        meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+        meta.MediaStorageSOPInstanceUID = '1.2.3.4.%d' % (i+1)
+        meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+        meta.ImplementationClassUID = '1.2.3.4'
+        dcm = dicom.dataset.FileDataset('', {}, file_meta=meta, preamble='\x00' * 128)
+        dcm.is_little_endian = True
+        dcm.is_implicit_VR = False
+        dcm.Manufacturer = 'GE MEDICAL SYSTEMS'
+        dcm.ImageType = dicomutil.TYPE_EPI
+        dcm.SeriesNumber = 1
+        dcm.InstanceNumber = i+1
+        slice_no = slices - 1 - i % slices if flip else i % slices
+        dcm.SliceLocation = slice_no * 3.
+        dcm.ImagePositionPatient = [-100., -100., slice_no * 3.]
+        dcm.ImageOrientationPatient = [1., 0., 0., 0., 1., 0.]
+        dcm.ImagesinAcquisition = slices * volumes
+        dcm.PixelSpacing = [2., 2.]
+        dcm.SpacingBetweenSlices = 3.
+        dcm.RepetitionTime = 2000.
+        dcm.TriggerTime = (i % slices) * 100.
+        dcm.Rows = rows
+        dcm.Columns = cols
+        dcm.BitsAllocated = 16
+        dcm.BitsStored = 16
+        dcm.HighBit = 15
+        dcm.PixelRepresentation = 1
+        dcm.SamplesperPixel = 1
+        dcm.PhotometricInterpretation = 'MONOCHROME2'
+        dcm.add_new(dicomutil.TAG_SLICES_PER_VOLUME, 'SS', slices)
+        dcm.PixelData = rng.randint(0, 4096, size=(rows, cols)).astype(np.int16).tostring()
+        dcm[0x7fe00010].VR = 'OW'
+        dcm.save_as(os.path.join(dcm_dir, 'i%05d.dcm' % (i+1)))
+
+
+def memory_status(field):
+    """Return a memory size, in bytes, from /proc/self/status (e.g., VmRSS or VmHWM)."""
+    with open('/proc/self/status') as fd:
+        return int([line.split()[1] for line in fd if line.startswith(field + ':')][0]) * 1024
+
+
+def convert_and_measure(dcm_dir, outbase, streaming, result_queue):
+    """Convert in a child process; report how far its peak resident memory grew during conversion."""
+    dcm_series = dicomutil.DicomSeries(dcm_dir)
+    dcm_series.to_nii(outbase, streaming=True)     # warm up lazy header parsing, zlib, etc.
+    with open('/proc/self/clear_refs', 'w') as fd:
+        fd.write('5')   # reset the peak resident memory (VmHWM) to the current value
+    rss_before = memory_status('VmRSS')
+    dcm_series.to_nii(outbase, streaming)
+    result_queue.put(memory_status('VmHWM') - rss_before)
+
+
+class TestStreamingConversion(object):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dcm_dir = os.path.join(self.tmp_dir, 'dicoms')
+        os.mkdir(self.dcm_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def convert(self, name, streaming):
+        outbase = os.path.join(self.tmp_dir, name)
+        result_queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=convert_and_measure, args=(self.dcm_dir, outbase, streaming, result_queue))
+        proc.start()
+        peak_growth = result_queue.get()
+        proc.join()
+        return assert_valid_gzip(outbase + '.nii.gz'), peak_growth
+
+    def test_identical_output(self):
+        # only the uncompressed payloads are compared; the gzip headers differ in file name and mtime
+        for flip in (False, True):
+            make_series(self.dcm_dir, (16, 16, 8, 4), flip)
+            default_nii, _ = self.convert('default', False)
+            streaming_nii, _ = self.convert('streaming', True)
+            assert_equals(hashlib.sha1(default_nii).hexdigest(), REFERENCE_DIGESTS[flip])
+            assert_equals(hashlib.sha1(streaming_nii).hexdigest(), REFERENCE_DIGESTS[flip])
+
+    def test_bounded_memory(self):
+        make_series(self.dcm_dir, SERIES_SHAPE)
+        series_size = np.prod(SERIES_SHAPE) * 2
+        volume_size = np.prod(SERIES_SHAPE[:3]) * 2
+        _, default_growth = self.convert('default', False)
+        streaming_nii, streaming_growth = self.convert('streaming', True)
+        assert_equals(len(streaming_nii), 352 + series_size)
+        assert_true(default_growth > series_size)
+        assert_true(streaming_growth < 4 * volume_size)
+
+
+class TestParallelDecode(object):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        make_series(self.tmp_dir, (16, 16, 8, 4), flip=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_identical_data(self):
+        serial = dicomutil.DicomSeries(self.tmp_dir, num_workers=1)
+        parallel = dicomutil.DicomSeries(self.tmp_dir, num_workers=4)
+        assert_true(np.array_equal(serial.image_data, parallel.image_data))
+        serial_nii = serial.to_nii(os.path.join(self.tmp_dir, 'serial'), streaming=True)
+        parallel_nii = parallel.to_nii(os.path.join(self.tmp_dir, 'parallel'), streaming=True)
+        assert_equals(assert_valid_gzip(serial_nii), assert_valid_gzip(parallel_nii))
+
+
+def deliver(src_dir, dst_dir, filenames, delay):
+    """Move dicoms into the series directory one by one, as the reaper and sorter would while a scan is running."""
+    for filename in filenames:
+        time.sleep(delay)
+        shutil.copy(os.path.join(src_dir, filename), os.path.join(src_dir, filename + '.tmp'))
+        os.rename(os.path.join(src_dir, filename + '.tmp'), os.path.join(dst_dir, filename))
+
+
+class TestIncrementalConversion(object):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp_dir, 'acquired')
+        self.dcm_dir = os.path.join(self.tmp_dir, 'dicoms')
+        os.mkdir(self.src_dir)
+        os.mkdir(self.dcm_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_identical_output(self):
+        for flip in (False, True):
+            shutil.rmtree(self.dcm_dir)
+            os.mkdir(self.dcm_dir)
+            make_series(self.src_dir, (16, 16, 8, 4), flip)
+            filenames = sorted(os.listdir(self.src_dir))
+            deliver(self.src_dir, self.dcm_dir, filenames[:3], 0)
+            dcm_series = dicomutil.DicomSeries(self.dcm_dir)
+            delivery = threading.Thread(target=deliver, args=(self.src_dir, self.dcm_dir, filenames[3:], 0.01))
+            delivery.start()
+            incremental_file = dcm_series.to_nii_incremental(os.path.join(self.tmp_dir, 'incremental'), len(filenames), 0.01, 10)
+            delivery.join()
+            complete_file = dicomutil.DicomSeries(self.dcm_dir).to_nii(os.path.join(self.tmp_dir, 'complete'))
+            assert_equals(assert_valid_gzip(incremental_file), assert_valid_gzip(complete_file))
+
+    def test_stalled_series(self):
+        make_series(self.src_dir, (16, 16, 8, 4))
+        filenames = sorted(os.listdir(self.src_dir))
+        deliver(self.src_dir, self.dcm_dir, filenames[:20], 0)
+        outbase = os.path.join(self.tmp_dir, 'incremental')
+        assert_equals(dicomutil.DicomSeries(self.dcm_dir).to_nii_incremental(outbase, len(filenames), 0.01, 0.1), None)
+        assert_true(not os.path.exists(outbase + '.nii.gz'))
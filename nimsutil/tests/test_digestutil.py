@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Tests for incremental dataset digests."""
+
+import os
+import mmap
+import shutil
+import hashlib
+import tempfile
+import multiprocessing.pool
+
+from nose.tools import assert_equals, assert_not_equals, assert_raises
+
+from nimsutil import digestutil
+
+
+class TestDigestManifest(object):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ds_dir = os.path.join(self.tmp_dir, '00000001')
+        os.mkdir(self.ds_dir)
+        for i in range(3):
+            self.write('%03d.dcm' % i, 'slice %d' % i * 100)
+        self.hashed = []
+        self.hash_files = digestutil.hash_files
+        digestutil.hash_files = lambda filenames, hash_name, pool: self.hashed.extend(map(os.path.basename, filenames)) or self.hash_files(filenames, hash_name, pool)
+
+    def tearDown(self):
+        digestutil.hash_files = self.hash_files
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, filename, content):
+        with open(os.path.join(self.ds_dir, filename), 'wb') as fd:
+            fd.write(content)
+
+    def test_only_changed_files_are_hashed(self):
+        file_cnt, digest = digestutil.file_cnt_and_digest(self.ds_dir)
+        assert_equals(file_cnt, 3)
+        assert_equals(len(digest), 20)
+        assert_equals(sorted(self.hashed), ['000.dcm', '001.dcm', '002.dcm'])
+        assert os.path.isfile(self.ds_dir + '.manifest')
+        self.hashed[:] = []
+        assert_equals(digestutil.file_cnt_and_digest(self.ds_dir), (3, digest))
+        assert_equals(self.hashed, [])
+        self.write('003.dcm', 'slice 3')
+        self.write('000.dcm', 'slice 0, resent')
+        file_cnt, new_digest = digestutil.file_cnt_and_digest(self.ds_dir)
+        assert_equals(file_cnt, 4)
+        assert_not_equals(new_digest, digest)
+        assert_equals(sorted(self.hashed), ['000.dcm', '003.dcm'])
+        os.remove(os.path.join(self.ds_dir, '003.dcm'))
+        assert_equals(digestutil.file_cnt_and_digest(self.ds_dir)[0], 3)
+
+    def test_digest_matches_fresh_manifest(self):
+        digestutil.file_cnt_and_digest(self.ds_dir)
+        self.write('001.dcm', 'other content')
+        incremental = digestutil.file_cnt_and_digest(self.ds_dir)
+        os.remove(self.ds_dir + '.manifest')
+        assert_equals(digestutil.file_cnt_and_digest(self.ds_dir), incremental)
+
+    def test_remove_dataset(self):
+        digestutil.file_cnt_and_digest(self.ds_dir)
+        digestutil.remove_dataset(self.ds_dir + '/')
+        assert_equals(os.listdir(self.tmp_dir), [])
+
+    def test_recorded_hash(self):
+        file_cnt, digest = digestutil.file_cnt_and_digest(self.ds_dir, 'adler32')
+        self.hashed[:] = []
+        assert_equals(digestutil.file_cnt_and_digest(self.ds_dir), (file_cnt, digest))
+        assert_equals(self.hashed, [])
+        assert_not_equals(digestutil.file_cnt_and_digest(self.ds_dir, 'sha1'), (file_cnt, digest))
+        assert_equals(digestutil.DigestManifest(self.ds_dir).hash_name, 'sha1')
+
+    def test_hashes(self):
+        sha1_digest = digestutil.file_cnt_and_digest(self.ds_dir)[1]
+        self.hashed[:] = []
+        adler32_digest = digestutil.file_cnt_and_digest(self.ds_dir, 'adler32')[1]
+        assert_equals(len(self.hashed), 3)     # a manifest of another hash is rebuilt
+        assert_not_equals(adler32_digest, sha1_digest)
+        assert_raises(ValueError, digestutil.DigestManifest, self.ds_dir, 'md4')
+
+
+class TestHashFiles(object):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.block_size, self.read_size = digestutil.BLOCK_SIZE, digestutil.READ_SIZE
+        digestutil.BLOCK_SIZE, digestutil.READ_SIZE = 8 * mmap.ALLOCATIONGRANULARITY, mmap.ALLOCATIONGRANULARITY
+        self.filenames = []
+        for i, size in enumerate([0, 100, digestutil.READ_SIZE + 1, digestutil.BLOCK_SIZE, 3 * digestutil.BLOCK_SIZE + 5]):
+            self.filenames.append(os.path.join(self.tmp_dir, '%d.dat' % i))
+            with open(self.filenames[-1], 'wb') as fd:
+                fd.write(os.urandom(size))
+
+    def tearDown(self):
+        digestutil.BLOCK_SIZE, digestutil.READ_SIZE = self.block_size, self.read_size
+        shutil.rmtree(self.tmp_dir)
+
+    def test_hash_files(self):
+        digests = digestutil.hash_files(self.filenames)
+        for filename, digest in zip(self.filenames[:4], digests):
+            with open(filename, 'rb') as fd:
+                assert_equals(digest, hashlib.sha1(fd.read()).hexdigest())
+        with open(self.filenames[4], 'rb') as fd:
+            blocks = iter(lambda: fd.read(digestutil.BLOCK_SIZE), '')
+            assert_equals(digests[4], hashlib.sha1(''.join(hashlib.sha1(block).hexdigest() for block in blocks)).hexdigest())
+        pool = multiprocessing.pool.ThreadPool(3)
+        for hash_name in digestutil.HASHES:
+            assert_equals(digestutil.hash_files(self.filenames, hash_name, pool), digestutil.hash_files(self.filenames, hash_name))
+        pool.close()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Tests for the pfile header parser generator, on a small gccxml-style header."""
+
+import os
+import sys
+import shutil
+import struct
+import tempfile
+import StringIO
+
+from nose.tools import assert_equals, assert_raises
+
+from nimsutil import mkpfheader
+
+HEADER_XML = """<?xml version="1.0"?>
+<GCC_XML>
+  <FundamentalType id="_1" name="int" size="32" align="32"/>
+  <FundamentalType id="_2" name="float" size="32" align="32"/>
+  <FundamentalType id="_3" name="char" size="8" align="8"/>
+  <FundamentalType id="_4" name="short int" size="16" align="16"/>
+  <ArrayType id="_5" min="0" max="9u" type="_3" size="80" align="8"/>
+  <ArrayType id="_6" min="0" max="2u" type="_4" size="48" align="16"/>
+  <Struct id="_10" name="DAB_INFO" members="_11 _12" size="32" align="16"/>
+  <Field id="_11" name="start_rcv" type="_4" context="_10"/>
+  <Field id="_12" name="stop_rcv" type="_4" context="_10"/>
+  <ArrayType id="_13" min="0" max="1u" type="_10" size="64" align="16"/>
+  <Struct id="_20" name="RDB_HEADER_REC" members="_24 _21 _22 _23" size="208" align="32"/>
+  <Field id="_24" name="rdb_hdr_rdbm_rev" type="_2" context="_20"/>
+  <Field id="_21" name="rdb_hdr_logo" type="_5" context="_20"/>
+  <Field id="_22" name="rdb_hdr_dab" type="_13" context="_20"/>
+  <Field id="_23" name="rdb_hdr_user0" type="_2" context="_20"/>
+  <Union id="_30" name="SLICE_UNION" members="_31 _32" size="48" align="32"/>
+  <Field id="_31" name="as_int" type="_1" context="_30"/>
+  <Field id="_32" name="as_shorts" type="_6" context="_30"/>
+  <Struct id="_40" name="MRIMAGEDATATYPE" members="_41 _42 _43 _44" size="120" align="32"/>
+  <Field id="_41" name="tr" type="_1" context="_40"/>
+  <Field id="_42" name="slices" type="_30" context="_40"/>
+  <Field id="_43" name="psdname" type="_5" context="_40"/>
+  <Field id="_44" name="plane" type="_3" context="_40"/>
+  <Struct id="_50" name="POOL_HEADER" members="_51 _52" size="328" align="32"/>
+  <Field id="_51" name="rec" type="_20" context="_50"/>
+  <Field id="_52" name="image" type="_40" context="_50"/>
+</GCC_XML>
+"""
+
+
+def generate_parser(printer, *args):
+    """Return the namespace of a generated parser module."""
+    stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+    try:
+        printer(*args)
+        source = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    pfheader = {}
+    exec source in pfheader
+    return pfheader
+
+
+def write_pfile(dirname, revision=22.0):
+    data = struct.pack('<f10shhhhfi3h10ss', revision, 'GE_MED_NMR', 1, 8, 9, 16, 2.5, 2000000, 4, 5, 6, 'epi\0junk', 'A')
+    filename = os.path.join(dirname, 'P%05d.7' % (revision * 1000))
+    with open(filename, 'wb') as fd:
+        fd.write(data + '\0' * 100)
+    return filename, data
+
+
+class TestFieldLayout(object):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        mkpfheader.NODE_DICT.clear()
+        mkpfheader.OBJECT_DICT.clear()
+        with open(os.path.join(self.tmp_dir, 'pfheader.xml'), 'w') as fd:
+            fd.write(HEADER_XML)
+        self.pool_header = mkpfheader.get_pool_header(os.path.join(self.tmp_dir, 'pfheader.xml'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_field_layout(self):
+        assert_equals(mkpfheader.field_layout(self.pool_header), [
+                ('rec.rdbm_rev', 0, 'f'),
+                ('rec.logo', 4, '10s'),
+                ('rec.dab[0].start_rcv', 14, 'h'),
+                ('rec.dab[0].stop_rcv', 16, 'h'),
+                ('rec.dab[1].start_rcv', 18, 'h'),
+                ('rec.dab[1].stop_rcv', 20, 'h'),
+                ('rec.user0', 22, 'f'),
+                ('image.tr', 26, 'i'),
+                ('image.slices.as_shorts', 30, '3h'),
+                ('image.psdname', 36, '10s'),
+                ('image.plane', 46, 's'),
+                ])
+
+    def test_fields_match_generated_parser(self):
+        pfheader = generate_parser(mkpfheader.print_parser, self.pool_header, mkpfheader.OBJECT_DICT)
+        filename, data = write_pfile(self.tmp_dir)
+        header = pfheader['get_header'](filename)
+        for name, (offset, format_) in pfheader['FIELDS'].iteritems():
+            value = struct.unpack_from('<' + format_, data, offset)
+            value = value[0].split('\0', 1)[0] if format_.endswith('s') else value if len(value) > 1 else value[0]
+            expected = eval('header.' + name)
+            assert_equals(value, tuple(expected) if isinstance(expected, tuple) else expected)
+
+    def test_numpy_backend(self):
+        struct_parser = generate_parser(mkpfheader.print_parser, self.pool_header, mkpfheader.OBJECT_DICT)
+        numpy_parser = generate_parser(mkpfheader.print_numpy_parser, self.pool_header)
+        filename, data = write_pfile(self.tmp_dir)
+        expected, header = struct_parser['get_header'](filename), numpy_parser['get_header'](filename)
+        for name in numpy_parser['FIELDS']:
+            assert_equals(eval('header.' + name), eval('expected.' + name))
+        assert_equals(header.rec.dab[1].stop_rcv, 16)
+        assert_equals(header.image.psdname, 'epi')
+        assert_equals(header.image.slices.as_shorts, (4, 5, 6))
+        assert_equals(header.image.plane, 'A')
+        assert_equals(numpy_parser['HEADER_DTYPE'].itemsize, 47)
+        with open(filename, 'r+b') as fd:
+            fd.write('NOT_A_PFILE')
+        assert_raises(numpy_parser['PfheaderError'], numpy_parser['get_header'], filename)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Tests for writing NIfTI files."""
+
+import os
+import gzip
+import zlib
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+import nibabel
+from nose.tools import assert_equals, assert_raises
+
+from nimsutil import niftiutil
+
+
+def assert_valid_gzip(filename):
+    """Check that a gzip file decompresses completely, and that its trailer matches its content."""
+    with gzip.open(filename, 'rb') as fd:
+        data = fd.read()
+    with open(filename, 'rb') as fd:
+        fd.seek(-8, os.SEEK_END)
+        crc, size = struct.unpack('<II', fd.read(8))
+    assert_equals(crc, zlib.crc32(data) & 0xffffffff)
+    assert_equals(size, len(data) & 0xffffffff)
+    return data
+
+
+class TestCompression(object):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image_data = np.random.RandomState(0).randint(0, 4096, size=(16, 16, 8, 5)).astype(np.int16)
+        self.nifti = nibabel.Nifti1Image(self.image_data, np.eye(4))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parse_compression(self):
+        assert_equals(niftiutil.parse_compression('gzip'), ('gzip', None))
+        assert_equals(niftiutil.parse_compression('pgzip:9'), ('pgzip', 9))
+        for spec in ('bzip2', 'gzip:10', 'gzip:fast', 'none:1'):
+            assert_raises(ValueError, niftiutil.parse_compression, spec)
+
+    def test_identical_content(self):
+        reference = nibabel.save(self.nifti, os.path.join(self.tmp_dir, 'reference.nii'))
+        with open(os.path.join(self.tmp_dir, 'reference.nii'), 'rb') as fd:
+            reference = fd.read()
+        for compression in ('none', 'gzip', 'gzip:9', 'pgzip', 'pgzip:6'):
+            outbase = os.path.join(self.tmp_dir, compression.replace(':', ''))
+            filename = niftiutil.save(self.nifti, outbase, compression)
+            with (gzip.open if filename.endswith('.gz') else open)(filename, 'rb') as fd:
+                assert_equals(fd.read(), reference)
+            with niftiutil.NiftiWriter(outbase + '_vols' + niftiutil.extension(compression), self.nifti.get_header(), self.image_data.shape, np.int16, compression) as writer:
+                for volume in np.rollaxis(self.image_data, 3):
+                    writer.write(volume)
+            assert_equals(nibabel.load(writer.filename).get_data().tolist(), self.image_data.tolist())
+            if writer.filename.endswith('.gz'):
+                assert_valid_gzip(writer.filename)
+
+    def test_truncated_volumes(self):
+        filename = os.path.join(self.tmp_dir, 'truncated.nii.gz')
+        writer = niftiutil.NiftiWriter(filename, self.nifti.get_header(), self.image_data.shape, np.int16)
+        for volume in np.rollaxis(self.image_data, 3)[:-1]:
+            writer.write(volume)
+        assert_raises(ValueError, writer.close)
+        assert not os.path.exists(filename)
+
+    def test_block_gzip(self):
+        data = self.image_data.tostring() * 3
+        filename = os.path.join(self.tmp_dir, 'blocks.gz')
+        with niftiutil.BlockGzipFile(filename, num_threads=3) as fd:
+            fd.block_size = 1000
+            for start in range(0, len(data), 777):
+                fd.write(data[start:start+777])
+        with gzip.open(filename) as fd:
+            assert_equals(fd.read(), data)
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""Tests for the nimsutil helpers."""
+
+from nose.tools import assert_equals
+
+import nimsutil
+
+
+class TestLRUCache(object):
+
+    def test_eviction(self):
+        cache = nimsutil.LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        assert_equals(cache.get('a'), 1)    # b is now the least recently used
+        cache['c'] = 3
+        assert_equals(len(cache), 2)
+        assert 'b' not in cache
+        assert_equals((cache.get('a'), cache.get('b', 0), cache.get('c')), (1, 0, 3))
+        cache['a'] = 4
+        cache['d'] = 5
+        assert_equals((cache.get('a'), cache.get('c')), (4, None))
+        assert_equals((cache.pop('a'), cache.pop('a')), (4, None))
+        assert_equals(len(cache), 1)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""Tests for dispatching pfile header parsing on the header revision."""
+
+import os
+import sys
+import types
+import shutil
+import tempfile
+
+from nose.tools import assert_equals, assert_raises
+
+from nimsutil import mkpfheader
+from nimsutil import pfheaders
+from nimsutil.tests.test_mkpfheader import HEADER_XML, generate_parser, write_pfile
+
+
+class TestRevisionDispatch(object):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        mkpfheader.NODE_DICT.clear()
+        mkpfheader.OBJECT_DICT.clear()
+        with open(os.path.join(self.tmp_dir, 'pfheader.xml'), 'w') as fd:
+            fd.write(HEADER_XML)
+        pool_header = mkpfheader.get_pool_header(os.path.join(self.tmp_dir, 'pfheader.xml'))
+        self.parser = types.ModuleType('nimsutil.pfheader_20_006')
+        self.parser.__dict__.update(generate_parser(mkpfheader.print_numpy_parser, pool_header, 20.006))
+        sys.modules['nimsutil.pfheader_20_006'] = self.parser
+        pfheaders.PARSERS.clear()
+
+    def tearDown(self):
+        del sys.modules['nimsutil.pfheader_20_006']
+        pfheaders.PARSERS.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_module_name(self):
+        assert_equals(pfheaders.module_name(20.006), 'pfheader_20_006')
+        assert_equals(pfheaders.module_name(22.0), 'pfheader_22')
+        assert_equals(pfheaders.module_name(14.3), 'pfheader_14_3')
+
+    def test_dispatch(self):
+        filename, data = write_pfile(self.tmp_dir, 20.006)
+        assert_equals(pfheaders.read_revision(filename), 20.006)
+        assert pfheaders.get_parser_for(filename) is self.parser
+        assert_equals(self.parser.REVISION, 20.006)
+        assert_equals(pfheaders.get_header(filename).image.psdname, 'epi')
+        with open(os.path.join(self.tmp_dir, 'notes.txt'), 'w') as fd:
+            fd.write('not a pfile')
+        assert_equals(pfheaders.read_revision(os.path.join(self.tmp_dir, 'notes.txt')), None)
+        assert_raises(pfheaders.PfheaderError, pfheaders.get_header, os.path.join(self.tmp_dir, 'notes.txt'))
+
+    def test_unknown_revision(self):
+        pfheaders.PARSERS[11.0] = None      # as if neither pfheader_11 nor a fallback pfheader module existed
+        filename, data = write_pfile(self.tmp_dir, 11.0)
+        assert_raises(pfheaders.UnknownRevisionError, pfheaders.get_parser_for, filename)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""Tests for memory-mapped pfile k-space data."""
+
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+from nose.tools import assert_equals, assert_raises
+
+from nimsutil import pfile
+
+RAW_FIELDS = {
+        'rec.dab[0].start_rcv': 0, 'rec.dab[0].stop_rcv': 1, 'rec.npasses': 3, 'rec.nslices': 6, 'rec.nechoes': 2,
+        'rec.nframes': 4, 'rec.hnover': 1, 'rec.frame_size': 8, 'rec.point_size': 2, 'rec.off_data': 64,
+        }
+
+
+class TestKspaceMemmap(object):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.header = pfile.HeaderStruct()
+        for field, value in RAW_FIELDS.iteritems():
+            pfile.HeaderProbe.set_field(self.header, re.findall(r'(\w+)(?:\[(\d+)\])?', field), value)
+        # samples in GE order: receiver, frame, slice, echo, view (baseline first), sample, real/imag
+        self.raw = np.arange(2 * 3 * 2 * 2 * 6 * 8 * 2, dtype='<i2').reshape(2, 3, 2, 2, 6, 8, 2)
+        self.filename = os.path.join(self.tmp_dir, 'P00001.7')
+        with open(self.filename, 'wb') as fd:
+            fd.write('\0' * 64 + self.raw.tostring())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_shape_and_order(self):
+        kspace = pfile.kspace_memmap(self.filename, self.header)
+        assert_equals(kspace.shape, (2, 2, 3, 2, 5, 8))
+        assert isinstance(kspace.base, np.memmap)
+        echo, slice_, frame, receiver, view, sample = 1, 0, 2, 1, 3, 5
+        assert_equals(kspace['real'][echo, slice_, frame, receiver, view, sample], self.raw[receiver, frame, slice_, echo, view + 1, sample, 0])
+        assert_equals(kspace['imag'][echo, slice_, frame, receiver, view, sample], self.raw[receiver, frame, slice_, echo, view + 1, sample, 1])
+
+    def test_truncated(self):
+        with open(self.filename, 'r+b') as fd:
+            fd.truncate(1000)
+        assert_raises(pfile.PFileError, pfile.kspace_memmap, self.filename, self.header)
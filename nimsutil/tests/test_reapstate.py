@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Tests for the persistent reaper state."""
+
+import os
+import time
+import shutil
+import datetime
+import tempfile
+
+from nose.tools import assert_equals
+
+from nimsutil import reapstate
+
+
+class TestReapState(object):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, '.state')
+        self.state = reapstate.ReapState(self.filename)
+
+    def tearDown(self):
+        self.state.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_reference_datetime(self):
+        now = datetime.datetime(2013, 4, 1, 12, 30, 15, 250)
+        assert_equals(self.state.get_reference_datetime(), None)
+        assert_equals(self.state.get_reference_datetime(now), now)
+        self.state.set_reference_datetime(now + datetime.timedelta(hours=1))
+        assert_equals(self.state.get_reference_datetime(now), now + datetime.timedelta(hours=1))
+
+    def test_legacy_datetime_file(self):
+        legacy_file = os.path.join(self.tmp_dir, '.datetime')
+        with open(legacy_file, 'w') as fd:
+            fd.write(datetime.datetime(2013, 4, 1, 12, 30, 15).strftime('%c\n'))
+        state = reapstate.ReapState(os.path.join(self.tmp_dir, '.legacy_state'), legacy_file)
+        assert_equals(state.get_reference_datetime(), datetime.datetime(2013, 4, 1, 12, 30, 15))
+        state.set_reference_datetime(datetime.datetime(2013, 4, 2))
+        state.close()
+        state = reapstate.ReapState(os.path.join(self.tmp_dir, '.legacy_state'), legacy_file)
+        assert_equals(state.get_reference_datetime(), datetime.datetime(2013, 4, 2))
+        state.close()
+
+    def test_changed_files(self):
+        self.state.mark('file', '/data/P12345.7', reapstate.REAPED, size=1024, mtime=1364844615.25)
+        assert self.state.is_reaped('file', '/data/P12345.7', 1024, 1364844615.25)
+        assert not self.state.is_reaped('file', '/data/P12345.7', 2048, 1364844615.25)
+        assert not self.state.is_reaped('file', '/data/P12345.7', 1024, 1364844616)
+        assert not self.state.is_reaped('file', '/data/P23456.7')
+        self.state.mark('file', '/data/P12345.7', reapstate.PENDING)
+        assert not self.state.is_reaped('file', '/data/P12345.7')
+
+    def test_persistence(self):
+        self.state.mark_many('image', ['1.2.3.1.%d' % i for i in range(1, 6)], reapstate.REAPED, '1.2.3.1')
+        self.state.mark_many('image', ['1.2.3.2.1'], reapstate.REAPED, '1.2.3.2')
+        self.state.mark('series', '1.2.3.1', reapstate.REAPED, '1.2.3', 5)
+        self.state.close()
+        self.state = reapstate.ReapState(self.filename)
+        assert_equals(self.state.keys('image', '1.2.3.1'), set('1.2.3.1.%d' % i for i in range(1, 6)))
+        assert_equals(len(self.state.keys('image')), 6)
+        assert self.state.is_reaped('series', '1.2.3.1', 5)
+        assert not self.state.is_reaped('series', '1.2.3.1', 6)
+
+    def test_forget_before(self):
+        self.state.mark('exam', '1.2.3', reapstate.REAPED)
+        self.state.forget_before('exam', time.time() - 60)
+        assert self.state.is_reaped('exam', '1.2.3')
+        self.state.forget_before('exam', time.time() + 60)
+        assert not self.state.is_reaped('exam', '1.2.3')
+
+    def test_forget_expired(self):
+        self.state.mark('file', '/data/P12345.7', reapstate.REAPED)
+        now = datetime.datetime.now()
+        self.state.forget_expired('file', now)
+        assert self.state.is_reaped('file', '/data/P12345.7')
+        self.state.forget_expired('file', now + datetime.timedelta(seconds=reapstate.RETENTION + 60))
+        assert not self.state.is_reaped('file', '/data/P12345.7')
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Tests for directory watchers."""
+
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equals
+
+from nimsutil import watcher
+
+
+class WatcherTests(object):
+
+    watcher_class = None
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.watch_dir = os.path.join(self.tmp_dir, 'watched')
+        os.mkdir(self.watch_dir)
+        with open(os.path.join(self.watch_dir, 'old.7'), 'w') as fd:
+            fd.write('present before watching')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_atomic(self):
+        with self.watcher_class(self.watch_dir, 0.2, atomic=True) as w:
+            assert_equals(w.wait(1), ['old.7'])
+            os.mkdir(os.path.join(self.tmp_dir, 'series'))
+            os.rename(os.path.join(self.tmp_dir, 'series'), os.path.join(self.watch_dir, 'series'))
+            assert_equals(w.wait(1), ['series'])
+            assert_equals(w.wait(0.3), [])
+
+    def test_written_in_place(self):
+        with self.watcher_class(self.watch_dir, 0.2, pattern='P*.7') as w:
+            fd = open(os.path.join(self.watch_dir, 'P00001.7'), 'w')
+            fd.write('partial')
+            fd.flush()
+            assert_equals(w.wait(0.1), [])
+            fd.write('more')
+            fd.close()
+            with open(os.path.join(self.watch_dir, 'ignored.dat'), 'w') as fd:
+                fd.write('does not match')
+            complete = set()
+            for i in range(10):
+                complete.update(w.wait(0.2))
+            assert_equals(complete, set(['P00001.7']))
+
+
+class TestInotifyWatcher(WatcherTests):
+
+    watcher_class = watcher.InotifyWatcher
+
+
+class TestPollingWatcher(WatcherTests):
+
+    watcher_class = watcher.PollingWatcher
+
+
+class TestWatchGlob(object):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for exam in ('e1', 'e2'):
+            os.mkdir(os.path.join(self.tmp_dir, exam))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_plain_directory(self):
+        with watcher.watch_glob(os.path.join(self.tmp_dir, 'e1', 'P*.7'), 0.2, poll=True) as w:
+            assert_equals((type(w), w.path, w.pattern), (watcher.PollingWatcher, os.path.join(self.tmp_dir, 'e1'), 'P*.7'))
+
+    def test_wildcard_directory(self):
+        with watcher.watch_glob(os.path.join(self.tmp_dir, '*', 'P*.7'), 0.2, atomic=True) as w:
+            assert_equals((type(w), w.path), (watcher.GlobWatcher, self.tmp_dir))
+            for exam, name in (('e1', 'P00001.7'), ('e2', 'P00002.7'), ('e2', 'ignored.dat')):
+                with open(os.path.join(self.tmp_dir, exam, name), 'w') as fd:
+                    fd.write('data')
+            assert_equals(sorted(w.wait(1)), ['e1/P00001.7', 'e2/P00002.7'])
+            assert_equals(w.wait(0.3), [])
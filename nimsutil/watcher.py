@@ -0,0 +1,253 @@
+# @author:  Gunnar Schaefer
+
+"""
+Watch a directory for new, complete items.
+
+An item is complete once it has been moved into the directory, or, for a file written in place, once the file
+has been closed after writing. Watchers use Linux inotify through ctypes, and fall back to polling where inotify is
+not available, or misses changes, i.e., on network filesystems, where it sees no writes made by other hosts. Polling
+watchers consider a file complete once its size and mtime are unchanged between two polls. Globs with wildcards in
+their directory part, e.g., /data/*/P*.7, are always polled.
+
+Example:
+    watcher = watch('/scratch/stage/sort', poll_interval=10, atomic=True)
+    while True:
+        for name in watcher.wait(timeout=10):
+            process(os.path.join('/scratch/stage/sort', name))
+"""
+
+import os
+import abc
+import glob
+import time
+import errno
+import select
+import struct
+import fnmatch
+import ctypes
+import ctypes.util
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x00080000
+EVENT_HEADER = struct.Struct('iIII')
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', 'glusterfs', 'lustre', 'fuse.sshfs')
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        libc = None
+    return libc
+
+libc = _load_libc()
+
+
+def is_network_fs(path):
+    """Return True if path is on a network filesystem, according to /proc/mounts."""
+    try:
+        with open('/proc/mounts') as fd:
+            mounts = [line.split()[1:3] for line in fd]
+    except IOError:
+        return False
+    path = os.path.realpath(path)
+    mounts = [(mount_point, fs_type) for mount_point, fs_type in mounts if path == mount_point or path.startswith(mount_point.rstrip('/') + '/')]
+    return bool(mounts) and max(mounts, key=lambda mount: len(mount[0]))[1] in NETWORK_FILESYSTEMS
+
+
+def watch(path, poll_interval=10, pattern='*', atomic=False, poll=False):
+    """
+    Return an InotifyWatcher for the given directory, or a PollingWatcher if inotify is not available, the directory
+    is on a network filesystem, or poll is True.
+
+    Only items whose names match pattern are reported. If atomic, items are known to be moved into the directory
+    complete, and are reported as soon as they appear.
+    """
+    if libc and not poll and not is_network_fs(path):
+        try:
+            return InotifyWatcher(path, poll_interval, pattern, atomic)
+        except OSError:     # e.g., out of inotify instances or watches
+            pass
+    return PollingWatcher(path, poll_interval, pattern, atomic)
+
+
+def watch_glob(path_glob, poll_interval=10, atomic=False, poll=False):
+    """
+    Return a watcher for the files matching a glob; items are reported by their path relative to the watcher's path.
+
+    A glob with wildcards in its directory part is watched by a GlobWatcher on the longest directory without any.
+    """
+    dirname, pattern = os.path.split(path_glob)
+    if not glob.has_magic(dirname):
+        return watch(dirname, poll_interval, pattern, atomic, poll)
+    parts = dirname.split(os.sep)
+    fixed_cnt = [glob.has_magic(part) for part in parts].index(True)
+    return GlobWatcher(os.sep.join(parts[:fixed_cnt]) or os.curdir, poll_interval, os.path.join(*(parts[fixed_cnt:] + [pattern])), atomic)
+
+
+class Watcher(object):
+
+    """Base class of directory watchers; items present on creation are reported once they are complete."""
+
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, path, poll_interval=10, pattern='*', atomic=False):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.pattern = pattern
+        self.atomic = atomic
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def matches(self, name):
+        return fnmatch.fnmatch(name, self.pattern)
+
+    def names(self):
+        return filter(self.matches, os.listdir(self.path))
+
+    def listdir(self):
+        """Return the names and stats of the matching items in the directory."""
+        items = {}
+        for name in self.names():
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:     # removed meanwhile
+                continue
+            items[name] = (stat.st_size, stat.st_mtime)
+        return items
+
+    @abc.abstractmethod
+    def wait(self, timeout=None):
+        """Return the names of items that completed since the last call, waiting up to timeout seconds for one."""
+
+    def close(self):
+        pass
+
+
+class PollingWatcher(Watcher):
+
+    def __init__(self, path, poll_interval=10, pattern='*', atomic=False):
+        super(PollingWatcher, self).__init__(path, poll_interval, pattern, atomic)
+        self.seen = {}
+        self.reported = {}
+        self.last_poll = 0
+
+    def poll(self):
+        items = self.listdir()
+        complete = [name for name, state in items.iteritems() if self.reported.get(name) != state and (self.atomic or self.seen.get(name) == state)]
+        self.seen = items
+        self.reported = dict((name, state) for name, state in self.reported.iteritems() if name in items)
+        self.reported.update((name, items[name]) for name in complete)
+        self.last_poll = time.time()
+        return complete
+
+    def wait(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            next_poll = self.last_poll + self.poll_interval
+            if deadline is not None and next_poll > deadline:
+                time.sleep(max(deadline - time.time(), 0))
+                return []
+            time.sleep(max(next_poll - time.time(), 0))
+            complete = self.poll()
+            if complete:
+                return complete
+
+
+class GlobWatcher(PollingWatcher):
+
+    """PollingWatcher for a pattern that spans subdirectories, e.g., '*/P*.7'; names are relative paths."""
+
+    def names(self):
+        return [os.path.relpath(filepath, self.path) for filepath in glob.glob(os.path.join(self.path, self.pattern))]
+
+
+class InotifyWatcher(Watcher):
+
+    """
+    Watcher that is woken by inotify events.
+
+    Items present on creation (or after the event queue overflowed) are reported once they have not been modified
+    for one poll interval, unless the watcher is atomic.
+    """
+
+    def __init__(self, path, poll_interval=10, pattern='*', atomic=False):
+        super(InotifyWatcher, self).__init__(path, poll_interval, pattern, atomic)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        if libc.inotify_add_watch(self.fd, path, IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), '%s: %s' % (os.strerror(ctypes.get_errno()), path))
+        self.settling = {}      # name -> time of last modification, for items of unknown completeness
+        self.rescan()
+
+    def rescan(self):
+        now = time.time()
+        self.settling = dict((name, now) for name in self.listdir())
+
+    def read_events(self):
+        """Return the names of items completed by the queued events, and note modifications of settling items."""
+        complete = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+                name = buf[offset+EVENT_HEADER.size:offset+EVENT_HEADER.size+length].rstrip('\0')
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    self.rescan()
+                elif not self.matches(name):
+                    pass
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    self.settling.pop(name, None)
+                    complete.append(name)
+                elif name in self.settling:
+                    self.settling[name] = time.time()
+        return complete
+
+    def settled(self):
+        """Return the settling items that are complete by now."""
+        now = time.time()
+        complete = [name for name, modtime in self.settling.iteritems() if self.atomic or now - modtime >= self.poll_interval]
+        for name in complete:
+            del self.settling[name]
+        return [name for name in complete if os.path.exists(os.path.join(self.path, name))]
+
+    def wait(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            complete = self.read_events() + self.settled()
+            if complete:
+                return sorted(set(complete), key=complete.index)
+            wakeups = [deadline] if deadline is not None else []
+            if self.settling:
+                wakeups.append(min(self.settling.values()) + self.poll_interval)
+            wait_time = max(min(wakeups) - time.time(), 0) if wakeups else None
+            if deadline is not None and time.time() >= deadline:
+                return []
+            try:
+                select.select([self.fd], [], [], wait_time)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None